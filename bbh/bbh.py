@@ -3,24 +3,22 @@ import copy
 import cv2
 import pymorton as pm
 from sortedcontainers import SortedList
-from queue import PriorityQueue
+from bbh.merge_tree import MergeTree, Hierarchy, ReplayHierarchy
+from bbh.candidate_queue import CandidateQueue, IndexedCandidateQueue
+from bbh.morton import (morton_encode_bboxes, morton_argsort, get_curve, interleave2_batch, hilbert_encode,
+                        shifted_interleave2_batch, CURVES, MORTON_SHIFT)
+from bbh.spatial_index import GridIndex, bboxes_overlap
+from bbh.box_store import BoxStore
+from bbh.metrics import (uncovered_area_metric, uncovered_area_metric_with_labels, uncovered_area_metric_batch,
+                         uncovered_area_metric_with_labels_batch, METRICS, get_metric)
 
 
-def uncovered_area_metric(bbox_s, bbox_t):
-    x_tl, y_tl = min(bbox_s[0], bbox_t[0]), min(bbox_s[1], bbox_t[1])
-    x_br, y_br = max(bbox_s[2], bbox_t[2]), max(bbox_s[3], bbox_t[3])
-    area_s = (bbox_s[2]-bbox_s[0])*(bbox_s[3]-bbox_s[1])
-    area_t = (bbox_t[2]-bbox_t[0])*(bbox_t[3]-bbox_t[1])
-    area_st = (x_br-x_tl)*(y_br-y_tl)
-    return area_st - area_s - area_t
+# Below this No. of candidates one NumPy call is not faster than the scalar calls it replaces
+BATCH_MIN_CANDIDATES = 16
+# No. of nearest bboxes the merged bboxes are checked against before the grid, see BBHFastNonOverlap
+NON_OVERLAP_BLOCKERS = 16
 
 
-def uncovered_area_metric_with_labels(bbox_s, bbox_t, label_s=0, label_t=0, penalty=1e10):
-    if label_s == label_t:
-        return uncovered_area_metric(bbox_s=bbox_s, bbox_t=bbox_t)
-    else:
-        return penalty + uncovered_area_metric(bbox_s=bbox_s, bbox_t=bbox_t)
-
 class BBoxesVis:
     '''
     Bounding Box Visualization
@@ -46,12 +44,95 @@ class BBoxesVis:
         return self.canvas
 
 
+def check_output(output):
+    if output not in ("levels", "tree", "hierarchy", "replay"):
+        raise ValueError(f"Unknown output: {output}")
+
+
+def wrap_tree(tree, output, checkpoint_interval=None):
+    """
+    Return the merge tree in the format asked by merge(output=...)
+    """
+    if output == "hierarchy":
+        return Hierarchy(tree, checkpoint_interval=checkpoint_interval)
+    if output == "replay":
+        return ReplayHierarchy(tree)
+    return tree
+
+
+def n_merges_until(n, stop_at_count=None):
+    """
+    No. of merges to do on n bboxes for merge(stop_at_count=...), i.e. until stop_at_count bboxes are left.
+    All the n-1 merges if stop_at_count is None.
+    """
+    if stop_at_count is None:
+        return max(n - 1, 0)
+    if stop_at_count < 1:
+        raise ValueError(f"stop_at_count should be at least 1: {stop_at_count}")
+    return max(n - stop_at_count, 0)
+
+
+def make_candidate_queue(indexed_queue=False):
+    """
+    indexed_queue: if True, use IndexedCandidateQueue which deletes the pairs of merged bboxes,
+                   otherwise use CandidateQueue which skips them when popped
+    """
+    return IndexedCandidateQueue() if indexed_queue else CandidateQueue()
+
+
+def window_candidates(data, store, n_neighbors, dist_metric, dist_metric_batch=None, labels=None):
+    """
+    Candidate pairs (dist, s_idx, t_idx) of every bbox in the sorted keys data and its n_neighbors neighbors
+    on each side. The pairs are in the order of the double loop over the positions, i.e. the order they used to be
+    pushed in, so that ties are popped in the same order.
+    With dist_metric_batch all the pairs are computed in one batch call, otherwise one dist_metric call per pair.
+    labels: labels of the bboxes by idx, if given the metric also takes the two labels
+    """
+    n = len(data)
+    ids = store.key_ids(data)
+    if dist_metric_batch is None:
+        bboxes = store.coords[ids].tolist()
+        ids = ids.tolist()
+        if labels is None:
+            return [(dist_metric(bboxes[i], bboxes[j]), ids[i], ids[j])
+                    for i in range(n)
+                    for j in range(i-n_neighbors, i+n_neighbors+1)
+                    if 0 <= j < n and j != i]
+        return [(dist_metric(bboxes[i], bboxes[j], labels[ids[i]], labels[ids[j]]), ids[i], ids[j])
+                for i in range(n)
+                for j in range(i-n_neighbors, i+n_neighbors+1)
+                if 0 <= j < n and j != i]
+    offsets = np.array([d for d in range(-n_neighbors, n_neighbors+1) if d != 0], dtype=np.int64)
+    s_pos = np.repeat(np.arange(n), len(offsets))
+    t_pos = s_pos + np.tile(offsets, n)
+    valid = (t_pos >= 0) & (t_pos < n)
+    s_ids, t_ids = ids[s_pos[valid]], ids[t_pos[valid]]
+    if labels is None:
+        dists = dist_metric_batch(store.coords[s_ids], store.coords[t_ids])
+    else:
+        labels = np.asarray(labels)
+        dists = dist_metric_batch(store.coords[s_ids], store.coords[t_ids], labels[s_ids], labels[t_ids])
+    return zip(dists.tolist(), s_ids.tolist(), t_ids.tolist())
+
+
+def bulk_sorted_list(store, z=None):
+    """
+    Build the SortedList of the sort keys of all the bboxes in store at once, see BoxStore.key.
+    The keys are put in order by one argsort first, so that SortedList only does a linear pass instead of N insertions.
+    z: codes along another curve, store.z by default
+    """
+    z = store.z if z is None else z
+    order = morton_argsort(z[:len(store)], store.coords[:len(store)])
+    return SortedList(store.keys(order, z))
+
+
 class BBH:
     def __init__(self,
                  bboxes,
                  dist_metric=uncovered_area_metric):
         self.bboxes = bboxes
-        self.dist_metric = dist_metric
+        # dist_metric: name in bbh.metrics.METRICS, a (scalar, batch) pair or a scalar metric
+        self.dist_metric, self.dist_metric_batch = get_metric(dist_metric)  # batch is None if there is none
 
     def _merge2(self, bbox_s, bbox_t):
         """
@@ -74,14 +155,22 @@ class BBHNaive(BBH):
                  dist_metric=uncovered_area_metric):
         super().__init__(bboxes=bboxes, dist_metric=dist_metric)
 
-    def merge(self):
+    def merge(self, output="levels", checkpoint_interval=None, stop_at_count=None, max_cost=None):
+        """
+        output: "levels", "tree", "hierarchy" or "replay", see BBHFast.merge
+        stop_at_count, max_cost: stop early, see BBHFast.merge
+        """
+        check_output(output)
         n = len(self.bboxes)
-        hierarchy = [[] for i in range(n)]
-        hierarchy[n-1] = copy.deepcopy(self.bboxes)
-        # There will be n-1 iterations
-        for idx in range(n-2, -1, -1):
+        store = BoxStore.from_bboxes(self.bboxes)  # bbox of every node, node ids are the store idx
+        hierarchy = [copy.deepcopy(self.bboxes)]
+        node_ids = list(range(n))  # Node id of each bbox in the current level, used to build the merge tree
+        merge_children = []
+        merge_costs = []
+        # There will be n-1 iterations without early stop
+        for _ in range(n_merges_until(n, stop_at_count)):
             # Calculate the pair distance between any two bboxs in previous round
-            candidates = hierarchy[idx+1]
+            candidates = hierarchy[-1]
             nc = len(candidates)
             to_merge_idx_s = -1
             to_merge_idx_t = -1
@@ -93,99 +182,362 @@ class BBHNaive(BBH):
                         min_dist = dist
                         to_merge_idx_s = i
                         to_merge_idx_t = j
+            if max_cost is not None and min_dist > max_cost:
+                break
             # Merge the two bboxes that have the minimum distance
-            bbox_merged = self._merge2(candidates[to_merge_idx_s], candidates[to_merge_idx_t])
+            bbox_merged = store.bbox(store.merge(node_ids[to_merge_idx_s], node_ids[to_merge_idx_t]))
             # Copy the list, delete the candidate two and insert the merged one
             bbox_list = [candidates[i] for i in range(nc) if i!=to_merge_idx_s and i!=to_merge_idx_t]
             bbox_list.append(bbox_merged)
-            hierarchy[idx] = bbox_list
-        hierarchy.reverse()
+            hierarchy.append(bbox_list)
+            merge_children.append((node_ids[to_merge_idx_s], node_ids[to_merge_idx_t]))
+            merge_costs.append(min_dist)
+            node_ids = [node_ids[i] for i in range(nc) if i!=to_merge_idx_s and i!=to_merge_idx_t]
+            node_ids.append(n + len(merge_children) - 1)
+        if output != "levels":
+            # Bboxes in a level are ordered by node id, same as the list output
+            tree = MergeTree(n_leaves=n,
+                             bboxes=store.coords[:len(store)],
+                             children=merge_children,
+                             costs=merge_costs)
+            return wrap_tree(tree, output, checkpoint_interval)
         return hierarchy
 
 
+class BBHNaiveVectorized(BBH):
+    """
+    NumPy version of BBHNaive, gives exactly the same hierarchy including the tie-breaking.
+    An N x N cost matrix is kept, after each merge only the column of the merged bbox is recomputed.
+    dist[r, c] is the cost of the bboxes in slot r and c if node id of c is larger than node id of r, otherwise inf.
+    The merged bbox takes the slot of one of its children and gets the largest node id, so it only has a column.
+    Any metric with a batch version is supported, see bbh.metrics.METRICS. Memory is O(N^2), e.g. 200MB for 5k bboxes.
+    """
+    def __init__(self,
+                 bboxes,
+                 dist_metric=uncovered_area_metric,
+                 chunk_size=1024):
+        super().__init__(bboxes=bboxes, dist_metric=dist_metric)
+        if self.dist_metric_batch is None:
+            raise ValueError(f"No batch version of the metric: {dist_metric}")
+        self.chunk_size = chunk_size  # No. of rows computed at a time when building the cost matrix
+
+    def _cost(self, bbox, bboxes):
+        """
+        Cost between one bbox and an array of bboxes, bbox can also be the array and bboxes the single bbox
+        """
+        return self.dist_metric_batch(bbox, bboxes)
+
+    def _init_costs(self):
+        bboxes = self.slot_bboxes
+        n = len(bboxes)
+        self.dist = np.full((n, n), np.inf)
+        for r0 in range(0, n, self.chunk_size):
+            self.dist[r0:r0+self.chunk_size] = self._cost(bboxes[r0:r0+self.chunk_size, None, :], bboxes)
+        # Only keep the pairs where the column has a larger node id
+        self.dist[np.tril_indices(n)] = np.inf
+
+    def _row_costs(self, r):
+        """
+        Costs of slot r against every slot, inf for the slots which are dead or have a smaller node id
+        """
+        return self.dist[r]
+
+    def _update_merged(self, s, t, alive):
+        """
+        Slot s now holds the merged bbox and slot t is dead.
+        Return the costs between the merged bbox and the bboxes in the alive slots.
+        """
+        self.dist[s] = np.inf
+        self.dist[t] = np.inf
+        self.dist[:, t] = np.inf
+        # The bbox with the smaller node id goes first like BBHNaive, so the metric does not have to be symmetric
+        costs = self._cost(self.slot_bboxes[alive], self.slot_bboxes[s])
+        self.dist[alive, s] = costs
+        return costs
+
+    def _row_min(self, r):
+        """
+        Minimum of row r, ties broken by the smallest node id like the double loop of BBHNaive
+        """
+        row = self._row_costs(r)
+        min_dist = row.min() if len(row) > 0 else np.inf
+        if min_dist == np.inf:
+            return min_dist, -1
+        cols = np.flatnonzero(row == min_dist)
+        return min_dist, cols[np.argmin(self.node_ids[cols])]
+
+    def merge(self, output="levels", checkpoint_interval=None, stop_at_count=None, max_cost=None):
+        """
+        output: "levels", "tree", "hierarchy" or "replay", see BBHFast.merge
+        stop_at_count, max_cost: stop early, see BBHFast.merge
+        """
+        check_output(output)
+        n = len(self.bboxes)
+        store = BoxStore.from_bboxes(self.bboxes)  # bbox of every node
+        self.slot_bboxes = store.coords[:n].copy()  # bbox in each slot
+        self.node_ids = np.arange(n)  # node id in each slot, -1 for dead slots
+        self._init_costs()
+        row_min = np.full(n, np.inf)
+        row_arg = np.full(n, -1)
+        for r in range(n):
+            row_min[r], row_arg[r] = self._row_min(r)
+
+        merge_children = []
+        merge_costs = []
+        for k in range(n_merges_until(n, stop_at_count)):
+            min_dist = row_min.min()
+            if max_cost is not None and min_dist > max_cost:
+                break
+            rows = np.flatnonzero(row_min == min_dist)
+            s = rows[np.argmin(self.node_ids[rows])]
+            t = row_arg[s]
+            merge_children.append((self.node_ids[s], self.node_ids[t]))
+            merge_costs.append(min_dist)
+            store.merge(self.node_ids[s], self.node_ids[t])
+
+            # Slot s holds the merged bbox, slot t is dead
+            self.slot_bboxes[s] = store.coords[n+k]
+            self.node_ids[s] = n + k
+            self.node_ids[t] = -1
+            row_min[s], row_arg[s] = np.inf, -1
+            row_min[t], row_arg[t] = np.inf, -1
+            # The merged bbox has the largest node id, so it goes to the column s of every alive row
+            alive = np.flatnonzero(self.node_ids >= 0)
+            alive = alive[alive != s]
+            costs = self._update_merged(s, t, alive)
+            # Rows whose minimum was s or t have to be recomputed, others only compare with the new column.
+            # Ties keep the old minimum as the merged bbox has the largest node id.
+            stale = (row_arg[alive] == s) | (row_arg[alive] == t)
+            better = ~stale & (costs < row_min[alive])
+            row_min[alive[better]] = costs[better]
+            row_arg[alive[better]] = s
+            for r in alive[stale]:
+                row_min[r], row_arg[r] = self._row_min(r)
+
+        # Bboxes in a level are ordered by node id, same as BBHNaive
+        tree = MergeTree(n_leaves=n,
+                         bboxes=store.coords[:n+len(merge_children)],
+                         children=merge_children,
+                         costs=merge_costs)
+        if output == "levels":
+            return tree.levels()
+        return wrap_tree(tree, output, checkpoint_interval)
+
+
+class BBHExactNN(BBHNaiveVectorized):
+    """
+    Exact bounding box hierarchy with a cached nearest-neighbor table, same hierarchy as BBHNaive.
+    Instead of the N x N cost matrix, only the nearest neighbor (among the bboxes with larger node id) of each bbox
+    is cached. After a merge, the costs of the merged bbox are computed once and compared with the cached minima,
+    only the bboxes whose nearest neighbor was merged rescan the current level.
+    Memory is O(N), time is O(N^2) in practice and O(N^3) in the worst case.
+    Nearest-neighbor chain is not used since uncovered_area_metric does not satisfy the reducibility property,
+    it would not reproduce the greedy merge order.
+    """
+    def __init__(self,
+                 bboxes,
+                 dist_metric=uncovered_area_metric):
+        super().__init__(bboxes=bboxes, dist_metric=dist_metric)
+
+    def _init_costs(self):
+        pass
+
+    def _row_costs(self, r):
+        cols = np.flatnonzero(self.node_ids > self.node_ids[r])
+        row = np.full(len(self.node_ids), np.inf)
+        row[cols] = self._cost(self.slot_bboxes[r], self.slot_bboxes[cols])
+        return row
+
+    def _update_merged(self, s, t, alive):
+        return self._cost(self.slot_bboxes[alive], self.slot_bboxes[s])
+
+
 class BBHFast(BBH):
     def __init__(self,
                  bboxes,
                  dist_metric=uncovered_area_metric,
-                 n_neighbors=4):
+                 n_neighbors=4,
+                 indexed_queue=False,
+                 curve="morton",
+                 extra_curves=()):
         super().__init__(bboxes=bboxes, dist_metric=dist_metric)
         self.n_neighbors = n_neighbors
+        self.indexed_queue = indexed_queue  # Delete the pairs of merged bboxes from the queue instead of skipping them
+        self.curve = curve  # Space-filling curve used to order the bboxes, see bbh.morton.CURVES
+        self.curve_encode = get_curve(curve)[0]
+        # Neighbors along these curves are also used as candidates, e.g. ["morton_shifted"] catches the pairs
+        # separated by a quadrant boundary of the main curve. Levels are still ordered by the main curve.
+        self.extra_curves = list(extra_curves)
+        self.extra_curve_encodes = [get_curve(c)[0] for c in self.extra_curves]
         self.n_bboxes = len(bboxes)  # No. of bboxes initially. Save this because later this will change.
-        self.idx2bbox_tuple = {}  # map idx(int) to bbox tuple (morton_code, bbox, index)
 
-    def merge(self):
+    def merge(self, output="levels", checkpoint_interval=None, stop_at_count=None, max_cost=None):
+        """
+        output: "levels" returns every level as a list of bboxes, which takes O(N^2) time and memory.
+                "tree" returns a MergeTree, which takes O(N) memory and rebuilds any level on demand.
+                "hierarchy" returns a Hierarchy, a lazy sequence of levels backed by the merge tree.
+                "replay" returns a ReplayHierarchy, a lazy sequence of levels with O(N) memory,
+                fastest to go through the levels in order.
+        Only one sorted level is kept during the merges whatever the output, the levels are replayed from the merges.
+        checkpoint_interval: only used by "hierarchy", see Hierarchy
+        stop_at_count: stop when this No. of bboxes is left, i.e. the last level has stop_at_count bboxes
+        max_cost: stop before the first merge whose cost is larger than max_cost
+        With an early stop only the levels up to the stop are returned, the merges after it are never computed.
+        """
+        check_output(output)
         self._morton_order()
+        store = self.store
 
-        hierarchy = []
-        is_merged = set()
-        cur_idx = len(self.bboxes)  # Index for new merged bbox
-        pq = PriorityQueue()  # Use priority queue for quick candidate selection
-        for i in range(len(self.data)):
-            for j in range(i-self.n_neighbors, i+self.n_neighbors+1):
-                if 0 <= j < len(self.data) and j != i:
-                    dist = self.dist_metric(self.data[i][1], self.data[j][1])
-                    pq.put((dist, self.data[i], self.data[j]))
-
-        hierarchy.append(self.data.copy())  # original bboxes
-        for i in range(0, self.n_bboxes-1):
-            while True:
-                p = pq.get()
-                s_idx, t_idx = p[1][2], p[2][2]  # get the index of the bbox pair
-                if s_idx not in is_merged and t_idx not in is_merged:
-                    break
-            # Merge the selected two bboxes to get a new one
-            bbox_merged = self._merge2(p[1][1], p[2][1])  # merge two bbox
-            new_center_x, new_center_y = int((bbox_merged[0] + bbox_merged[2]) / 2), int(
-                (bbox_merged[1] + bbox_merged[3]) / 2)
-            z_merged = pm.interleave2(new_center_x, new_center_y)
-            d_merged = (z_merged, bbox_merged, cur_idx)
-            self.idx2bbox_tuple[cur_idx] = d_merged
-            cur_idx += 1  # index for next bbox
+        merge_children = []  # (s_idx, t_idx) of each merge, used to build the merge tree
+        merge_costs = []
+        pq = make_candidate_queue(self.indexed_queue)  # Use priority queue for quick candidate selection
+        self._init_candidates(pq)
+
+        cur_data = self.data  # current level, updated in place
+        for i in range(n_merges_until(self.n_bboxes, stop_at_count)):
+            dist, s_idx, t_idx = pq.pop_valid(store.alive)  # get the index of the bbox pair
+            if max_cost is not None and dist > max_cost:
+                break
+            # Merge the selected two bboxes to get a new one, its index is the next slot of the store
+            key_merged = store.key(store.merge(s_idx, t_idx))
+            merge_children.append((s_idx, t_idx))
+            merge_costs.append(dist)
 
-            # Mark the selected two boxes as merged
-            is_merged.add(s_idx)
-            is_merged.add(t_idx)
+            # Drop the pairs of the merged bboxes, store.merge marked them as not alive
+            pq.remove_box(s_idx)
+            pq.remove_box(t_idx)
 
             # Remove the merged bboxes from the current sorted list
-            cur_data = hierarchy[i].copy()  # Copy from previous level first. This is not necessary so does not count
-            cur_data.remove(self.idx2bbox_tuple[s_idx])
-            cur_data.remove(self.idx2bbox_tuple[t_idx])
+            cur_data.remove(store.key(s_idx))
+            cur_data.remove(store.key(t_idx))
             # Add the merged bbox to the sorted list
-            cur_data.add(d_merged)  # BST insert, O(logN)
+            cur_data.add(key_merged)  # BST insert, O(logN)
             # Search neighbors and calculate the distance
-            m_idx = cur_data.index(d_merged)  # Get the index of the added element in the sorted list. Log(N)
-            for j in range(m_idx-self.n_neighbors, m_idx+self.n_neighbors+1):
-                if 0 <= j < len(cur_data) and j != m_idx:
-                    dist = self.dist_metric(cur_data[m_idx][1], cur_data[j][1])
-                    pq.put((dist, cur_data[m_idx], cur_data[j]))
-
-            hierarchy.append(cur_data)
-        # Post-processing. Convert OrderedList to List
-        hl = []
-        for h in hierarchy:
-            l = []
-            for t in h:
-                l.append(t[1])
-            hl.append(l)
-        return hl
+            self._merged_candidates(pq, cur_data, key_merged, s_idx, t_idx)
+        self.queue_stats = pq.stats()
+        tree = self._merge_tree(merge_children, merge_costs)
+        if output == "levels":
+            return tree.levels()
+        return wrap_tree(tree, output, checkpoint_interval)
+
+    def _init_candidates(self, pq):
+        """
+        Push the candidate pairs of the original bboxes, i.e. the neighbors along each curve
+        """
+        for data in [self.data] + self.extra_data:
+            pq.extend(window_candidates(data, self.store, self.n_neighbors, self.dist_metric, self.dist_metric_batch))
+
+    def _push_candidates(self, pq, data, m_idx, bbox_merged, m):
+        """
+        Push the pairs of the merged bbox m at position m_idx of data and its n_neighbors neighbors on each side.
+        With a batch metric and enough neighbors the costs are computed in one call.
+        """
+        js = [j for j in range(m_idx-self.n_neighbors, m_idx+self.n_neighbors+1) if 0 <= j < len(data) and j != m_idx]
+        if self.dist_metric_batch is not None and len(js) >= BATCH_MIN_CANDIDATES:
+            ids = [self.store.key_idx(data[j]) for j in js]
+            for dist, idx in zip(self.dist_metric_batch(bbox_merged, self.store.coords[ids]).tolist(), ids):
+                pq.push(dist, m, idx)
+            return
+        for j in js:
+            idx = self.store.key_idx(data[j])
+            pq.push(self.dist_metric(bbox_merged, self.store.bbox(idx)), m, idx)
+
+    def _merged_candidates(self, pq, cur_data, key_merged, s_idx, t_idx):
+        """
+        Push the candidate pairs of the merged bbox, its sort key key_merged is already in cur_data.
+        s_idx and t_idx are the merged bboxes.
+        """
+        m = self.store.key_idx(key_merged)
+        bbox_merged = self.store.bbox(m)
+        m_idx = cur_data.index(key_merged)  # Get the index of the added element in the sorted list. Log(N)
+        self._push_candidates(pq, cur_data, m_idx, bbox_merged, m)
+        # Same for the extra curves, these sorted lists are updated in place
+        if self.extra_data:
+            new_center_x, new_center_y = int((bbox_merged[0] + bbox_merged[2]) / 2), int(
+                (bbox_merged[1] + bbox_merged[3]) / 2)
+        for data, z, encode in zip(self.extra_data, self.extra_z, self.extra_curve_encodes):
+            z[m] = encode(new_center_x, new_center_y)
+            key_extra = self.store.key(m, z)
+            data.remove(self.store.key(s_idx, z))
+            data.remove(self.store.key(t_idx, z))
+            data.add(key_extra)
+            self._push_candidates(pq, data, data.index(key_extra), bbox_merged, m)
 
     def _morton_order(self):
         """
         Calculate the Morton-order or Z-order of the bboxes
         """
-        self.bbox_centers = [[int((x_tl+x_br)/2), int((y_tl+y_br)/2)] for x_tl, y_tl, x_br, y_br in self.bboxes]
-        self.z_orders = [pm.interleave2(x, y) for x, y in self.bbox_centers]
+        self.store = BoxStore.from_bboxes(self.bboxes, curve=self.curve)
         # Use SortedList for Fast Insertion and Deletion
+        self.data = bulk_sorted_list(self.store)
+        self.extra_z = [self.store.codes(curve) for curve in self.extra_curves]
+        self.extra_data = [bulk_sorted_list(self.store, z) for z in self.extra_z]
 
-        self.data = SortedList()
-        for idx, (bbox, z_order) in enumerate(zip(self.bboxes, self.z_orders)):
-            self.data.add((z_order, bbox, idx))
-            self.idx2bbox_tuple[idx] = (z_order, bbox, idx)
+    def _merge_tree(self, merge_children, merge_costs):
+        """
+        Build the merge tree from the recorded merges. Node ids are the same as the bbox indices used in merge().
+        """
+        n_nodes = self.n_bboxes + len(merge_children)
+        return MergeTree(n_leaves=self.n_bboxes,
+                         bboxes=self.store.coords[:n_nodes],
+                         children=merge_children,
+                         costs=merge_costs,
+                         keys=self.store.z[:n_nodes])
 
     def _radix_sort(self):
         pass
 
 
+class BBHFastGrid(BBHFast):
+    """
+    Fast Bounding Box Hierarchy Algorithm with a spatial index for candidate generation.
+    Instead of the neighbors along the Morton curve, the candidates of a bbox are its k nearest bboxes
+    under uncovered_area_metric in the current level, found with a dynamic uniform grid (see GridIndex).
+    Merged bboxes are removed from the grid and the new one is inserted after each merge.
+    This finds the close pairs that are far apart in Morton order, e.g. on dense OCR pages.
+    k is 2*n_neighbors, the same No. of distance evaluations per bbox as BBHFast.
+    Levels are still ordered by the Morton code.
+    """
+    def __init__(self,
+                 bboxes,
+                 n_neighbors=4,
+                 indexed_queue=False):
+        super().__init__(bboxes=bboxes,
+                         dist_metric=uncovered_area_metric,
+                         n_neighbors=n_neighbors,
+                         indexed_queue=indexed_queue)
+
+    def _init_candidates(self, pq):
+        self.grid = GridIndex.from_bboxes(self.bboxes, dist_metric=self.dist_metric)
+        k = 2 * self.n_neighbors
+        for idx, bbox in enumerate(self.bboxes):
+            for dist, j in self.grid.knn(bbox, k, exclude=idx):
+                pq.push(dist, idx, j)
+
+    def _merged_candidates(self, pq, cur_data, key_merged, s_idx, t_idx):
+        m = self.store.key_idx(key_merged)
+        bbox_merged = self.store.bbox(m)
+        self.grid.remove(s_idx)
+        self.grid.remove(t_idx)
+        for dist, j in self.grid.knn(bbox_merged, 2 * self.n_neighbors):
+            pq.push(dist, m, j)
+        self.grid.insert(m, bbox_merged)
+
+
+class _LabelMetric:
+    """
+    dist_metric of a multi-label algorithm with both labels fixed to label, so that the bboxes of one label can be
+    merged by BBHFast. A class instead of a closure so that it can be sent to a worker process.
+    Works for both the scalar and the batch metric, the labels are passed by position.
+    """
+    def __init__(self, dist_metric, label):
+        self.dist_metric = dist_metric
+        self.label = label
+
+    def __call__(self, bbox_s, bbox_t):
+        return self.dist_metric(bbox_s, bbox_t, self.label, self.label)
+
+
 class BBHFastMultiLabel():
     """
     Fast Bounding Box hierarchy Algorithm for multi-label inputs.
@@ -196,207 +548,364 @@ class BBHFastMultiLabel():
     label2:[[bbox1], [bbox2], ..., [bbox_n]],
     ...
     label_n:[[bbox1], [bbox2], ..., [bbox_n]]}
+
+    With partition_labels=True the bboxes of each label are merged on their own by BBHFast, in a process pool
+    across the labels, then the label roots are merged with the cross-label rule of dist_metric.
+    When the labels are spatially interleaved, e.g. CityPersons, the Morton neighbors of a bbox are mostly bboxes of
+    other labels whose pairs only cost the penalty, this mode spends every neighbor slot on a bbox of the same label.
+    The label merges are interleaved by cost, so as long as every same-label cost is below the penalty the order is
+    the one of the single queue: all the same-label merges first, then the cross-label ones.
+    workers: No. of processes, None for the No. of CPUs, 1 to run in this process
     """
     def __init__(self,
                  bboxes,
                  labels,
                  dist_metric=uncovered_area_metric_with_labels,
-                 n_neighbors=4):
+                 n_neighbors=4,
+                 indexed_queue=False,
+                 partition_labels=False,
+                 workers=None):
         self.bboxes = bboxes
         self.labels = labels
-        self.dist_metric = dist_metric
+        self.dist_metric, self.dist_metric_batch = get_metric(dist_metric)
         self.n_neighbors = n_neighbors
+        self.indexed_queue = indexed_queue
+        self.partition_labels = partition_labels  # Merge each label on its own first, see above
+        self.workers = workers
 
         self.n_bboxes = len(bboxes)
-        self.idx2bbox_tuple = {}
 
-    def merge(self):
+    def merge(self, stop_at_count=None, max_cost=None):
+        """
+        Return the levels of bboxes and the levels of their labels.
+        stop_at_count, max_cost: stop early, see BBHFast.merge
+        """
+        if self.partition_labels:
+            tree, labels = self._merge_partitioned(stop_at_count, max_cost)
+        else:
+            tree, labels = self._merge_interleaved(stop_at_count, max_cost)
+        # Replay the merges to get the lists of bboxes and labels of every level
+        hl = []
+        hierarchy_labels = []
+        for ids in map(ReplayHierarchy(tree).level_ids, range(len(tree))):
+            hl.append(tree.bboxes[ids].tolist())
+            hierarchy_labels.append([labels[idx] for idx in ids.tolist()])
+        return hl, hierarchy_labels
+
+    def _merge_interleaved(self, stop_at_count=None, max_cost=None):
+        """
+        Merge all the labels in one Morton order and one queue, return the merge tree and the label of every node
+        """
         self._morton_order()
+        store = self.store
+        labels = [int(label) for label in store.label[:self.n_bboxes]]  # label of each bbox idx as int
 
-        hierarchy = []
-        is_merged = set()
-        cur_idx = len(self.bboxes)  # Index for new merged bbox
-        pq = PriorityQueue()  # Use priority queue for quick candidate selection
-        for i in range(len(self.data)):
-            for j in range(i - self.n_neighbors, i + self.n_neighbors + 1):
-                if 0 <= j < len(self.data) and j != i:
-                    dist = self.dist_metric(self.data[i][1], self.data[j][1], self.data[i][3], self.data[j][3])
-                    pq.put((dist, self.data[i], self.data[j]))
-
-        hierarchy.append(self.data.copy())  # original bboxes
-        for i in range(0, self.n_bboxes - 1):
-            while True:
-                p = pq.get()
-                s_idx, t_idx = p[1][2], p[2][2]  # get the index of the bbox pair
-                if s_idx not in is_merged and t_idx not in is_merged:
-                    break
-            # Merge the selected two bboxes to get a new one
-            bbox_merged, label_merged = self._merge2withlabels(p[1][1], p[2][1], p[1][3], p[2][3])  # merge two bbox
-            new_center_x, new_center_y = int((bbox_merged[0] + bbox_merged[2]) / 2), int(
-                (bbox_merged[1] + bbox_merged[3]) / 2)
-            z_merged = pm.interleave2(new_center_x, new_center_y)
-            d_merged = (z_merged, bbox_merged, cur_idx, label_merged)
-            self.idx2bbox_tuple[cur_idx] = d_merged
-            cur_idx += 1  # index for next bbox
+        merge_children = []
+        merge_costs = []
+        pq = make_candidate_queue(self.indexed_queue)  # Use priority queue for quick candidate selection
+        pq.extend(window_candidates(self.data, store, self.n_neighbors, self.dist_metric, self.dist_metric_batch,
+                                    labels=labels))
 
-            # Mark the selected two boxes as merged
-            is_merged.add(s_idx)
-            is_merged.add(t_idx)
+        cur_data = self.data  # current level, updated in place
+        for i in range(n_merges_until(self.n_bboxes, stop_at_count)):
+            dist, s_idx, t_idx = pq.pop_valid(store.alive)  # get the index of the bbox pair
+            if max_cost is not None and dist > max_cost:
+                break
+            # Merge the selected two bboxes to get a new one, the label of the merged bbox is the larger one
+            m = store.merge(s_idx, t_idx)
+            key_merged = store.key(m)
+            bbox_merged = store.bbox(m)
+            label_merged = max(labels[s_idx], labels[t_idx])
+            labels.append(label_merged)
+            merge_children.append((s_idx, t_idx))
+            merge_costs.append(dist)
+
+            # Drop the pairs of the merged bboxes, store.merge marked them as not alive
+            pq.remove_box(s_idx)
+            pq.remove_box(t_idx)
 
             # Remove the merged bboxes from the current sorted list
-            cur_data = hierarchy[i].copy()  # Copy from previous level first. This is not necessary so does not count
-            cur_data.remove(self.idx2bbox_tuple[s_idx])
-            cur_data.remove(self.idx2bbox_tuple[t_idx])
+            cur_data.remove(store.key(s_idx))
+            cur_data.remove(store.key(t_idx))
             # Add the merged bbox to the sorted list
-            cur_data.add(d_merged)  # BST insert, O(logN)
+            cur_data.add(key_merged)  # BST insert, O(logN)
             # Search neighbors and calculate the distance
-            m_idx = cur_data.index(d_merged)  # Get the index of the added element in the sorted list. Log(N)
-            for j in range(m_idx - self.n_neighbors, m_idx + self.n_neighbors + 1):
-                if 0 <= j < len(cur_data) and j != m_idx:
-                    dist = self.dist_metric(cur_data[m_idx][1], cur_data[j][1], cur_data[m_idx][3], cur_data[j][3])
-                    pq.put((dist, cur_data[m_idx], cur_data[j]))
-
-            hierarchy.append(cur_data)
-        # Post-processing. Convert OrderedList to List
-        hl = []
-        hierarchy_labels = []
-        for h in hierarchy:
-            l = []
-            hlabel = []
-            for t in h:
-                l.append(t[1])
-                hlabel.append(t[3])
-            hl.append(l)
-            hierarchy_labels.append(hlabel)
-        return hl, hierarchy_labels
+            m_idx = cur_data.index(key_merged)  # Get the index of the added element in the sorted list. Log(N)
+            js = [j for j in range(m_idx - self.n_neighbors, m_idx + self.n_neighbors + 1)
+                  if 0 <= j < len(cur_data) and j != m_idx]
+            if self.dist_metric_batch is not None and len(js) >= BATCH_MIN_CANDIDATES:
+                ids = [store.key_idx(cur_data[j]) for j in js]
+                dists = self.dist_metric_batch(bbox_merged, store.coords[ids], label_merged, store.label[ids])
+                for dist, idx in zip(dists.tolist(), ids):
+                    pq.push(dist, m, idx)
+            else:
+                for j in js:
+                    idx = store.key_idx(cur_data[j])
+                    dist = self.dist_metric(bbox_merged, store.bbox(idx), label_merged, labels[idx])
+                    pq.push(dist, m, idx)
+        self.queue_stats = pq.stats()
+        n_nodes = self.n_bboxes + len(merge_children)
+        return MergeTree(n_leaves=self.n_bboxes,
+                         bboxes=store.coords[:n_nodes],
+                         children=merge_children,
+                         costs=merge_costs,
+                         keys=store.z[:n_nodes]), labels
 
-    def _merge2withlabels(self, bbox_s, bbox_t,
-                          label_s, label_t):
-        x_tl, y_tl = min(bbox_s[0], bbox_t[0]), min(bbox_s[1], bbox_t[1])
-        x_br, y_br = max(bbox_s[2], bbox_t[2]), max(bbox_s[3], bbox_t[3])
-        return [x_tl, y_tl, x_br, y_br], max(label_s, label_t)
+    def _run_labels(self, bboxes, groups, labels, max_cost=None):
+        """
+        Run BBHFast on the bboxes of every label, groups[i] are the indices of the bboxes with label labels[i]
+        """
+        from bbh.parallel import run_groups  # bbh.parallel imports this module
+        jobs = [(bboxes[ids].tolist(),
+                 (_LabelMetric(self.dist_metric, label),
+                  None if self.dist_metric_batch is None else _LabelMetric(self.dist_metric_batch, label)),
+                 self.n_neighbors, self.indexed_queue, max_cost) for ids, label in zip(groups, labels)]
+        return run_groups(jobs, self.workers)
+
+    def _merge_partitioned(self, stop_at_count=None, max_cost=None):
+        """
+        Merge the bboxes of each label on their own, then the label roots with the cross-label rule.
+        Return the merge tree and the label of every node.
+        """
+        from bbh.parallel import interleave_merges  # bbh.parallel imports this module
+        n = self.n_bboxes
+        bboxes = np.asarray(self.bboxes).reshape(-1, 4)
+        labels = [int(label) for label in np.asarray(self.labels).reshape(-1)]
+        group_labels = sorted(set(labels))
+        groups = [np.flatnonzero(np.asarray(labels) == label) for label in group_labels]
+        results = self._run_labels(bboxes, groups, group_labels, max_cost)
+        self.queue_stats = {key: sum(result[3][key] for result in results)
+                            for key in ("pushed", "popped", "stale_pops", "removed", "size")}
+
+        # Interleave the label merges by cost, keeping the order inside each label
+        local2global = [ids.tolist() for ids in groups]  # local node id -> global node id of each label
+        merge_children, merge_costs, bboxes_merged, merge_groups = interleave_merges(results, local2global, n,
+                                                                                     n_merges_until(n, stop_at_count))
+        labels.extend(group_labels[g] for g in merge_groups)
+        all_bboxes = np.concatenate([bboxes] + bboxes_merged)
+
+        # Merge what is left of every label, the label roots unless stopped early, with the cross-label rule
+        alive = np.ones(n + len(merge_children), dtype=bool)
+        alive[np.asarray(merge_children, dtype=np.int64).ravel()] = False
+        root_ids = np.flatnonzero(alive)
+        if len(root_ids) > 1:
+            roots = BBHFastMultiLabel(bboxes=all_bboxes[root_ids].tolist(),
+                                      labels=[labels[idx] for idx in root_ids.tolist()],
+                                      dist_metric=(self.dist_metric, self.dist_metric_batch),
+                                      n_neighbors=self.n_neighbors,
+                                      indexed_queue=self.indexed_queue)
+            tree, root_labels = roots._merge_interleaved(stop_at_count=stop_at_count, max_cost=max_cost)
+            root2global = root_ids.tolist()
+            for (s, t), cost in zip(tree.children.tolist(), tree.costs.tolist()):
+                merge_children.append((root2global[s], root2global[t]))
+                merge_costs.append(cost)
+                root2global.append(n + len(merge_children) - 1)
+            labels.extend(root_labels[tree.n_leaves:])
+            all_bboxes = np.concatenate((all_bboxes, tree.bboxes[tree.n_leaves:]))
+            for key in self.queue_stats:
+                self.queue_stats[key] += roots.queue_stats[key]
+
+        # Levels are ordered by Morton code like the single queue
+        return MergeTree(n_leaves=n,
+                         bboxes=all_bboxes,
+                         children=merge_children,
+                         costs=merge_costs,
+                         keys=morton_encode_bboxes(all_bboxes)), labels
 
     def _morton_order(self):
         """
         Calculate the Morton-order or Z-order of the bboxes
         """
-        self.bbox_centers = [[int((x_tl+x_br)/2), int((y_tl+y_br)/2)] for x_tl, y_tl, x_br, y_br in self.bboxes]
-        self.z_orders = [pm.interleave2(x, y) for x, y in self.bbox_centers]
+        self.store = BoxStore.from_bboxes(self.bboxes, labels=self.labels)
         # Use SortedList for Fast Insertion and Deletion
-
-        self.data = SortedList()
-        for idx, (bbox, z_order, label) in enumerate(zip(self.bboxes, self.z_orders, self.labels)):
-            self.data.add((z_order, bbox, idx, label))
-            self.idx2bbox_tuple[idx] = (z_order, bbox, idx, label)
+        self.data = bulk_sorted_list(self.store)
 
 class BBHFastNonOverlap(BBHFast):
     """
-    Fast Bounding Box Hierarchy Algorithm with Non-overlapping Constraint
+    Fast Bounding Box Hierarchy Algorithm with Non-overlapping Constraint.
+    A pair is only merged if the merged bbox does not overlap any other bbox of the current level.
+    The candidates are the neighbors along the Morton curve like BBHFast. The overlap check queries a GridIndex of
+    the current level for the bboxes which can reach the merged bbox, so every overlap is found wherever the other
+    bbox is in Morton order, and the bboxes are never looked up in the sorted level.
+    A rejected pair never becomes valid again: the bbox it overlaps is only merged into larger bboxes, which still
+    overlap it. So the rejected pairs are dropped, and when the queue runs out the k nearest bboxes of every bbox
+    in the grid are added as candidates, then if none of them can be merged, every pair of the level.
+    A bbox which has been paired with the whole level is marked as exhausted and later refills skip it, its pairs
+    with the bboxes merged after that are pushed by the new bboxes. So each bbox is paired with the whole level at
+    most once. The merged bboxes of these pairs are first checked against the nearest bboxes of the bbox with numpy,
+    which rejects most of them, and only the rest are checked in the grid.
+    If no pair of the level can be merged, merge() stops early and the last level has more than one bbox.
+    dist_metric: only uncovered_area_metric, the knn queries of the grid prune with its lower bound, see GridIndex
     """
     def __init__(self,
                  bboxes,
                  dist_metric=uncovered_area_metric,
                  n_neighbors=4,
-                 check_overlap_neighbors=5):
-        self.bboxes = bboxes
-        self.dist_metric = dist_metric
-        self.n_neighbors = n_neighbors
-        self.check_overlap_neighbors = check_overlap_neighbors
-
-        self.n_bboxes = len(bboxes)
-        self.idx2bbox_tuple = {}
+                 indexed_queue=False,
+                 curve="morton"):
+        super().__init__(bboxes=bboxes,
+                         dist_metric=dist_metric,
+                         n_neighbors=n_neighbors,
+                         indexed_queue=indexed_queue,
+                         curve=curve)
+        if self.dist_metric is not uncovered_area_metric:
+            raise ValueError("BBHFastNonOverlap only supports uncovered_area_metric")
 
-    def merge(self):
+    def merge(self, output="levels", checkpoint_interval=None, stop_at_count=None, max_cost=None):
+        """
+        output: "levels", "tree", "hierarchy" or "replay", see BBHFast.merge
+        stop_at_count, max_cost: stop early, see BBHFast.merge
+        """
+        check_output(output)
         self._morton_order()
+        store = self.store
+        self.grid = GridIndex.from_bboxes(self.bboxes, dist_metric=self.dist_metric)
 
-        hierarchy = []
-        is_merged = set()
-        cur_idx = len(self.bboxes)  # Index for new merged bbox
-        pq = PriorityQueue()  # Use priority queue for quick candidate selection
-        for i in range(len(self.data)):
-            for j in range(i-self.n_neighbors, i+self.n_neighbors+1):
-                if 0 <= j < len(self.data) and j != i:
-                    dist = self.dist_metric(self.data[i][1], self.data[j][1])
-                    pq.put((dist, self.data[i], self.data[j]))
-
-        hierarchy.append(self.data.copy())  # original bboxes
-        for i in range(0, self.n_bboxes-1):
-            while True:
-                # Instead of popping the first element, just access it and check if merged, the merged one has overlap
-                # with other rects
-                p = pq.get()
-                s_idx, t_idx = p[1][2], p[2][2]  # get the index of the bbox pair
-                if s_idx not in is_merged and t_idx not in is_merged:
-                    bbox_s = self.idx2bbox_tuple[s_idx]
-                    s_index = hierarchy[i].index(bbox_s)
-                    bbox_t = self.idx2bbox_tuple[t_idx]
-                    t_index = hierarchy[i].index(bbox_t)
-
-                    is_valid_merge = True
-                    # check if merge these two, it will have overlaps
-                    bbox_merged = self._merge2(p[1][1], p[2][1])
-                    # check if the merged one has overlap with the 1st bbox
-                    for j in range(s_index-self.check_overlap_neighbors, s_index+self.check_overlap_neighbors+1):
-                        if 0<=j<len(hierarchy[i]) and j != s_index and j != t_index:
-                            if self._overlap(bbox_merged, hierarchy[i][j][1]):
-                                is_valid_merge = False
-                                break
-                    # check if the merged one has overlap with the 2nd bbox
-                    for j in range(t_index-self.check_overlap_neighbors, t_index+self.check_overlap_neighbors+1):
-                        if 0<=j<len(hierarchy[i]) and j != t_index and j != s_index:
-                            if self._overlap(bbox_merged, hierarchy[i][j][1]):
-                                is_valid_merge = False
-                                break
-                    # if everything is OK then get out of the while loop
-                    if is_valid_merge:
-                        break
+        merge_children = []
+        merge_costs = []
+        # idx -> idx of the bboxes it can not be merged with, the merged bbox would overlap another bbox.
+        # Only the bboxes of the current level are kept.
+        self.rejected = {}
+        self.n_rejected = 0
+        # idx -> No. of nodes when the bbox was paired with the whole level, the bboxes with a smaller idx were
+        # paired with it then
+        self.exhausted = {}
+        self.n_refills = 0
+        pq = make_candidate_queue(self.indexed_queue)  # Use priority queue for quick candidate selection
+        self._init_candidates(pq)
+
+        cur_data = self.data  # current level, updated in place
+        for i in range(n_merges_until(self.n_bboxes, stop_at_count)):
+            pair = self._pop_non_overlap(pq)
+            if pair is None:
+                break  # every merge left would overlap another bbox
+            dist, s_idx, t_idx = pair
+            if max_cost is not None and dist > max_cost:
+                break
             # Merge the selected two bboxes to get a new one
-            bbox_merged = self._merge2(p[1][1], p[2][1])  # merge two bbox
-            new_center_x, new_center_y = int((bbox_merged[0] + bbox_merged[2]) / 2), int(
-                (bbox_merged[1] + bbox_merged[3]) / 2)
-            z_merged = pm.interleave2(new_center_x, new_center_y)
-            d_merged = (z_merged, bbox_merged, cur_idx)
-            self.idx2bbox_tuple[cur_idx] = d_merged
-            cur_idx += 1  # index for next bbox
+            m = store.merge(s_idx, t_idx)
+            key_merged = store.key(m)
+            merge_children.append((s_idx, t_idx))
+            merge_costs.append(dist)
 
-            # Mark the selected two boxes as merged
-            is_merged.add(s_idx)
-            is_merged.add(t_idx)
+            # Drop the pairs of the merged bboxes, store.merge marked them as not alive
+            pq.remove_box(s_idx)
+            pq.remove_box(t_idx)
+            self._forget(s_idx)
+            self._forget(t_idx)
+            self.grid.insert(m, store.bbox(m))
 
             # Remove the merged bboxes from the current sorted list
-            cur_data = hierarchy[i].copy()  # Copy from previous level first. This is not necessary so does not count
-            cur_data.remove(self.idx2bbox_tuple[s_idx])
-            cur_data.remove(self.idx2bbox_tuple[t_idx])
+            cur_data.remove(store.key(s_idx))
+            cur_data.remove(store.key(t_idx))
             # Add the merged bbox to the sorted list
-            cur_data.add(d_merged)  # BST insert, O(logN)
+            cur_data.add(key_merged)  # BST insert, O(logN)
             # Search neighbors and calculate the distance
-            m_idx = cur_data.index(d_merged)  # Get the index of the added element in the sorted list. Log(N)
-            for j in range(m_idx-self.n_neighbors, m_idx+self.n_neighbors+1):
-                if 0 <= j < len(cur_data) and j != m_idx:
-                    dist = self.dist_metric(cur_data[m_idx][1], cur_data[j][1])
-                    pq.put((dist, cur_data[m_idx], cur_data[j]))
-
-            hierarchy.append(cur_data)
-        # Post-processing. Convert OrderedList to List
-        hl = []
-        for h in hierarchy:
-            l = []
-            for t in h:
-                l.append(t[1])
-            hl.append(l)
-        return hl
-
-    def _overlap(self, bbox_s, bbox_t):
-        # Check if two bboxs overlap
-        xmin = max(bbox_s[0], bbox_t[0])
-        ymin = max(bbox_s[1], bbox_t[1])
-        xmax = min(bbox_s[2], bbox_t[2])
-        ymax = min(bbox_s[3], bbox_t[3])
-
-        if xmax > xmin and ymax > ymin:
-            return True
-        else:
-            return False
+            self._merged_candidates(pq, cur_data, key_merged, s_idx, t_idx)
+        self.queue_stats = pq.stats()
+        self.queue_stats.update(rejected=self.n_rejected, refills=self.n_refills)
+        tree = self._merge_tree(merge_children, merge_costs)
+        if output == "levels":
+            return tree.levels()
+        return wrap_tree(tree, output, checkpoint_interval)
+
+    def _pop_non_overlap(self, pq):
+        """
+        Pop the closest pair whose merged bbox does not overlap any other bbox, refill the queue from the grid
+        when it runs out. Return None if no such pair is left.
+        """
+        refills = [lambda: self._refill_knn(pq, 2 * self.n_neighbors), lambda: self._refill_whole_level(pq)]
+        while True:
+            while len(pq) > 0:
+                try:
+                    dist, s_idx, t_idx = pq.pop_valid(self.store.alive)
+                except IndexError:
+                    break  # only stale pairs were left
+                if t_idx in self.rejected.get(s_idx, ()):
+                    continue
+                if self._overlaps_others(s_idx, t_idx):
+                    self._reject(s_idx, t_idx)
+                    continue
+                return dist, s_idx, t_idx
+            if not refills:
+                return None  # every pair of the level has been checked
+            refills.pop(0)()
+
+    def _overlaps_others(self, s_idx, t_idx):
+        """
+        True if the merged bbox of s_idx and t_idx overlaps another bbox of the current level
+        """
+        bbox_merged = self._merge2(self.grid.idx2bbox[s_idx], self.grid.idx2bbox[t_idx])
+        return next(self.grid.overlapping(bbox_merged, exclude=(s_idx, t_idx)), None) is not None
+
+    def _reject(self, s_idx, t_idx):
+        self.rejected.setdefault(s_idx, set()).add(t_idx)
+        self.rejected.setdefault(t_idx, set()).add(s_idx)
+        self.n_rejected += 1
+
+    def _refill_knn(self, pq, k):
+        """
+        Push the pairs of every bbox of the current level which is not exhausted and its k nearest bboxes in the
+        grid, except the rejected ones
+        """
+        self.n_refills += 1
+        for idx, bbox in list(self.grid.idx2bbox.items()):
+            if idx in self.exhausted:
+                continue
+            rejected = self.rejected.get(idx, ())
+            for dist, j in self.grid.knn(bbox, k, exclude=idx):
+                if j not in rejected:
+                    pq.push(dist, idx, j)
+
+    def _refill_whole_level(self, pq):
+        """
+        Push the pairs of every bbox of the current level which is not exhausted with every other bbox whose merged
+        bbox does not overlap another bbox, then mark the bbox as exhausted.
+        The pairs already pushed by an exhausted bbox are skipped. The merged bboxes are first checked against the
+        NON_OVERLAP_BLOCKERS nearest bboxes at once, only the ones which overlap none of them are checked in the grid.
+        """
+        self.n_refills += 1
+        ids = np.fromiter(self.grid.idx2bbox, dtype=np.int64, count=len(self.grid))
+        coords = self.store.coords[ids]
+        exhausted_at = np.array([self.exhausted.get(j, -1) for j in ids.tolist()], dtype=np.int64)
+        n_nodes = len(self.store)
+        n_blockers = min(NON_OVERLAP_BLOCKERS, len(ids) - 1)
+        for pos, idx in enumerate(ids.tolist()):
+            if idx in self.exhausted:
+                continue
+            bbox = coords[pos]
+            dists = uncovered_area_metric_batch(bbox, coords)
+            blockers = np.argpartition(dists, n_blockers)[:n_blockers + 1]
+            blockers = blockers[blockers != pos]
+            x_tl, y_tl = np.minimum(bbox[0], coords[:, :1]), np.minimum(bbox[1], coords[:, 1:2])
+            x_br, y_br = np.maximum(bbox[2], coords[:, 2:3]), np.maximum(bbox[3], coords[:, 3:4])
+            bboxes_u = coords[blockers]
+            # (No. of bboxes, No. of blockers), same test as bboxes_overlap, a bbox does not block its own pair
+            blocked = ((np.minimum(x_br, bboxes_u[:, 2]) > np.maximum(x_tl, bboxes_u[:, 0])) &
+                       (np.minimum(y_br, bboxes_u[:, 3]) > np.maximum(y_tl, bboxes_u[:, 1])) &
+                       (ids[:, None] != ids[blockers]))
+            # skip the pairs with the bboxes exhausted after idx was created, they pushed the pair
+            candidates = ~blocked.any(axis=1) & (ids != idx) & (exhausted_at <= idx)
+            rejected = self.rejected.get(idx, ())
+            for pos_t in np.flatnonzero(candidates).tolist():
+                j = ids[pos_t].item()
+                if j in rejected:
+                    continue
+                if self._overlaps_others(idx, j):
+                    self._reject(idx, j)
+                else:
+                    pq.push(dists[pos_t].item(), idx, j)
+            exhausted_at[pos] = n_nodes
+            self.exhausted[idx] = n_nodes
+
+    def _forget(self, idx):
+        """
+        Remove the merged bbox idx from the grid and from the rejected pairs and exhausted bboxes
+        """
+        self.grid.remove(idx)
+        for j in self.rejected.pop(idx, ()):
+            self.rejected[j].discard(idx)
+        self.exhausted.pop(idx, None)
 
 
 def get_test_case():
@@ -436,6 +945,9 @@ def bbh_naive_test():
     img_tgt = tgt_vis.render()
     cv2.imwrite("ori.png", img_ori)
     cv2.imwrite("tgt.png", img_tgt)
+    # The loaders give ndarray bboxes, the merge tree should be the same as with a list
+    tree = BBHNaive(bboxes=np.array(bboxes_ori)).merge(output="tree")
+    assert [tree.level(k) for k in range(len(tree))] == bboxes_hierarchy
 
 
 def bbh_fast_test():
@@ -459,6 +971,234 @@ def bbh_fast_test():
     cv2.imwrite("tgt.png", img_tgt)
 
 
+def bbh_naive_vectorized_test():
+    """
+    Test the vectorized naive bbh algorithm, the hierarchy should be identical to the naive one
+    """
+    bboxes_ori = get_test_case()
+    assert BBHNaiveVectorized(bboxes=bboxes_ori).merge() == BBHNaive(bboxes=bboxes_ori).merge()
+
+
+def bbh_exact_nn_test():
+    """
+    Test the nearest-neighbor table bbh algorithm, the hierarchy should be identical to the naive one
+    """
+    bboxes_ori = get_test_case()
+    assert BBHExactNN(bboxes=bboxes_ori).merge() == BBHNaive(bboxes=bboxes_ori).merge()
+
+
+def bbh_morton_batch_test():
+    """
+    Test the vectorized Morton encoding, the codes should be the same as pymorton
+    """
+    bboxes_ori = get_test_case()
+    z_orders = morton_encode_bboxes(bboxes_ori)
+    assert z_orders == [pm.interleave2(int((x_tl+x_br)/2), int((y_tl+y_br)/2)) for x_tl, y_tl, x_br, y_br in bboxes_ori]
+    # Coordinates of 2^16 and more, the leaves use the batch encoder and the merged bboxes use pymorton
+    xs = [0, 1, 65535, 65536, 65537, 70000, 123456, 2**20 + 5, 2**31 - 1]
+    ys = [65536, 2**17, 3, 654321, 0, 65535, 2**24 + 7, 17, 5]
+    assert interleave2_batch(xs, ys).tolist() == [pm.interleave2(x, y) for x, y in zip(xs, ys)]
+
+
+def bbh_curve_test():
+    """
+    Test the space-filling curve options of the fast bbh algorithm
+    """
+    # The vectorized encoder of every curve gives the same codes as its scalar encoder
+    rng = np.random.default_rng(0)
+    xs, ys = rng.integers(0, 2**17, 200), rng.integers(0, 2**17, 200)
+    for curve, (encode, encode_batch) in CURVES.items():
+        assert encode_batch(xs, ys).tolist() == [encode(x, y) for x, y in zip(xs.tolist(), ys.tolist())], curve
+    # Hilbert order of a 4 x 4 grid, row by row
+    assert [hilbert_encode(x, y, order=2) for y in range(4) for x in range(4)] == [0, 1, 14, 15, 3, 2, 13, 12,
+                                                                                   4, 7, 8, 11, 5, 6, 9, 10]
+    # Consecutive cells along the Hilbert curve are neighbors, the shifted Morton curve is Morton on shifted points
+    d2xy = {hilbert_encode(x, y): (x, y) for x in range(16) for y in range(16)}
+    cells = [d2xy[d] for d in sorted(d2xy)]
+    assert all(abs(x0 - x1) + abs(y0 - y1) == 1 for (x0, y0), (x1, y1) in zip(cells, cells[1:]))
+    assert shifted_interleave2_batch(xs, ys).tolist() == interleave2_batch(xs + MORTON_SHIFT, ys + MORTON_SHIFT).tolist()
+
+    bboxes_ori = get_test_case()
+    bboxes_hierarchy_bf = BBHNaive(bboxes=bboxes_ori).merge()
+    for curve, extra_curves in [("morton", []), ("hilbert", []), ("morton", ["morton_shifted"])]:
+        alg = BBHFast(bboxes=bboxes_ori, n_neighbors=2, curve=curve, extra_curves=extra_curves)
+        bboxes_hierarchy = alg.merge()
+        assert len(bboxes_hierarchy) == len(bboxes_hierarchy_bf)
+        n_same = sum(sorted(h) == sorted(h_bf) for h, h_bf in zip(bboxes_hierarchy, bboxes_hierarchy_bf))
+        print(f"{curve} {extra_curves}: {n_same} levels same as brute force")
+    # The extra curves only add candidates, on these random cases they never lower the No. of levels same as
+    # brute force
+    for seed in range(3):
+        rng = np.random.default_rng(seed)
+        x1, y1 = rng.integers(0, 600, 50), rng.integers(0, 600, 50)
+        w, h = rng.integers(1, 40, 50), rng.integers(1, 40, 50)
+        bboxes = np.stack((x1, y1, x1 + w, y1 + h), axis=1).tolist()
+        bboxes_hierarchy_bf = BBHNaive(bboxes=bboxes).merge()
+        n_same_prev = 0
+        for extra_curves in [[], ["morton_shifted"], ["morton_shifted", "hilbert"]]:
+            bboxes_hierarchy = BBHFast(bboxes=bboxes, n_neighbors=2, extra_curves=extra_curves).merge()
+            n_same = sum(sorted(h) == sorted(h_bf) for h, h_bf in zip(bboxes_hierarchy, bboxes_hierarchy_bf))
+            assert n_same >= n_same_prev, (seed, extra_curves)
+            n_same_prev = n_same
+
+
+def bbh_grid_test():
+    """
+    Test the fast bbh algorithm with the grid spatial index for candidate generation
+    """
+    bboxes_ori = get_test_case()
+    bboxes_hierarchy_bf = BBHNaive(bboxes=bboxes_ori).merge()
+    bboxes_hierarchy = BBHFastGrid(bboxes=bboxes_ori, n_neighbors=1).merge()
+    assert len(bboxes_hierarchy) == len(bboxes_hierarchy_bf)
+    assert all(len(h) == len(bboxes_ori) - k for k, h in enumerate(bboxes_hierarchy))
+    n_same = sum(sorted(h) == sorted(h_bf) for h, h_bf in zip(bboxes_hierarchy, bboxes_hierarchy_bf))
+    print(f"Grid: {n_same} levels same as brute force")
+    # k nearest and overlapping bboxes of the grid against brute force, with some bboxes removed
+    rng = np.random.default_rng(0)
+    x1, y1 = rng.integers(0, 500, 300), rng.integers(0, 500, 300)
+    w, h = rng.integers(1, 80, 300), rng.integers(1, 80, 300)
+    bboxes = np.stack((x1, y1, x1 + w, y1 + h), axis=1).tolist()
+    grid = GridIndex.from_bboxes(bboxes, dist_metric=uncovered_area_metric)
+    for idx in rng.choice(len(bboxes), 100, replace=False).tolist():
+        grid.remove(idx)
+    for idx in range(0, len(bboxes), 7):
+        bbox = bboxes[idx]
+        knn_bf = sorted((uncovered_area_metric(bbox, bbox_t), j) for j, bbox_t in grid.idx2bbox.items() if j != idx)
+        assert grid.knn(bbox, 8, exclude=idx) == knn_bf[:8]
+        overlapping_bf = {j for j, bbox_t in grid.idx2bbox.items() if j != idx and bboxes_overlap(bbox, bbox_t)}
+        assert set(grid.overlapping(bbox, exclude=(idx,))) == overlapping_bf
+
+
+def bbh_merge_tree_test():
+    """
+    Test the merge tree output of the fast bbh algorithm, every level should be the same as the list output
+    """
+    bboxes_ori = get_test_case()
+    bboxes_hierarchy = BBHFast(bboxes=bboxes_ori).merge()
+    tree = BBHFast(bboxes=bboxes_ori).merge(output="tree")
+    assert len(tree) == len(bboxes_hierarchy)
+    for k in range(len(tree)):
+        assert tree.level(k) == bboxes_hierarchy[k]
+    print(tree.linkage())
+
+
+def bbh_lazy_hierarchy_test():
+    """
+    Test the lazy hierarchy output, indexing and slicing should give the same levels as the list output
+    """
+    bboxes_ori = get_test_case()
+    for alg_cls in [BBHNaive, BBHFast]:
+        bboxes_hierarchy = alg_cls(bboxes=bboxes_ori).merge()
+        lazy_hierarchy = alg_cls(bboxes=bboxes_ori).merge(output="hierarchy", checkpoint_interval=4)
+        assert len(lazy_hierarchy) == len(bboxes_hierarchy)
+        assert list(lazy_hierarchy) == bboxes_hierarchy
+        assert lazy_hierarchy[-5] == bboxes_hierarchy[-5]
+        assert lazy_hierarchy[-10:-2] == bboxes_hierarchy[-10:-2]
+
+
+def bbh_replay_hierarchy_test():
+    """
+    Test the replay hierarchy output, levels accessed in any order should be the same as the list output
+    """
+    bboxes_ori = get_test_case()
+    for alg_cls in [BBHNaive, BBHFast]:
+        bboxes_hierarchy = alg_cls(bboxes=bboxes_ori).merge()
+        replay_hierarchy = alg_cls(bboxes=bboxes_ori).merge(output="replay")
+        assert len(replay_hierarchy) == len(bboxes_hierarchy)
+        assert list(replay_hierarchy) == bboxes_hierarchy
+        assert replay_hierarchy[3] == bboxes_hierarchy[3]
+        assert replay_hierarchy[-10:-2] == bboxes_hierarchy[-10:-2]
+        assert replay_hierarchy[::-1] == bboxes_hierarchy[::-1]
+
+
+def bbh_indexed_queue_test():
+    """
+    Test the indexed candidate queue, the hierarchy should be the same as the lazy queue
+    """
+    bboxes_ori = get_test_case()
+    alg_lazy = BBHFast(bboxes=bboxes_ori)
+    alg_indexed = BBHFast(bboxes=bboxes_ori, indexed_queue=True)
+    assert alg_lazy.merge() == alg_indexed.merge()
+    print(f"Lazy queue: {alg_lazy.queue_stats}")
+    print(f"Indexed queue: {alg_indexed.queue_stats}")
+
+
+def bbh_box_store_test():
+    """
+    Test the box store, the merged bbox and the int sort keys should sort like the old (z_order, bbox, idx) tuples
+    """
+    bboxes_ori = get_test_case()
+    store = BoxStore.from_bboxes(bboxes_ori)
+    old_keys = [(z, bbox, idx) for idx, (z, bbox) in enumerate(zip(morton_encode_bboxes(bboxes_ori), bboxes_ori))]
+    assert [store.key_idx(key) for key in sorted(store.keys())] == [key[2] for key in sorted(old_keys)]
+    m = store.merge(0, 1)
+    assert m == len(bboxes_ori) and store.bbox(m) == [68, 81, 252, 327]
+    assert not store.alive[0] and not store.alive[1] and store.alive[m]
+    assert store.key_idx(store.key(m)) == m
+    # Same z and the same first coordinates, the keys fall back to the other coordinates and then idx
+    store = BoxStore.from_bboxes([[0, 0, 4, 9], [0, 0, 4, 3], [0, 1, 4, 2], [0, 0, 4, 3], [-5.5, 0, 12, 8]])
+    old_keys = [(z, bbox, idx) for idx, (z, bbox) in enumerate(zip(store.z.tolist(), store.coords.tolist()))]
+    assert [store.key_idx(key) for key in sorted(store.keys())] == [key[2] for key in sorted(old_keys[:5])]
+    print(f"{len(store)} bboxes, {store.nbytes} bytes")
+
+
+def bbh_batch_metric_test():
+    """
+    Test the batch metrics, the costs should be the same as the scalar ones
+    """
+    bboxes_ori = get_test_case()
+    labels = [i % 3 for i in range(len(bboxes_ori))]
+    for bbox_s, label_s in zip(bboxes_ori, labels):
+        assert uncovered_area_metric_batch(bbox_s, bboxes_ori).tolist() == \
+               [uncovered_area_metric(bbox_s, bbox_t) for bbox_t in bboxes_ori]
+        assert uncovered_area_metric_with_labels_batch(bbox_s, bboxes_ori, label_s, labels).tolist() == \
+               [uncovered_area_metric_with_labels(bbox_s, bbox_t, label_s, label_t)
+                for bbox_t, label_t in zip(bboxes_ori, labels)]
+    # Enough neighbors to use the batch metric for the merged bboxes too
+    bboxes_hierarchy = BBHFast(bboxes=bboxes_ori, n_neighbors=BATCH_MIN_CANDIDATES).merge()
+    bboxes_hierarchy_bf = BBHNaive(bboxes=bboxes_ori).merge()
+    assert all(sorted(h) == sorted(h_bf) for h, h_bf in zip(bboxes_hierarchy, bboxes_hierarchy_bf))
+
+
+def bbh_metric_registry_test():
+    """
+    Test the metrics selected by name, the batch metric should give the same costs as the scalar one,
+    and the exact algorithms should give the same hierarchy with any of them
+    """
+    bboxes_ori = get_test_case()
+    for name, (metric, metric_batch) in METRICS.items():
+        for bbox_s in bboxes_ori:
+            assert metric_batch(bbox_s, bboxes_ori).tolist() == [metric(bbox_s, bbox_t) for bbox_t in bboxes_ori]
+        if name == "uncovered_area_with_labels":
+            continue
+        bboxes_hierarchy_bf = BBHNaive(bboxes=bboxes_ori, dist_metric=name).merge()
+        assert BBHNaiveVectorized(bboxes=bboxes_ori, dist_metric=name).merge() == bboxes_hierarchy_bf
+        assert BBHExactNN(bboxes=bboxes_ori, dist_metric=name).merge() == bboxes_hierarchy_bf
+        bboxes_hierarchy = BBHFast(bboxes=bboxes_ori, dist_metric=name).merge()
+        n_same = sum(sorted(h) == sorted(h_bf) for h, h_bf in zip(bboxes_hierarchy, bboxes_hierarchy_bf))
+        print(f"{name}: {n_same} levels of BBHFast same as brute force")
+
+
+def bbh_early_stop_test():
+    """
+    Test the early stop of merge, the levels should be the first levels of the full hierarchy
+    """
+    bboxes_ori = get_test_case()
+    n = len(bboxes_ori)
+    for alg_cls in [BBHNaive, BBHNaiveVectorized, BBHExactNN, BBHFast, BBHFastGrid]:
+        bboxes_hierarchy = alg_cls(bboxes=bboxes_ori).merge()
+        costs = alg_cls(bboxes=bboxes_ori).merge(output="tree").costs
+        for k in [1, 3, n]:
+            assert alg_cls(bboxes=bboxes_ori).merge(stop_at_count=k) == bboxes_hierarchy[:n-k+1]
+        max_cost = float(np.median(costs))
+        n_merges = int(np.argmax(costs > max_cost))
+        assert alg_cls(bboxes=bboxes_ori).merge(max_cost=max_cost) == bboxes_hierarchy[:n_merges+1]
+        tree = alg_cls(bboxes=bboxes_ori).merge(output="tree", stop_at_count=5, max_cost=max_cost)
+        assert len(tree) == min(n-5, n_merges) + 1
+    bboxes_hierarchy, labels_hierarchy = BBHFastMultiLabel(bboxes=bboxes_ori, labels=[0]*n).merge(stop_at_count=5)
+    assert len(bboxes_hierarchy) == len(labels_hierarchy) == n-4 and len(bboxes_hierarchy[-1]) == 5
+
+
 def bbh_non_overlap_test():
     """
     Test the non-overlap bbh algorithm
@@ -469,6 +1209,31 @@ def bbh_non_overlap_test():
     bboxes_ori = get_test_case()
     alg = BBHFastNonOverlap(bboxes=bboxes_ori)
     bboxes_hierarchy = alg.merge()
+    # A merged bbox never overlaps another bbox of its level
+    for h in bboxes_hierarchy:
+        for bbox_s in h:
+            if bbox_s not in bboxes_ori:
+                assert not any(bboxes_overlap(bbox_s, bbox_t) for bbox_t in h if bbox_t is not bbox_s)
+    print(f"{len(bboxes_hierarchy)} levels, {alg.queue_stats}")
+    # No pair of this pinwheel can be merged without overlapping the others, so it stops at level 0
+    pinwheel = [[0, 0, 20, 10], [20, 0, 30, 20], [10, 20, 30, 30], [0, 10, 10, 30], [10, 10, 20, 20]]
+    assert len(BBHFastNonOverlap(bboxes=pinwheel).merge()) == 1
+    # When it stops early, every pair of the last level overlaps another bbox
+    rng = np.random.default_rng(0)
+    xy = rng.integers(0, 1000, size=(300, 2))
+    random_bboxes = np.hstack([xy, xy + rng.integers(5, 60, size=(300, 2))]).tolist()
+    alg = BBHFastNonOverlap(bboxes=random_bboxes)
+    last = alg.merge()[-1]
+    for s in range(len(last)):
+        for t in range(s+1, len(last)):
+            bbox_merged = alg._merge2(last[s], last[t])
+            assert any(bboxes_overlap(bbox_merged, last[u]) for u in range(len(last)) if u != s and u != t)
+    print(f"random: {len(last)} bboxes left, {alg.queue_stats}")
+    try:
+        BBHFastNonOverlap(bboxes=bboxes_ori, dist_metric="iou")
+        assert False, "only uncovered_area_metric is supported"
+    except ValueError:
+        pass
     ori_vis = BBoxesVis(h=img_h,
                         w=img_w,
                         bboxes=bboxes_ori)
@@ -480,9 +1245,43 @@ def bbh_non_overlap_test():
     cv2.imwrite("ori.png", img_ori)
     cv2.imwrite("tgt_non_overlap.png", img_tgt)
 
+
+def bbh_partition_labels_test():
+    """
+    Test the label-partitioned multi-label algorithm against the single queue on the test case with two labels
+    """
+    print("bbh_partition_labels_test")
+    bboxes_ori = get_test_case()
+    labels = [i % 2 for i in range(len(bboxes_ori))]
+    hl, hl_labels = BBHFastMultiLabel(bboxes=bboxes_ori, labels=labels).merge()
+    alg = BBHFastMultiLabel(bboxes=bboxes_ori, labels=labels, partition_labels=True, workers=1)
+    hl_part, hl_part_labels = alg.merge()
+    assert len(hl_part) == len(hl) and hl_part[0] == hl[0] and hl_part[-1] == hl[-1]
+    # Every merge but the last one is inside a label
+    assert all(set(h_labels) == {0, 1} for h_labels in hl_part_labels[:-1])
+    print(f"{len(hl_part)} levels, {alg.queue_stats}")
+    hl_part, _ = BBHFastMultiLabel(bboxes=bboxes_ori, labels=labels, partition_labels=True,
+                                   workers=1).merge(stop_at_count=5)
+    assert len(hl_part) == len(bboxes_ori) - 4 and len(hl_part[-1]) == 5
+
+
 def main():
     # bbh_naive_test()
+    # bbh_naive_vectorized_test()
+    # bbh_exact_nn_test()
     # bbh_fast_test()
+    # bbh_morton_batch_test()
+    # bbh_curve_test()
+    # bbh_grid_test()
+    # bbh_merge_tree_test()
+    # bbh_lazy_hierarchy_test()
+    # bbh_replay_hierarchy_test()
+    # bbh_indexed_queue_test()
+    # bbh_box_store_test()
+    # bbh_batch_metric_test()
+    # bbh_metric_registry_test()
+    # bbh_early_stop_test()
+    # bbh_partition_labels_test()
     bbh_non_overlap_test()
 
 
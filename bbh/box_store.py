@@ -0,0 +1,131 @@
+import numpy as np
+from bbh.morton import bbox_centers, get_curve
+
+
+class BoxStore:
+    """
+    Struct-of-arrays storage of the bboxes of a hierarchy, preallocated for the 2N-1 nodes of the merge tree.
+    Node idx 0..N-1 are the input bboxes, N+i is the bbox made by the i-th merge, same as the merge tree node ids.
+    coords: (2N-1, 4) int64 array of x_tl, y_tl, x_br, y_br (float64 if the input has float coordinates)
+    z: int64 array, code of the bbox center along the curve, see bbh.morton.CURVES
+    alive: bool array, False once the bbox is merged
+    label: int32 array, only used by the multi-label algorithm
+    The sorted levels of the fast algorithms hold one int sort key per bbox instead of a tuple, about 40 bytes.
+    The key packs (z, x_tl, y_tl, x_br, y_br, idx) into the bits of one int, so the ints sort like the old
+    (z, bbox, idx) tuples: the coordinates are replaced by their ranks among the coordinates of the input bboxes,
+    which also rank the merged ones as a merged bbox only takes coordinates of its children.
+    The lowest id_bits bits are idx, see key_idx, the bbox is read from coords. The curve codes must not be negative.
+    """
+    def __init__(self, capacity, dtype=np.int64, curve="morton"):
+        self.coords = np.zeros((capacity, 4), dtype=dtype)
+        self.z = np.zeros(capacity, dtype=np.int64)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.label = np.zeros(capacity, dtype=np.int32)
+        self.size = 0  # No. of slots used
+        self.curve_encode, self.curve_encode_batch = get_curve(curve)
+        self.values = np.zeros(0, dtype=dtype)  # sorted coordinates of the input bboxes, see key
+        self.coord_bits = 1
+        self.id_bits = max(capacity - 1, 1).bit_length()
+        self.id_mask = (1 << self.id_bits) - 1
+
+    @classmethod
+    def from_bboxes(cls, bboxes, labels=None, curve="morton"):
+        """
+        Store N bboxes with room for the N-1 merged ones, the curve codes are computed at once
+        """
+        coords = np.asarray(bboxes).reshape(-1, 4)
+        n = len(coords)
+        dtype = np.float64 if np.issubdtype(coords.dtype, np.floating) else np.int64
+        store = cls(capacity=max(2*n-1, 0), dtype=dtype, curve=curve)
+        store.coords[:n] = coords
+        store.z[:n] = store.curve_encode_batch(*bbox_centers(coords))
+        store.alive[:n] = True
+        if labels is not None:
+            store.label[:n] = labels
+        store.size = n
+        if n > 0 and store.z[:n].min() < 0:
+            raise ValueError("The curve codes of the bboxes must not be negative")
+        store.values = np.unique(coords)
+        store.coord_bits = max(len(store.values) - 1, 1).bit_length()
+        return store
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        return self.coords.nbytes + self.z.nbytes + self.alive.nbytes + self.label.nbytes
+
+    def bbox(self, idx):
+        return self.coords[idx].tolist()
+
+    def key(self, idx, z=None):
+        """
+        Sort key of bbox idx in a level, the int packing (z, x_tl, y_tl, x_br, y_br, idx)
+        z: array of codes along another curve, self.z by default
+        """
+        z = self.z if z is None else z
+        b = self.coord_bits
+        x_tl, y_tl, x_br, y_br = np.searchsorted(self.values, self.coords[idx]).tolist()
+        return (((((int(z[idx]) << b | x_tl) << b | y_tl) << b | x_br) << b | y_br) << self.id_bits) | idx
+
+    def keys(self, ids=None, z=None):
+        """
+        Sort keys of many bboxes (all the used slots by default), built column by column
+        """
+        if ids is None:
+            ids = np.arange(self.size)
+        ids = np.asarray(ids, dtype=np.int64)
+        z = self.z if z is None else z
+        b = self.coord_bits
+        ranks = np.searchsorted(self.values, self.coords[ids])
+        return [(((((zi << b | x_tl) << b | y_tl) << b | x_br) << b | y_br) << self.id_bits) | idx
+                for zi, x_tl, y_tl, x_br, y_br, idx in zip(z[ids].tolist(), ranks[:, 0].tolist(),
+                                                           ranks[:, 1].tolist(), ranks[:, 2].tolist(),
+                                                           ranks[:, 3].tolist(), ids.tolist())]
+
+    def key_idx(self, key):
+        """
+        idx of the bbox of a sort key
+        """
+        return key & self.id_mask
+
+    def key_ids(self, keys):
+        """
+        idx of the bboxes of many sort keys, e.g. a sorted level, as an int64 array
+        """
+        return np.fromiter((key & self.id_mask for key in keys), dtype=np.int64, count=len(keys))
+
+    def codes(self, curve):
+        """
+        Codes of the bbox centers along another curve, e.g. for the extra curves of BBHFast.
+        Return an array with the same capacity as self.z, the slots not used yet are 0.
+        """
+        z = np.zeros_like(self.z)
+        z[:self.size] = get_curve(curve)[1](*bbox_centers(self.coords[:self.size]))
+        return z
+
+    def add(self, bbox, label=0):
+        """
+        Append a bbox, return its idx
+        """
+        idx = self.size
+        self.coords[idx] = bbox
+        self.z[idx] = self.curve_encode(int((bbox[0] + bbox[2]) / 2), int((bbox[1] + bbox[3]) / 2))
+        self.alive[idx] = True
+        self.label[idx] = label
+        self.size += 1
+        return idx
+
+    def merge(self, s_idx, t_idx):
+        """
+        Append the union of bbox s_idx and t_idx and mark the two as merged, return the idx of the new bbox.
+        The label of the merged bbox is the larger one of the two.
+        """
+        bbox_s = self.coords[s_idx].tolist()
+        bbox_t = self.coords[t_idx].tolist()
+        bbox_merged = [min(bbox_s[0], bbox_t[0]), min(bbox_s[1], bbox_t[1]),
+                       max(bbox_s[2], bbox_t[2]), max(bbox_s[3], bbox_t[3])]
+        self.alive[s_idx] = False
+        self.alive[t_idx] = False
+        return self.add(bbox_merged, max(self.label[s_idx], self.label[t_idx]))
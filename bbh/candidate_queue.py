@@ -0,0 +1,182 @@
+import heapq
+import itertools
+
+
+class CandidateQueue:
+    """
+    Min-heap of candidate bbox pairs used by the fast BBH algorithms.
+    Unlike queue.PriorityQueue there is no lock, and each entry is a compact (dist, seq, s_idx, t_idx) tuple of numbers.
+    seq is a monotonic counter, so pairs with the same distance are popped in insertion order
+    and the bboxes themselves are never compared.
+    """
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.n_pushed = 0
+        self.n_popped = 0
+        self.n_stale_pops = 0  # pairs popped and dropped because one of the bboxes was already merged
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, dist, s_idx, t_idx):
+        heapq.heappush(self.heap, (dist, next(self.counter), s_idx, t_idx))
+        self.n_pushed += 1
+
+    def extend(self, pairs):
+        """
+        Bulk insert an iterable of (dist, s_idx, t_idx), O(n) heapify instead of n pushes
+        """
+        counter = self.counter
+        n = len(self.heap)
+        self.heap.extend((dist, next(counter), s_idx, t_idx) for dist, s_idx, t_idx in pairs)
+        heapq.heapify(self.heap)
+        self.n_pushed += len(self.heap) - n
+
+    def remove_box(self, idx):
+        """
+        Pairs of a merged bbox are left in the heap and dropped lazily by pop_valid
+        """
+        pass
+
+    def stats(self):
+        return {"pushed": self.n_pushed,
+                "popped": self.n_popped,
+                "stale_pops": self.n_stale_pops,
+                "removed": 0,
+                "size": len(self.heap)}
+
+    def pop(self):
+        """
+        Pop the pair with the minimum distance, return (dist, s_idx, t_idx)
+        """
+        dist, _, s_idx, t_idx = heapq.heappop(self.heap)
+        self.n_popped += 1
+        return dist, s_idx, t_idx
+
+    def pop_valid(self, alive):
+        """
+        Pop until a pair whose bboxes are both not merged yet, stale pairs are dropped
+        alive: bool array by bbox idx, False once the bbox is merged, e.g. BoxStore.alive
+        """
+        heap = self.heap
+        while True:
+            dist, _, s_idx, t_idx = heapq.heappop(heap)
+            self.n_popped += 1
+            if alive[s_idx] and alive[t_idx]:
+                return dist, s_idx, t_idx
+            self.n_stale_pops += 1
+
+
+class IndexedCandidateQueue:
+    """
+    Binary min-heap of candidate bbox pairs with handles, so that a pair can be deleted from the middle of the heap.
+    When a bbox is merged, remove_box deletes all its pairs, the heap never holds stale pairs
+    and its size stays bounded by the pairs of the current level instead of growing to O(N*n_neighbors).
+    Entries are [dist, seq, s_idx, t_idx] lists, seq is the handle as well as the tie breaker.
+    """
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.pos = {}  # handle -> position in heap
+        self.box2handles = {}  # bbox idx -> handles of the pairs containing the bbox
+        self.n_pushed = 0
+        self.n_popped = 0
+        self.n_removed = 0  # pairs deleted by remove_box, i.e. stale pops avoided
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, dist, s_idx, t_idx):
+        seq = next(self.counter)
+        entry = [dist, seq, s_idx, t_idx]
+        self.heap.append(entry)
+        self.pos[seq] = len(self.heap) - 1
+        self.box2handles.setdefault(s_idx, set()).add(seq)
+        self.box2handles.setdefault(t_idx, set()).add(seq)
+        self._sift_up(len(self.heap) - 1)
+        self.n_pushed += 1
+        return seq
+
+    def extend(self, pairs):
+        for dist, s_idx, t_idx in pairs:
+            self.push(dist, s_idx, t_idx)
+
+    def pop(self):
+        """
+        Pop the pair with the minimum distance, return (dist, s_idx, t_idx)
+        """
+        dist, _, s_idx, t_idx = self._delete_at(0)
+        self.n_popped += 1
+        return dist, s_idx, t_idx
+
+    def pop_valid(self, alive):
+        """
+        Merged bboxes have been removed already, so the top pair is always valid
+        """
+        return self.pop()
+
+    def remove_box(self, idx):
+        """
+        Delete all the pairs containing bbox idx, O(k*log(n)) for k pairs
+        """
+        for seq in self.box2handles.pop(idx, ()):
+            self._delete_at(self.pos[seq])
+            self.n_removed += 1
+
+    def stats(self):
+        return {"pushed": self.n_pushed,
+                "popped": self.n_popped,
+                "stale_pops": 0,
+                "removed": self.n_removed,
+                "size": len(self.heap)}
+
+    def _delete_at(self, i):
+        heap = self.heap
+        entry = heap[i]
+        seq, s_idx, t_idx = entry[1], entry[2], entry[3]
+        del self.pos[seq]
+        for idx in (s_idx, t_idx):
+            handles = self.box2handles.get(idx)
+            if handles is not None:
+                handles.discard(seq)
+        last = heap.pop()
+        if i < len(heap):
+            heap[i] = last
+            self.pos[last[1]] = i
+            if last < entry:
+                self._sift_up(i)
+            else:
+                self._sift_down(i)
+        return entry
+
+    def _sift_up(self, i):
+        heap, pos = self.heap, self.pos
+        entry = heap[i]
+        while i > 0:
+            parent = (i - 1) >> 1
+            if heap[parent] <= entry:
+                break
+            heap[i] = heap[parent]
+            pos[heap[i][1]] = i
+            i = parent
+        heap[i] = entry
+        pos[entry[1]] = i
+
+    def _sift_down(self, i):
+        heap, pos = self.heap, self.pos
+        n = len(heap)
+        entry = heap[i]
+        while True:
+            child = 2 * i + 1
+            if child >= n:
+                break
+            if child + 1 < n and heap[child + 1] < heap[child]:
+                child += 1
+            if entry <= heap[child]:
+                break
+            heap[i] = heap[child]
+            pos[heap[i][1]] = i
+            i = child
+        heap[i] = entry
+        pos[entry[1]] = i
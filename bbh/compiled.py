@@ -0,0 +1,487 @@
+import math
+import numpy as np
+from bbh.bbh import BBHFast, check_output, wrap_tree, n_merges_until
+from bbh.box_store import BoxStore
+from bbh.metrics import (uncovered_area_metric, enlargement_metric, perimeter_growth_metric, iou_metric,
+                         center_distance_metric)
+from bbh.morton import morton_argsort, _part1by1
+from bbh.jit import njit, HAS_NUMBA
+
+
+# Metrics the kernel can compute: scalar metric -> metric kind in _dist
+KERNEL_METRICS = {uncovered_area_metric: 0,
+                  enlargement_metric: 1,
+                  perimeter_growth_metric: 2,
+                  iou_metric: 3,
+                  center_distance_metric: 4}
+
+# The heap is compacted when it holds more than this No. of entries and twice as many as after the last compaction
+COMPACT_MIN_ENTRIES = 4096
+
+_part1by1_jit = njit(cache=True)(_part1by1)
+
+
+@njit(cache=True)
+def _dist(kind, coords, s, t):
+    """
+    Distance between node s and t, same arithmetic as the metric in bbh.metrics so that the costs are identical
+    """
+    s0, s1, s2, s3 = coords[s, 0], coords[s, 1], coords[s, 2], coords[s, 3]
+    t0, t1, t2, t3 = coords[t, 0], coords[t, 1], coords[t, 2], coords[t, 3]
+    if kind == 4:
+        dx = (s0+s2)/2 - (t0+t2)/2
+        dy = (s1+s3)/2 - (t1+t3)/2
+        return math.sqrt(dx*dx + dy*dy)
+    area_s = (s2-s0)*(s3-s1)
+    area_t = (t2-t0)*(t3-t1)
+    if kind == 3:
+        area_i = max(min(s2, t2) - max(s0, t0), 0)*max(min(s3, t3) - max(s1, t1), 0)
+        area_u = area_s + area_t - area_i
+        return 1.0 - area_i / area_u if area_u > 0 else 1.0
+    x_tl, y_tl = min(s0, t0), min(s1, t1)
+    x_br, y_br = max(s2, t2), max(s3, t3)
+    if kind == 2:
+        return float(2*((x_br-x_tl)+(y_br-y_tl)) - max(2*((s2-s0)+(s3-s1)), 2*((t2-t0)+(t3-t1))))
+    area_st = (x_br-x_tl)*(y_br-y_tl)
+    if kind == 1:
+        return float(area_st - max(area_s, area_t))
+    return float(area_st - area_s - area_t)
+
+
+# Columns of the node array of the treap: one row of 8 int64 per node is one cache line, the treap walks touch
+# one row per step instead of one element of 7 separate arrays
+_LEFT, _RIGHT, _PARENT, _PRIO, _PREV, _NEXT, _Z = 0, 1, 2, 3, 4, 5, 6
+
+
+@njit(cache=True)
+def _key_less(node, coords, a, b):
+    """
+    Sort key of node a < sort key of node b, i.e. (z, x_tl, y_tl, x_br, y_br, idx) like BoxStore.key
+    """
+    if node[a, _Z] != node[b, _Z]:
+        return node[a, _Z] < node[b, _Z]
+    for c in range(4):
+        if coords[a, c] != coords[b, c]:
+            return coords[a, c] < coords[b, c]
+    return a < b
+
+
+@njit(cache=True)
+def _rotate_up(node, root, x):
+    """
+    Rotate node x above its parent in the treap, return the root
+    """
+    p = node[x, _PARENT]
+    g = node[p, _PARENT]
+    if node[p, _LEFT] == x:
+        node[p, _LEFT] = node[x, _RIGHT]
+        if node[x, _RIGHT] != -1:
+            node[node[x, _RIGHT], _PARENT] = p
+        node[x, _RIGHT] = p
+    else:
+        node[p, _RIGHT] = node[x, _LEFT]
+        if node[x, _LEFT] != -1:
+            node[node[x, _LEFT], _PARENT] = p
+        node[x, _LEFT] = p
+    node[p, _PARENT] = x
+    node[x, _PARENT] = g
+    if g == -1:
+        return x
+    if node[g, _LEFT] == p:
+        node[g, _LEFT] = x
+    else:
+        node[g, _RIGHT] = x
+    return root
+
+
+@njit(cache=True)
+def _treap_insert(node, coords, root, x):
+    """
+    Insert node x into the treap of the current level and the linked list of the level order, return the root
+    """
+    node[x, _LEFT] = -1
+    node[x, _RIGHT] = -1
+    if root == -1:
+        node[x, _PARENT] = -1
+        node[x, _PREV] = -1
+        node[x, _NEXT] = -1
+        return x
+    cur = root
+    while True:
+        if _key_less(node, coords, x, cur):
+            if node[cur, _LEFT] == -1:
+                node[cur, _LEFT] = x
+                # x is right before cur in the level
+                node[x, _PREV] = node[cur, _PREV]
+                node[x, _NEXT] = cur
+                break
+            cur = node[cur, _LEFT]
+        else:
+            if node[cur, _RIGHT] == -1:
+                node[cur, _RIGHT] = x
+                # x is right after cur in the level
+                node[x, _PREV] = cur
+                node[x, _NEXT] = node[cur, _NEXT]
+                break
+            cur = node[cur, _RIGHT]
+    node[x, _PARENT] = cur
+    if node[x, _PREV] != -1:
+        node[node[x, _PREV], _NEXT] = x
+    if node[x, _NEXT] != -1:
+        node[node[x, _NEXT], _PREV] = x
+    while node[x, _PARENT] != -1 and node[x, _PRIO] < node[node[x, _PARENT], _PRIO]:
+        root = _rotate_up(node, root, x)
+    return root
+
+
+@njit(cache=True)
+def _treap_delete(node, root, x):
+    """
+    Remove node x from the treap and the linked list, return the root
+    """
+    # Rotate x down until it is a leaf
+    while node[x, _LEFT] != -1 or node[x, _RIGHT] != -1:
+        if node[x, _LEFT] == -1:
+            c = node[x, _RIGHT]
+        elif node[x, _RIGHT] == -1:
+            c = node[x, _LEFT]
+        else:
+            c = node[x, _LEFT] if node[node[x, _LEFT], _PRIO] < node[node[x, _RIGHT], _PRIO] else node[x, _RIGHT]
+        root = _rotate_up(node, root, c)
+    p = node[x, _PARENT]
+    if p == -1:
+        root = -1
+    elif node[p, _LEFT] == x:
+        node[p, _LEFT] = -1
+    else:
+        node[p, _RIGHT] = -1
+    if node[x, _PREV] != -1:
+        node[node[x, _PREV], _NEXT] = node[x, _NEXT]
+    if node[x, _NEXT] != -1:
+        node[node[x, _NEXT], _PREV] = node[x, _PREV]
+    return root
+
+
+@njit(cache=True)
+def _entry_less(h, a, d, q):
+    """
+    Heap entry a < entry (d, q), entries are ordered by (dist, seq)
+    """
+    return h[a, 0] < d or (h[a, 0] == d and h[a, 1] < q)
+
+
+@njit(cache=True)
+def _sift_down(h, size, i):
+    """
+    Move the entry at i down the heap, the entries are moved into the hole instead of swapped
+    """
+    d, q = h[i, 0], h[i, 1]
+    while True:
+        c = 2*i + 1
+        if c >= size:
+            break
+        if c + 1 < size and _entry_less(h, c + 1, h[c, 0], h[c, 1]):
+            c += 1
+        if not _entry_less(h, c, d, q):
+            break
+        h[i, 0], h[i, 1] = h[c, 0], h[c, 1]
+        i = c
+    h[i, 0], h[i, 1] = d, q
+
+
+@njit(cache=True)
+def _sift_up(h, i):
+    d, q = h[i, 0], h[i, 1]
+    while i > 0:
+        p = (i - 1) // 2
+        if _entry_less(h, p, d, q):
+            break
+        h[i, 0], h[i, 1] = h[p, 0], h[p, 1]
+        i = p
+    h[i, 0], h[i, 1] = d, q
+
+
+@njit(cache=True)
+def _grow(a, capacity):
+    b = np.empty((capacity,) + a.shape[1:], dtype=a.dtype)
+    b[:len(a)] = a
+    return b
+
+
+@njit(cache=True)
+def _initial_pairs(coords, order, n_neighbors, metric_kind):
+    """
+    Initial candidates: every bbox and its n_neighbors neighbors on each side, in the order of window_candidates
+    Return the distances of the pairs by seq and the nodes of the pairs with room for the later pairs
+    """
+    n = len(order)
+    pair_capacity = max(2*n_neighbors*n, 1)
+    pair_s = np.empty(pair_capacity, dtype=np.int64)
+    pair_t = np.empty(pair_capacity, dtype=np.int64)
+    dist = np.empty(pair_capacity, dtype=np.float64)
+    coords_sorted = coords[order]  # sequential access below
+    n_pushed = 0
+    for i in range(n):
+        for j in range(max(i - n_neighbors, 0), min(i + n_neighbors + 1, n)):
+            if j != i:
+                dist[n_pushed] = _dist(metric_kind, coords_sorted, i, j)
+                pair_s[n_pushed] = order[i]
+                pair_t[n_pushed] = order[j]
+                n_pushed += 1
+    return dist[:n_pushed], pair_s, pair_t
+
+
+@njit(cache=True)
+def _merge_kernel(coords, z, order, n, n_merges, n_neighbors, metric_kind, max_cost, children, costs,
+                  init_order, init_dist, pair_s, pair_t, compact_min=COMPACT_MIN_ENTRIES):
+    """
+    The merge loop of BBHFast over flat arrays:
+    - the current level is a treap keyed by the sort keys, plus a doubly linked list of the level order,
+      so the position of a merged bbox is found in O(log(N)) and its neighbors by following the links
+    - the candidate pairs are a binary heap of (dist, seq) rows ordered by (dist, seq), seq being the push order,
+      the bboxes of pair seq are pair_s[seq] and pair_t[seq]. Stale pairs are dropped when popped like
+      CandidateQueue. The heap is memory bound for large N, 16 bytes per entry keeps it small.
+    - most of the pairs go stale before they are popped, so when the heap has doubled since the last compaction
+      (and has more than compact_min entries) the stale pairs are filtered out and the heap is rebuilt in O(size).
+      Dropping stale pairs does not change which valid pair is popped next.
+    The pairs are pushed in the same order as BBHFast, so ties are broken the same way and the merges are identical.
+    coords, z: arrays of the BoxStore with room for the merged bboxes, filled in place
+    order: node ids of the input bboxes in sort key order
+    children, costs: (n_merges, 2) and (n_merges,) arrays, filled in place
+    init_order, init_dist: seqs of the initial pairs sorted by (dist, seq) and their sorted distances
+    pair_s, pair_t: nodes of the initial pairs by seq, see _initial_pairs, the later pairs are appended
+    Return the No. of merges done and the queue stats (pushed, popped, stale pops, removed by compaction, size)
+    """
+    capacity = max(2*n - 1, 1)
+    node = np.full((capacity, 8), -1, dtype=np.int64)
+    node[:, _PRIO] = np.random.randint(0, 2**62, capacity)
+    node[:n, _Z] = z[:n]
+    alive = np.zeros(capacity, dtype=np.bool_)
+
+    # Cartesian tree of the sorted input bboxes, O(N)
+    stack = np.empty(max(n, 1), dtype=np.int64)
+    top = 0
+    for i in range(n):
+        x = order[i]
+        alive[x] = True
+        if i > 0:
+            node[x, _PREV] = order[i-1]
+            node[order[i-1], _NEXT] = x
+        last = -1
+        while top > 0 and node[stack[top-1], _PRIO] > node[x, _PRIO]:
+            last = stack[top-1]
+            top -= 1
+        node[x, _LEFT] = last
+        if last != -1:
+            node[last, _PARENT] = x
+        if top > 0:
+            node[stack[top-1], _RIGHT] = x
+            node[x, _PARENT] = stack[top-1]
+        stack[top] = x
+        top += 1
+    root = stack[0] if n > 0 else -1
+
+    # The initial pairs are popped in (dist, seq) order, gather them once so that it is sequential
+    n_init = n_pushed = len(init_order)
+    init_s = pair_s[init_order]
+    init_t = pair_t[init_order]
+    r = 0  # next initial pair to pop
+    h = np.empty((max(n, 1), 2), dtype=np.float64)
+    size = 0
+
+    n_popped = 0
+    n_stale = 0
+    neighbors = np.empty(2*n_neighbors, dtype=np.int64)
+    n_done = 0
+    compact_at = compact_min
+    n_removed = 0
+    for k in range(n_merges):
+        # Pop the closest pair of bboxes which are both not merged yet
+        found = False
+        dist, s, t = 0.0, -1, -1
+        while r < n_init or size > 0:
+            if r < n_init and (size == 0 or not _entry_less(h, 0, init_dist[r], init_order[r])):
+                dist, s, t = init_dist[r], init_s[r], init_t[r]
+                r += 1
+            else:
+                dist, seq = h[0, 0], int(h[0, 1])
+                size -= 1
+                h[0, 0], h[0, 1] = h[size, 0], h[size, 1]
+                _sift_down(h, size, 0)
+                s, t = pair_s[seq], pair_t[seq]
+            n_popped += 1
+            if alive[s] and alive[t]:
+                found = True
+                break
+            n_stale += 1
+        if not found or dist > max_cost:
+            break
+
+        # Merge the two bboxes into node m
+        m = n + k
+        coords[m, 0] = min(coords[s, 0], coords[t, 0])
+        coords[m, 1] = min(coords[s, 1], coords[t, 1])
+        coords[m, 2] = max(coords[s, 2], coords[t, 2])
+        coords[m, 3] = max(coords[s, 3], coords[t, 3])
+        center_x = int((coords[m, 0] + coords[m, 2]) / 2)
+        center_y = int((coords[m, 1] + coords[m, 3]) / 2)
+        z[m] = _part1by1_jit(center_x) | (_part1by1_jit(center_y) << 1)
+        node[m, _Z] = z[m]
+        alive[s] = False
+        alive[t] = False
+        alive[m] = True
+        children[k, 0] = s
+        children[k, 1] = t
+        costs[k] = dist
+        n_done += 1
+
+        root = _treap_delete(node, root, s)
+        root = _treap_delete(node, root, t)
+        root = _treap_insert(node, coords, root, m)
+
+        # Neighbors of m in the level order, from left to right
+        n_left = 0
+        v = node[m, _PREV]
+        while v != -1 and n_left < n_neighbors:
+            n_left += 1
+            v = node[v, _PREV]
+        v = node[m, _PREV]
+        for i in range(n_left - 1, -1, -1):
+            neighbors[i] = v
+            v = node[v, _PREV]
+        n_found = n_left
+        v = node[m, _NEXT]
+        while v != -1 and n_found < n_left + n_neighbors:
+            neighbors[n_found] = v
+            n_found += 1
+            v = node[v, _NEXT]
+
+        if size + n_found > len(h):
+            h = _grow(h, max(2*len(h), size + n_found))
+        if n_pushed + n_found > len(pair_s):
+            pair_s = _grow(pair_s, max(2*len(pair_s), n_pushed + n_found))
+            pair_t = _grow(pair_t, max(2*len(pair_t), n_pushed + n_found))
+        for i in range(n_found):
+            h[size, 0] = _dist(metric_kind, coords, m, neighbors[i])
+            h[size, 1] = n_pushed
+            pair_s[n_pushed] = m
+            pair_t[n_pushed] = neighbors[i]
+            _sift_up(h, size)
+            size += 1
+            n_pushed += 1
+        if size > compact_at:
+            j = 0
+            for i in range(size):
+                seq = int(h[i, 1])
+                if alive[pair_s[seq]] and alive[pair_t[seq]]:
+                    h[j, 0], h[j, 1] = h[i, 0], h[i, 1]
+                    j += 1
+            n_removed += size - j
+            size = j
+            for i in range(size // 2 - 1, -1, -1):
+                _sift_down(h, size, i)
+            compact_at = max(2*size, compact_min)
+    return n_done, n_pushed, n_popped, n_stale, n_removed, n_init - r + size
+
+
+class BBHCompiled(BBHFast):
+    """
+    BBHFast with the whole merge loop in one kernel over flat arrays, compiled with numba if it is installed.
+    The hierarchy is identical to BBHFast (Morton curve, lazy candidate queue), see _merge_kernel.
+    The kernel supports the metrics in KERNEL_METRICS, other metrics or options run the Python loop of BBHFast.
+    use_kernel: None to use the kernel when numba is installed and the metric is supported,
+                True to always use it (plain Python without numba, only useful to test it), False for BBHFast.
+    The first call compiles the kernel, it is cached on disk by numba afterwards.
+    1M random bboxes take about 9 s on one core, not the few seconds aimed at, measured breakdown:
+    - BoxStore.from_bboxes 0.7 s (0.4 s of it converting the list), morton_argsort 0.2 s
+    - _initial_pairs 0.3 s, sorting its 8M pairs 1.2 s
+    - _merge_kernel 5-6 s: 0.6 s to set up, the rest is the merge loop, mostly the treap updates
+      (random access to a 2M node tree) and the 16M pushes
+    - the merge tree 0.04 s
+    """
+    def __init__(self,
+                 bboxes,
+                 dist_metric=uncovered_area_metric,
+                 n_neighbors=4,
+                 use_kernel=None):
+        super().__init__(bboxes=bboxes, dist_metric=dist_metric, n_neighbors=n_neighbors)
+        self.metric_kind = KERNEL_METRICS.get(self.dist_metric)
+        if use_kernel is None:
+            use_kernel = HAS_NUMBA and self.metric_kind is not None
+        elif use_kernel and self.metric_kind is None:
+            raise ValueError(f"The kernel does not support the metric: {dist_metric}")
+        self.use_kernel = use_kernel
+
+    def merge(self, output="levels", checkpoint_interval=None, stop_at_count=None, max_cost=None):
+        """
+        Same as BBHFast.merge
+        """
+        if not self.use_kernel:
+            return super().merge(output=output, checkpoint_interval=checkpoint_interval,
+                                 stop_at_count=stop_at_count, max_cost=max_cost)
+        check_output(output)
+        n = self.n_bboxes
+        self.store = store = BoxStore.from_bboxes(self.bboxes, curve=self.curve)
+        order = morton_argsort(store.z[:n], store.coords[:n])
+        n_merges = n_merges_until(n, stop_at_count)
+        children = np.zeros((n_merges, 2), dtype=np.int64)
+        costs = np.zeros(n_merges, dtype=np.float64)
+        init_dist, pair_s, pair_t = _initial_pairs(store.coords, order, self.n_neighbors, self.metric_kind)
+        # Stable, so ties stay in seq order. NumPy sorts this faster than numba does inside the kernel
+        init_order = np.argsort(init_dist, kind="stable")
+        n_done, n_pushed, n_popped, n_stale, n_removed, size = _merge_kernel(
+            store.coords, store.z, order, n, n_merges, self.n_neighbors, self.metric_kind,
+            np.inf if max_cost is None else float(max_cost), children, costs,
+            init_order, init_dist[init_order], pair_s, pair_t)
+        store.alive[children[:n_done].ravel()] = False
+        store.alive[n:n+n_done] = True
+        store.size = n + n_done
+        self.queue_stats = {"pushed": n_pushed, "popped": n_popped, "stale_pops": n_stale, "removed": n_removed,
+                            "size": size}
+        tree = self._merge_tree(children[:n_done], costs[:n_done])
+        if output == "levels":
+            return tree.levels()
+        return wrap_tree(tree, output, checkpoint_interval)
+
+
+def bbh_compiled_test():
+    """
+    Test the compiled bbh algorithm, the hierarchy should be identical to BBHFast for every supported metric,
+    with ties, float coordinates and early stop
+    """
+    from bbh.bbh import get_test_case
+    rng = np.random.default_rng(0)
+    xy = rng.integers(0, 300, size=(300, 2))
+    bboxes_random = np.hstack((xy, xy + rng.integers(1, 20, size=(300, 2)))).tolist()
+    bboxes_grid = [[x, y, x + 10, y + 10] for x in range(0, 200, 20) for y in range(0, 200, 20)]  # many ties
+    cases = [get_test_case(), bboxes_random, bboxes_grid, (np.asarray(bboxes_random) / 3).tolist(), [[0, 0, 1, 1]], []]
+    for bboxes in cases:
+        for metric in KERNEL_METRICS:
+            alg_fast = BBHFast(bboxes=bboxes, dist_metric=metric)
+            alg_compiled = BBHCompiled(bboxes=bboxes, dist_metric=metric, use_kernel=True)
+            assert alg_compiled.merge() == alg_fast.merge()
+            assert alg_compiled.queue_stats == alg_fast.queue_stats
+            tree = BBHCompiled(bboxes=bboxes, dist_metric=metric, use_kernel=True).merge(output="tree")
+            tree_fast = BBHFast(bboxes=bboxes, dist_metric=metric).merge(output="tree")
+            assert np.array_equal(tree.children, tree_fast.children) and np.array_equal(tree.costs, tree_fast.costs)
+        if len(bboxes) > 10:
+            max_cost = float(np.median(tree_fast.costs))
+            assert BBHCompiled(bboxes=bboxes, use_kernel=True).merge(stop_at_count=10, max_cost=max_cost) == \
+                   BBHFast(bboxes=bboxes).merge(stop_at_count=10, max_cost=max_cost)
+    # Enough pairs to compact the heap, the stale pairs it drops are not popped so only the pushes match BBHFast
+    xy = rng.integers(0, 2000, size=(3000, 2))
+    bboxes_large = np.hstack((xy, xy + rng.integers(1, 40, size=(3000, 2)))).tolist()
+    alg_fast = BBHFast(bboxes=bboxes_large)
+    alg_compiled = BBHCompiled(bboxes=bboxes_large, use_kernel=True)
+    assert alg_compiled.merge() == alg_fast.merge()
+    assert alg_compiled.queue_stats["removed"] > 0
+    assert alg_compiled.queue_stats["pushed"] == alg_fast.queue_stats["pushed"]
+    print(f"numba: {HAS_NUMBA}, passed")
+
+
+def main():
+    bbh_compiled_test()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+import heapq
+import math
+from sortedcontainers import SortedList
+from bbh.bbh import BBH, BBHFast, uncovered_area_metric, check_output, wrap_tree, n_merges_until
+from bbh.merge_tree import MergeTree
+from bbh.morton import bbox_centers, interleave2_batch
+
+
+class IncrementalBBH(BBH):
+    """
+    Bounding box hierarchy which supports inserting and deleting leaf bboxes after it is built.
+    The hierarchy is built by BBHFast first, then every update only rebuilds one small subtree:
+    - insert: go down from the root to the child with the smallest cost to the new bbox, until the subtree has
+      less than rebuild_size leaves. Rebuild that subtree with BBHFast including the new bbox.
+    - delete: the sibling of the leaf takes the place of their parent. The largest subtree above the sibling with
+      at most rebuild_size leaves is rebuilt with BBHFast.
+    The bboxes and costs of the ancestors of the rebuilt subtree are updated on the way up,
+    so an update is O(depth + rebuild_size*log(rebuild_size)) instead of O(N*log(N)) for a new BBHFast.
+    Every merge has a rank, the levels replay the merges in the order of their ranks. A rebuilt subtree reuses the
+    ranks of the merges it replaces, so the merge order of the rest of the hierarchy does not change.
+    Leaves are identified by handles, 0 ~ N-1 for the input bboxes, insert() returns the handle of a new leaf.
+    rebuild_size: max No. of leaves of a rebuilt subtree, larger gives a hierarchy closer to a full rebuild
+    """
+    def __init__(self,
+                 bboxes,
+                 dist_metric=uncovered_area_metric,
+                 n_neighbors=4,
+                 rebuild_size=32):
+        super().__init__(bboxes=bboxes, dist_metric=dist_metric)
+        self.n_neighbors = n_neighbors
+        self.rebuild_size = max(rebuild_size, 2)
+        self.node_bbox = {}  # node -> bbox, for leaves and merged nodes
+        self.node_children = {}  # merged node -> (node_s, node_t)
+        self.node_parent = {}  # node -> parent node, None for the root
+        self.node_size = {}  # node -> No. of leaves under the node
+        self.node_cost = {}  # merged node -> distance of the merge
+        self.node_rank = {}  # merged node -> position in the merge order, a float so that ranks can be inserted
+        self.ranks = SortedList()  # all the ranks in node_rank, to find the gap a new rank goes into
+        self.next_node = 0
+        self.root = None
+        leaves = [self._new_leaf(bbox) for bbox in bboxes]
+        if leaves:
+            self.root = self._build_subtree(leaves, ranks=range(len(leaves) - 1))
+
+    def __len__(self):
+        """
+        No. of leaves
+        """
+        return 0 if self.root is None else self.node_size[self.root]
+
+    def _new_leaf(self, bbox):
+        node = self.next_node
+        self.next_node += 1
+        self.node_bbox[node] = list(bbox)
+        self.node_parent[node] = None
+        self.node_size[node] = 1
+        return node
+
+    def _new_merged(self, node_s, node_t, cost, rank):
+        node = self.next_node
+        self.next_node += 1
+        self.node_bbox[node] = self._merge2(self.node_bbox[node_s], self.node_bbox[node_t])
+        self.node_children[node] = (node_s, node_t)
+        self.node_parent[node] = None
+        self.node_parent[node_s] = node
+        self.node_parent[node_t] = node
+        self.node_size[node] = self.node_size[node_s] + self.node_size[node_t]
+        self.node_cost[node] = cost
+        assert all(self.node_rank.get(child, -math.inf) < rank for child in (node_s, node_t)), \
+            "a merge should come after the merges of its children"
+        self.node_rank[node] = rank
+        self.ranks.add(rank)
+        return node
+
+    def _build_subtree(self, leaves, ranks):
+        """
+        Merge the leaves with BBHFast, the i-th merge gets the i-th rank. Return the root of the subtree.
+        """
+        if len(leaves) == 1:
+            return leaves[0]
+        tree = BBHFast(bboxes=[self.node_bbox[leaf] for leaf in leaves],
+                       dist_metric=(self.dist_metric, self.dist_metric_batch),
+                       n_neighbors=self.n_neighbors).merge(output="tree")
+        local2node = list(leaves)  # node id in the BBHFast tree -> node
+        for (s, t), cost, rank in zip(tree.children.tolist(), tree.costs.tolist(), ranks):
+            local2node.append(self._new_merged(local2node[s], local2node[t], cost, rank))
+        return local2node[-1]
+
+    def _remove_subtree(self, node):
+        """
+        Delete the merged nodes under node (including itself), return its leaves and the sorted ranks of the merges
+        """
+        leaves = []
+        ranks = []
+        stack = [node]
+        while stack:
+            v = stack.pop()
+            if v not in self.node_children:
+                leaves.append(v)
+                continue
+            stack.extend(self.node_children.pop(v))
+            ranks.append(self.node_rank.pop(v))
+            self.ranks.remove(ranks[-1])
+            del self.node_bbox[v], self.node_parent[v], self.node_size[v], self.node_cost[v]
+        leaves.sort()
+        ranks.sort()
+        return leaves, ranks
+
+    def _replace(self, parent, old, new):
+        """
+        Put node new under parent in the place of node old
+        """
+        self.node_parent[new] = parent
+        if parent is None:
+            self.root = new
+            return
+        assert self.node_rank.get(new, -math.inf) < self.node_rank[parent], "a merge should come after its children"
+        node_s, node_t = self.node_children[parent]
+        self.node_children[parent] = (new, node_t) if node_s == old else (node_s, new)
+
+    def _refresh(self, node):
+        """
+        Recompute the bbox, cost and size of a merged node from its children
+        """
+        node_s, node_t = self.node_children[node]
+        bbox_s, bbox_t = self.node_bbox[node_s], self.node_bbox[node_t]
+        self.node_bbox[node] = self._merge2(bbox_s, bbox_t)
+        self.node_cost[node] = self.dist_metric(bbox_s, bbox_t)
+        self.node_size[node] = self.node_size[node_s] + self.node_size[node_t]
+
+    def _update_ancestors(self, node):
+        """
+        Recompute the bbox, cost and size of the ancestors of node
+        """
+        v = self.node_parent[node]
+        while v is not None:
+            self._refresh(v)
+            v = self.node_parent[v]
+
+    def _renumber(self):
+        """
+        Reset the ranks to 0, 1, 2, ... in the same order, when the gaps between them are too small to insert one
+        """
+        for i, node in enumerate(sorted(self.node_rank, key=lambda v: (self.node_rank[v], v))):
+            self.node_rank[node] = i
+        self.ranks = SortedList(range(len(self.node_rank)))
+
+    def _new_rank(self, upper):
+        """
+        A rank not used yet, larger than every rank below upper and smaller than upper.
+        The merges of a subtree have smaller ranks than its parent, so the new rank is larger than all of them.
+        """
+        i = self.ranks.bisect_left(upper)
+        if i == 0:
+            lower = -1 if upper == math.inf else upper - 1
+        else:
+            lower = self.ranks[i - 1]
+        new = lower + 1 if upper == math.inf else (lower + upper) / 2
+        if not lower < new < upper:
+            # No float left between lower and upper
+            self._renumber()
+            return None
+        return new
+
+    def _rebuild(self, node, leaf=None):
+        """
+        Rebuild the subtree of node with BBHFast, with the new leaf added if given. Return the new root of the subtree.
+        """
+        parent = self.node_parent[node]
+        if leaf is not None:
+            # One more merge, it is the root of the subtree so its rank goes between the ranks under parent and parent
+            rank = None
+            while rank is None:
+                rank = self._new_rank(math.inf if parent is None else self.node_rank[parent])
+        leaves, ranks = self._remove_subtree(node)
+        if leaf is not None:
+            ranks.append(rank)
+            leaves.append(leaf)
+        new = self._build_subtree(leaves, ranks)
+        self._replace(parent, node, new)
+        return new
+
+    def insert(self, bbox):
+        """
+        Add a leaf bbox, return its handle
+        """
+        leaf = self._new_leaf(bbox)
+        if self.root is None:
+            self.root = leaf
+            return leaf
+        node = self.root
+        while self.node_size[node] >= self.rebuild_size and node in self.node_children:
+            node = min(self.node_children[node], key=lambda v: self.dist_metric(self.node_bbox[leaf], self.node_bbox[v]))
+        self._update_ancestors(self._rebuild(node, leaf))
+        return leaf
+
+    def delete(self, leaf):
+        """
+        Remove the leaf bbox with the handle returned by insert(), or its index in the input bboxes
+        """
+        if leaf not in self.node_bbox or leaf in self.node_children:
+            raise KeyError(f"No leaf {leaf}")
+        parent = self.node_parent[leaf]
+        del self.node_bbox[leaf], self.node_parent[leaf], self.node_size[leaf]
+        if parent is None:
+            self.root = None
+            return
+        # The sibling takes the place of the parent
+        node_s, node_t = self.node_children.pop(parent)
+        sibling = node_t if node_s == leaf else node_s
+        grandparent = self.node_parent[parent]
+        del self.node_bbox[parent], self.node_parent[parent], self.node_size[parent]
+        del self.node_cost[parent]
+        self.ranks.remove(self.node_rank.pop(parent))
+        self._replace(grandparent, parent, sibling)
+        self._update_ancestors(sibling)
+        # Repair the largest subtree above the sibling with at most rebuild_size leaves
+        node = sibling
+        while self.node_parent[node] is not None and self.node_size[self.node_parent[node]] <= self.rebuild_size:
+            node = self.node_parent[node]
+        if node in self.node_children:
+            self._rebuild(node)
+
+    def move(self, moves):
+        """
+        Change the bboxes of some leaves in place, e.g. the same objects in the next video frame.
+        moves: iterable of (handle, bbox)
+        The tree is kept as it is, the ancestors of all the moved leaves are recomputed once each,
+        the deepest first so that the children are always done before the parent.
+        """
+        depth = {}  # dirty node -> depth, all the ancestors of a dirty node are dirty too
+        for leaf, bbox in moves:
+            self.node_bbox[leaf] = list(bbox)
+            path = []
+            v = self.node_parent[leaf]
+            while v is not None and v not in depth:
+                path.append(v)
+                v = self.node_parent[v]
+            d = -1 if v is None else depth[v]
+            for v in reversed(path):
+                d += 1
+                depth[v] = d
+        for v in sorted(depth, key=depth.__getitem__, reverse=True):
+            self._refresh(v)
+
+    def bbox(self, leaf):
+        return self.node_bbox[leaf]
+
+    def _merge_order(self, leaves, n_merges=None, max_cost=None):
+        """
+        Order the merges like the greedy algorithm would: among the merges whose children are done,
+        take the one with the smallest cost, ties broken by rank.
+        For a tree built by BBHFast this gives back the merge order of BBHFast. After updates, the merges of the
+        rebuilt subtrees go to the place of their cost instead of the place of the merges they replaced.
+        n_merges, max_cost: stop after n_merges merges, or before the first merge whose cost is larger than max_cost
+        """
+        order = []
+        ready = [(self.node_cost[v], self.node_rank[v], v) for v in
+                 set(self.node_parent[leaf] for leaf in leaves if self.node_parent[leaf] is not None)
+                 if all(c not in self.node_children for c in self.node_children[v])]
+        heapq.heapify(ready)
+        done = set(leaves)
+        while ready and (n_merges is None or len(order) < n_merges):
+            cost, _, v = heapq.heappop(ready)
+            if max_cost is not None and cost > max_cost:
+                break
+            order.append(v)
+            done.add(v)
+            parent = self.node_parent[v]
+            if parent is not None and all(c in done for c in self.node_children[parent]):
+                heapq.heappush(ready, (self.node_cost[parent], self.node_rank[parent], parent))
+        return order
+
+    def merge(self, output="levels", checkpoint_interval=None, stop_at_count=None, max_cost=None):
+        """
+        Current hierarchy, O(N*log(N)). output: "levels", "tree", "hierarchy" or "replay", see BBHFast.merge
+        stop_at_count, max_cost: stop early, see BBHFast.merge
+        Leaf i of the hierarchy is the leaf with handle self.leaf_handles[i], leaves are in the order of the handles.
+        Levels are ordered by the Morton code like BBHFast.
+        """
+        check_output(output)
+        leaves = sorted(v for v in self.node_bbox if v not in self.node_children)
+        merged = self._merge_order(leaves, n_merges_until(len(leaves), stop_at_count), max_cost)
+        n = len(leaves)
+        node2id = {v: i for i, v in enumerate(leaves + merged)}
+        bboxes = [self.node_bbox[v] for v in leaves + merged]
+        center_x, center_y = bbox_centers(bboxes)
+        tree = MergeTree(n_leaves=n,
+                         bboxes=bboxes,
+                         children=[(node2id[s], node2id[t]) for s, t in (self.node_children[v] for v in merged)],
+                         costs=[self.node_cost[v] for v in merged],
+                         keys=interleave2_batch(center_x, center_y))
+        self.leaf_handles = leaves
+        if output == "levels":
+            return tree.levels()
+        return wrap_tree(tree, output, checkpoint_interval)
+
+
+def bbh_incremental_test():
+    """
+    Test the incremental bbh algorithm, after every update the hierarchy should be complete and cover the current bboxes
+    """
+    from bbh.bbh import get_test_case
+    bboxes_ori = get_test_case()
+    alg = IncrementalBBH(bboxes=bboxes_ori[:-3], rebuild_size=4)
+    assert alg.merge() == BBHFast(bboxes=bboxes_ori[:-3]).merge()
+    handles = [alg.insert(bbox) for bbox in bboxes_ori[-3:]]
+    alg.delete(0)
+    alg.delete(handles[1])
+    bboxes_cur = [bbox for i, bbox in enumerate(bboxes_ori) if i != 0 and i != len(bboxes_ori) - 2]
+    bboxes_hierarchy = alg.merge()
+    assert len(alg) == len(bboxes_cur) == len(bboxes_hierarchy)
+    assert sorted(bboxes_hierarchy[0]) == sorted(bboxes_cur)
+    for i, h in enumerate(bboxes_hierarchy):
+        assert len(h) == len(bboxes_cur) - i
+    print(bboxes_hierarchy[-1])
+
+
+def check_levels(bboxes_hierarchy, bboxes):
+    """
+    Check that the hierarchy starts from bboxes and that every level is made from the previous one by one merge
+    """
+    from collections import Counter
+    assert sorted(bboxes_hierarchy[0]) == sorted(bboxes)
+    for h_prev, h in zip(bboxes_hierarchy[:-1], bboxes_hierarchy[1:]):
+        assert len(h) == len(h_prev) - 1
+        removed = list((Counter(map(tuple, h_prev)) - Counter(map(tuple, h))).elements())
+        added = list((Counter(map(tuple, h)) - Counter(map(tuple, h_prev))).elements())
+        if not added:
+            # The merged bbox is the same as one of the two, the other one is inside it
+            assert len(removed) == 1 and any(b[0] <= removed[0][0] and b[1] <= removed[0][1] and
+                                             removed[0][2] <= b[2] and removed[0][3] <= b[3] for b in h)
+            continue
+        assert len(removed) == 2 and len(added) == 1
+        bbox_s, bbox_t = removed
+        assert added[0] == (min(bbox_s[0], bbox_t[0]), min(bbox_s[1], bbox_t[1]),
+                            max(bbox_s[2], bbox_t[2]), max(bbox_s[3], bbox_t[3]))
+
+
+def check_tree(alg):
+    """
+    Check the invariants of the tree of an IncrementalBBH: a merged bbox is the hull of its children
+    and a merge has a larger rank than the merges of its children
+    """
+    for v, (node_s, node_t) in alg.node_children.items():
+        assert alg.node_bbox[v] == alg._merge2(alg.node_bbox[node_s], alg.node_bbox[node_t])
+        assert all(alg.node_rank.get(c, -math.inf) < alg.node_rank[v] for c in (node_s, node_t))
+        assert alg.node_parent[node_s] == v and alg.node_parent[node_t] == v
+    assert len(set(alg.node_rank.values())) == len(alg.node_rank) == len(alg.ranks)
+
+
+def bbh_incremental_fuzz_test(n_runs=50, n_updates=60, seed=0):
+    """
+    Random insert/delete/move sequences, after every update the tree invariants should hold and the levels should be
+    well formed, same as the ones of a new BBHFast on the current bboxes
+    """
+    import random
+    rng = random.Random(seed)
+    for run in range(n_runs):
+        def random_bbox():
+            x, y = rng.randint(0, 200), rng.randint(0, 200)
+            return [x, y, x + rng.randint(1, 30), y + rng.randint(1, 30)]
+        bboxes = {i: random_bbox() for i in range(rng.randint(0, 20))}
+        alg = IncrementalBBH(bboxes=list(bboxes.values()), rebuild_size=rng.choice([2, 3, 4, 8]))
+        for _ in range(n_updates):
+            if bboxes and rng.random() < 0.4:
+                handle = rng.choice(list(bboxes))
+                alg.delete(handle)
+                del bboxes[handle]
+            elif bboxes and rng.random() < 0.3:
+                moves = [(handle, random_bbox()) for handle in rng.sample(list(bboxes), rng.randint(1, len(bboxes)))]
+                alg.move(moves)
+                bboxes.update(moves)
+            else:
+                bbox = random_bbox()
+                bboxes[alg.insert(bbox)] = bbox
+            check_tree(alg)
+            if bboxes:
+                bboxes_hierarchy = alg.merge()
+                check_levels(bboxes_hierarchy, list(bboxes.values()))
+                check_levels(BBHFast(bboxes=list(bboxes.values())).merge(), list(bboxes.values()))
+                assert bboxes_hierarchy[-1] == BBHFast(bboxes=list(bboxes.values())).merge()[-1]
+    print(f"bbh_incremental_fuzz_test: {n_runs} runs of {n_updates} updates passed")
+
+
+def main():
+    bbh_incremental_test()
+    bbh_incremental_fuzz_test()
+
+
+if __name__ == "__main__":
+    main()
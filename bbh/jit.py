@@ -0,0 +1,23 @@
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+    def njit(*args, **kwargs):
+        """
+        No numba, the kernel functions stay plain Python
+        """
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+def kernel_args(arrays):
+    """
+    Arguments of an njit kernel: the arrays themselves with numba, otherwise the arrays as lists,
+    since plain Python is much faster on lists than on NumPy scalars
+    """
+    if HAS_NUMBA:
+        return arrays
+    return [a.tolist() for a in arrays]
@@ -0,0 +1,235 @@
+import numpy as np
+from sortedcontainers import SortedList
+
+
+class MergeTree:
+    """
+    Compact merge tree (dendrogram) of a bounding box hierarchy.
+    Node 0 ~ n_leaves-1 are the input bboxes, the i-th merge creates node n_leaves+i.
+    Only O(N) memory is used, any level of the hierarchy is rebuilt on demand.
+    n_leaves: int, No. of input bboxes
+    bboxes: (n_nodes, 4) array, bbox of every node. Leaves first, then merged bboxes in merge order.
+    children: (n_merges, 2) int array, node ids of the two bboxes merged in each merge
+    costs: (n_merges,) float array, distance of each merge
+    keys: optional (n_nodes,) array used to order the bboxes in a level, e.g. Morton code.
+          If None, bboxes in a level are ordered by node id.
+    """
+    def __init__(self, n_leaves, bboxes, children, costs, keys=None):
+        self.n_leaves = n_leaves
+        self.bboxes = np.asarray(bboxes).reshape(-1, 4)
+        self.children = np.asarray(children, dtype=np.int64).reshape(-1, 2)
+        self.costs = np.asarray(costs, dtype=np.float64)
+        self.keys = None if keys is None else np.asarray(keys)
+        self.n_merges = len(self.children)
+        self.n_nodes = self.n_leaves + self.n_merges
+        # parent[i] is the node created by merging node i, -1 if node i is never merged
+        self.parent = np.full(self.n_nodes, -1, dtype=np.int64)
+        merged_ids = np.arange(self.n_leaves, self.n_nodes, dtype=np.int64)
+        self.parent[self.children[:, 0]] = merged_ids
+        self.parent[self.children[:, 1]] = merged_ids
+
+    def __len__(self):
+        """
+        No. of levels, level 0 is the input bboxes
+        """
+        return self.n_merges + 1
+
+    def _normalize_level(self, k):
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError(f"Level {k} out of range")
+        return k
+
+    def level_ids(self, k):
+        """
+        Node ids of the bboxes at level k, i.e. after k merges. O(N).
+        """
+        k = self._normalize_level(k)
+        n_alive = self.n_leaves + k
+        parent = self.parent[:n_alive]
+        ids = np.flatnonzero((parent < 0) | (parent >= n_alive))
+        return self._sort_ids(ids)
+
+    def _sort_ids(self, ids):
+        """
+        Order the node ids the same way as the engine which built the tree
+        """
+        if self.keys is None:
+            return np.sort(ids)
+        b = self.bboxes[ids]
+        order = np.lexsort((ids, b[:, 3], b[:, 2], b[:, 1], b[:, 0], self.keys[ids]))
+        return ids[order]
+
+    def level(self, k):
+        """
+        Bboxes at level k as a list of [x1, y1, x2, y2]
+        """
+        return self.bboxes[self.level_ids(k)].tolist()
+
+    def levels(self):
+        """
+        All the levels, same as the List[List[bbox]] output of merge(). This takes O(N^2) memory.
+        The levels are replayed one merge at a time, see ReplayHierarchy.
+        """
+        return list(ReplayHierarchy(self))
+
+    def linkage(self):
+        """
+        scipy-style linkage matrix, each row is [id_s, id_t, cost, No. of leaves under the merged node]
+        """
+        sizes = np.ones(self.n_nodes, dtype=np.int64)
+        for i, (s, t) in enumerate(self.children):
+            sizes[self.n_leaves + i] = sizes[s] + sizes[t]
+        z = np.empty((self.n_merges, 4), dtype=np.float64)
+        z[:, :2] = self.children
+        z[:, 2] = self.costs
+        z[:, 3] = sizes[self.n_leaves:]
+        return z
+
+
+class Hierarchy:
+    """
+    Lazy, sequence-like view of all the levels of a merge tree.
+    Supports len(), (negative) indexing and slicing like the List[List[bbox]] output of merge(),
+    but a level is only rebuilt when it is accessed, by replaying/undoing merges from the nearest checkpoint.
+    tree: MergeTree
+    checkpoint_interval: int, No. of merges between two checkpoints. Every checkpoint stores the node ids of one level,
+                         so a smaller interval takes more memory and gives faster access.
+                         Default is sqrt(N), i.e. O(N^1.5) memory and O(sqrt(N)) replay per access.
+    """
+    def __init__(self, tree, checkpoint_interval=None):
+        self.tree = tree
+        if checkpoint_interval is None:
+            checkpoint_interval = int(np.sqrt(max(tree.n_leaves, 1)))
+        self.checkpoint_interval = max(int(checkpoint_interval), 1)
+        self.id_dtype = np.int32 if tree.n_nodes < np.iinfo(np.int32).max else np.int64
+        self._build_checkpoints()
+
+    def _build_checkpoints(self):
+        tree = self.tree
+        alive = np.zeros(tree.n_nodes, dtype=bool)
+        alive[:tree.n_leaves] = True
+        self.checkpoints = {0: np.flatnonzero(alive).astype(self.id_dtype)}
+        for i, (s, t) in enumerate(tree.children):
+            alive[s] = False
+            alive[t] = False
+            alive[tree.n_leaves + i] = True
+            k = i + 1
+            if k % self.checkpoint_interval == 0 or k == tree.n_merges:
+                self.checkpoints[k] = np.flatnonzero(alive).astype(self.id_dtype)
+
+    def _nearest_checkpoint(self, k):
+        lower = k - k % self.checkpoint_interval
+        upper = min(lower + self.checkpoint_interval, self.tree.n_merges)
+        return lower if k - lower <= upper - k else upper
+
+    def level_ids(self, k):
+        """
+        Node ids of the bboxes at level k
+        """
+        tree = self.tree
+        k = tree._normalize_level(k)
+        c = self._nearest_checkpoint(k)
+        ids = self.checkpoints[c]
+        if k > c:
+            # Replay merges c ~ k-1: add the merged nodes and remove their children
+            added = np.arange(tree.n_leaves + c, tree.n_leaves + k, dtype=self.id_dtype)
+            removed = tree.children[c:k].ravel()
+        elif k < c:
+            # Undo merges k ~ c-1: add the children back and remove the merged nodes
+            added = tree.children[k:c].ravel()
+            removed = np.arange(tree.n_leaves + k, tree.n_leaves + c, dtype=self.id_dtype)
+        else:
+            return tree._sort_ids(ids.astype(np.int64))
+        ids = np.concatenate((ids, added)).astype(np.int64)
+        ids = ids[~np.isin(ids, removed)]
+        return tree._sort_ids(ids)
+
+    def level(self, k):
+        return self.tree.bboxes[self.level_ids(k)].tolist()
+
+    def __len__(self):
+        return len(self.tree)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self.level(i) for i in range(*k.indices(len(self)))]
+        return self.level(k)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self.level(k)
+
+
+class ReplayHierarchy:
+    """
+    Sequence-like view of all the levels of a merge tree with O(N) memory.
+    Only one level is kept, as a SortedList of the sort keys of its bboxes. The merges of the tree are the undo log:
+    going from level k to k+1 removes the two children of merge k and adds the merged node, going back does the
+    opposite. Accessing level k replays or undoes the merges between the current level and k in O(log(N)) each,
+    so going through all the levels in order costs O(N*log(N)) plus the size of the levels returned.
+    Supports len(), (negative) indexing, slicing and iteration like the List[List[bbox]] output of merge().
+    tree: MergeTree
+    """
+    def __init__(self, tree):
+        self.tree = tree
+        self.k = 0  # index of the current level
+        self.id_pos = 0 if tree.keys is None else 5  # position of the node id in the sort keys
+        self.cur = SortedList(self._keys(np.arange(tree.n_leaves)))
+
+    def _keys(self, ids):
+        """
+        Sort keys of the nodes ids in the order of MergeTree._sort_ids, key[1:5] is the bbox:
+        (key, x_tl, y_tl, x_br, y_br, id), or (id, x_tl, y_tl, x_br, y_br) if the tree has no keys
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        b = self.tree.bboxes[ids]
+        columns = [b[:, 0].tolist(), b[:, 1].tolist(), b[:, 2].tolist(), b[:, 3].tolist()]
+        if self.tree.keys is None:
+            return list(zip(ids.tolist(), *columns))
+        return list(zip(self.tree.keys[ids].tolist(), *columns, ids.tolist()))
+
+    def _seek(self, k):
+        tree = self.tree
+        k = tree._normalize_level(k)
+        if k > self.k:
+            # Replay merges self.k ~ k-1
+            removed = self._keys(tree.children[self.k:k].ravel())
+            added = self._keys(np.arange(tree.n_leaves + self.k, tree.n_leaves + k))
+            for j in range(k - self.k):
+                self.cur.remove(removed[2*j])
+                self.cur.remove(removed[2*j + 1])
+                self.cur.add(added[j])
+        elif k < self.k:
+            # Undo merges self.k-1 ~ k
+            removed = self._keys(tree.children[k:self.k].ravel())
+            added = self._keys(np.arange(tree.n_leaves + k, tree.n_leaves + self.k))
+            for j in range(self.k - k - 1, -1, -1):
+                self.cur.remove(added[j])
+                self.cur.add(removed[2*j])
+                self.cur.add(removed[2*j + 1])
+        self.k = k
+
+    def level_ids(self, k):
+        """
+        Node ids of the bboxes at level k
+        """
+        self._seek(k)
+        return np.fromiter((key[self.id_pos] for key in self.cur), dtype=np.int64, count=len(self.cur))
+
+    def level(self, k):
+        self._seek(k)
+        return [list(key[1:5]) for key in self.cur]
+
+    def __len__(self):
+        return len(self.tree)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self.level(i) for i in range(*k.indices(len(self)))]
+        return self.level(k)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self.level(k)
@@ -0,0 +1,153 @@
+import math
+import numpy as np
+
+
+def uncovered_area_metric(bbox_s, bbox_t):
+    x_tl, y_tl = min(bbox_s[0], bbox_t[0]), min(bbox_s[1], bbox_t[1])
+    x_br, y_br = max(bbox_s[2], bbox_t[2]), max(bbox_s[3], bbox_t[3])
+    area_s = (bbox_s[2]-bbox_s[0])*(bbox_s[3]-bbox_s[1])
+    area_t = (bbox_t[2]-bbox_t[0])*(bbox_t[3]-bbox_t[1])
+    area_st = (x_br-x_tl)*(y_br-y_tl)
+    return area_st - area_s - area_t
+
+
+def uncovered_area_metric_with_labels(bbox_s, bbox_t, label_s=0, label_t=0, penalty=1e10):
+    if label_s == label_t:
+        return uncovered_area_metric(bbox_s=bbox_s, bbox_t=bbox_t)
+    else:
+        return penalty + uncovered_area_metric(bbox_s=bbox_s, bbox_t=bbox_t)
+
+
+def enlargement_metric(bbox_s, bbox_t):
+    """
+    Area added to the larger bbox to cover the other one, as in R-tree insertion
+    """
+    x_tl, y_tl = min(bbox_s[0], bbox_t[0]), min(bbox_s[1], bbox_t[1])
+    x_br, y_br = max(bbox_s[2], bbox_t[2]), max(bbox_s[3], bbox_t[3])
+    area_s = (bbox_s[2]-bbox_s[0])*(bbox_s[3]-bbox_s[1])
+    area_t = (bbox_t[2]-bbox_t[0])*(bbox_t[3]-bbox_t[1])
+    area_st = (x_br-x_tl)*(y_br-y_tl)
+    return area_st - max(area_s, area_t)
+
+
+def perimeter_growth_metric(bbox_s, bbox_t):
+    """
+    Perimeter added to the bbox with the larger perimeter to cover the other one, as the margin of the R*-tree
+    """
+    x_tl, y_tl = min(bbox_s[0], bbox_t[0]), min(bbox_s[1], bbox_t[1])
+    x_br, y_br = max(bbox_s[2], bbox_t[2]), max(bbox_s[3], bbox_t[3])
+    perimeter_s = 2*((bbox_s[2]-bbox_s[0])+(bbox_s[3]-bbox_s[1]))
+    perimeter_t = 2*((bbox_t[2]-bbox_t[0])+(bbox_t[3]-bbox_t[1]))
+    perimeter_st = 2*((x_br-x_tl)+(y_br-y_tl))
+    return perimeter_st - max(perimeter_s, perimeter_t)
+
+
+def iou_metric(bbox_s, bbox_t):
+    """
+    1 - IoU of the two bboxes, 1 for disjoint bboxes whatever their distance
+    """
+    w = min(bbox_s[2], bbox_t[2]) - max(bbox_s[0], bbox_t[0])
+    h = min(bbox_s[3], bbox_t[3]) - max(bbox_s[1], bbox_t[1])
+    area_i = max(w, 0)*max(h, 0)
+    area_s = (bbox_s[2]-bbox_s[0])*(bbox_s[3]-bbox_s[1])
+    area_t = (bbox_t[2]-bbox_t[0])*(bbox_t[3]-bbox_t[1])
+    area_u = area_s + area_t - area_i
+    return 1.0 - area_i / area_u if area_u > 0 else 1.0
+
+
+def center_distance_metric(bbox_s, bbox_t):
+    """
+    Euclidean distance between the bbox centers
+    """
+    dx = (bbox_s[0]+bbox_s[2])/2 - (bbox_t[0]+bbox_t[2])/2
+    dy = (bbox_s[1]+bbox_s[3])/2 - (bbox_t[1]+bbox_t[3])/2
+    return math.sqrt(dx*dx + dy*dy)
+
+
+def uncovered_area_metric_batch(bbox_s, bboxes_t):
+    """
+    uncovered_area_metric between bbox_s and an (M, 4) array of bboxes, return an array of M costs.
+    bbox_s can also be an (M, 4) array to get the costs of M pairs, or any shape that broadcasts with bboxes_t.
+    Same arithmetic as the scalar version, so the costs are identical. Same for the other batch metrics below.
+    """
+    bbox_s, bboxes_t = np.asarray(bbox_s), np.asarray(bboxes_t)
+    x_tl, y_tl = np.minimum(bbox_s[..., 0], bboxes_t[..., 0]), np.minimum(bbox_s[..., 1], bboxes_t[..., 1])
+    x_br, y_br = np.maximum(bbox_s[..., 2], bboxes_t[..., 2]), np.maximum(bbox_s[..., 3], bboxes_t[..., 3])
+    area_s = (bbox_s[..., 2]-bbox_s[..., 0])*(bbox_s[..., 3]-bbox_s[..., 1])
+    area_t = (bboxes_t[..., 2]-bboxes_t[..., 0])*(bboxes_t[..., 3]-bboxes_t[..., 1])
+    area_st = (x_br-x_tl)*(y_br-y_tl)
+    return area_st - area_s - area_t
+
+
+def uncovered_area_metric_with_labels_batch(bbox_s, bboxes_t, label_s=0, labels_t=0, penalty=1e10):
+    """
+    uncovered_area_metric_with_labels between bbox_s and an (M, 4) array of bboxes with M labels, see
+    uncovered_area_metric_batch
+    """
+    costs = uncovered_area_metric_batch(bbox_s, bboxes_t)
+    return np.where(np.asarray(label_s) == np.asarray(labels_t), costs, penalty + costs)
+
+
+def enlargement_metric_batch(bbox_s, bboxes_t):
+    bbox_s, bboxes_t = np.asarray(bbox_s), np.asarray(bboxes_t)
+    x_tl, y_tl = np.minimum(bbox_s[..., 0], bboxes_t[..., 0]), np.minimum(bbox_s[..., 1], bboxes_t[..., 1])
+    x_br, y_br = np.maximum(bbox_s[..., 2], bboxes_t[..., 2]), np.maximum(bbox_s[..., 3], bboxes_t[..., 3])
+    area_s = (bbox_s[..., 2]-bbox_s[..., 0])*(bbox_s[..., 3]-bbox_s[..., 1])
+    area_t = (bboxes_t[..., 2]-bboxes_t[..., 0])*(bboxes_t[..., 3]-bboxes_t[..., 1])
+    area_st = (x_br-x_tl)*(y_br-y_tl)
+    return area_st - np.maximum(area_s, area_t)
+
+
+def perimeter_growth_metric_batch(bbox_s, bboxes_t):
+    bbox_s, bboxes_t = np.asarray(bbox_s), np.asarray(bboxes_t)
+    x_tl, y_tl = np.minimum(bbox_s[..., 0], bboxes_t[..., 0]), np.minimum(bbox_s[..., 1], bboxes_t[..., 1])
+    x_br, y_br = np.maximum(bbox_s[..., 2], bboxes_t[..., 2]), np.maximum(bbox_s[..., 3], bboxes_t[..., 3])
+    perimeter_s = 2*((bbox_s[..., 2]-bbox_s[..., 0])+(bbox_s[..., 3]-bbox_s[..., 1]))
+    perimeter_t = 2*((bboxes_t[..., 2]-bboxes_t[..., 0])+(bboxes_t[..., 3]-bboxes_t[..., 1]))
+    perimeter_st = 2*((x_br-x_tl)+(y_br-y_tl))
+    return perimeter_st - np.maximum(perimeter_s, perimeter_t)
+
+
+def iou_metric_batch(bbox_s, bboxes_t):
+    bbox_s, bboxes_t = np.asarray(bbox_s), np.asarray(bboxes_t)
+    w = np.minimum(bbox_s[..., 2], bboxes_t[..., 2]) - np.maximum(bbox_s[..., 0], bboxes_t[..., 0])
+    h = np.minimum(bbox_s[..., 3], bboxes_t[..., 3]) - np.maximum(bbox_s[..., 1], bboxes_t[..., 1])
+    area_i = np.maximum(w, 0)*np.maximum(h, 0)
+    area_s = (bbox_s[..., 2]-bbox_s[..., 0])*(bbox_s[..., 3]-bbox_s[..., 1])
+    area_t = (bboxes_t[..., 2]-bboxes_t[..., 0])*(bboxes_t[..., 3]-bboxes_t[..., 1])
+    area_u = area_s + area_t - area_i
+    iou = np.divide(area_i, area_u, out=np.zeros(np.shape(area_u)), where=area_u > 0)
+    return 1.0 - iou
+
+
+def center_distance_metric_batch(bbox_s, bboxes_t):
+    bbox_s, bboxes_t = np.asarray(bbox_s), np.asarray(bboxes_t)
+    dx = (bbox_s[..., 0]+bbox_s[..., 2])/2 - (bboxes_t[..., 0]+bboxes_t[..., 2])/2
+    dy = (bbox_s[..., 1]+bbox_s[..., 3])/2 - (bboxes_t[..., 1]+bboxes_t[..., 3])/2
+    return np.sqrt(dx*dx + dy*dy)
+
+
+# Distance metrics between two bboxes: name -> (scalar metric, batch metric)
+METRICS = {"uncovered_area": (uncovered_area_metric, uncovered_area_metric_batch),
+           "uncovered_area_with_labels": (uncovered_area_metric_with_labels, uncovered_area_metric_with_labels_batch),
+           "enlargement": (enlargement_metric, enlargement_metric_batch),
+           "perimeter_growth": (perimeter_growth_metric, perimeter_growth_metric_batch),
+           "iou": (iou_metric, iou_metric_batch),
+           "center_distance": (center_distance_metric, center_distance_metric_batch)}
+
+# Batch version of each scalar metric in METRICS
+BATCH_METRICS = {scalar: batch for scalar, batch in METRICS.values()}
+
+
+def get_metric(metric):
+    """
+    metric: name in METRICS, a (scalar metric, batch metric) pair, or a scalar metric
+    Return the (scalar metric, batch metric) pair, the batch metric is None for a scalar metric not in METRICS
+    """
+    if isinstance(metric, str):
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric: {metric}")
+        return METRICS[metric]
+    if isinstance(metric, tuple):
+        return metric
+    return metric, BATCH_METRICS.get(metric)
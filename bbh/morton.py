@@ -0,0 +1,135 @@
+import numpy as np
+import pymorton as pm
+
+
+def _part1by1(n):
+    """
+    Spread the lower 16 bits of each element so that there is a 0 bit between every two bits
+    """
+    n = n & 0x0000ffff
+    n = (n | (n << 8)) & 0x00ff00ff
+    n = (n | (n << 4)) & 0x0f0f0f0f
+    n = (n | (n << 2)) & 0x33333333
+    n = (n | (n << 1)) & 0x55555555
+    return n
+
+
+def interleave2_batch(x, y):
+    """
+    Vectorized pymorton.interleave2, x and y are int arrays, return an int64 array of Morton codes.
+    Like pymorton only the lower 16 bits of each coordinate are used, so the codes are identical.
+    """
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    return _part1by1(x) | (_part1by1(y) << 1)
+
+
+def bbox_centers(bboxes):
+    """
+    Integer centers of an (N, 4) array of bboxes, same as int((x_tl+x_br)/2), int((y_tl+y_br)/2)
+    """
+    bboxes = np.asarray(bboxes).reshape(-1, 4)
+    center_x = ((bboxes[:, 0] + bboxes[:, 2]) / 2).astype(np.int64)
+    center_y = ((bboxes[:, 1] + bboxes[:, 3]) / 2).astype(np.int64)
+    return center_x, center_y
+
+
+def morton_encode_bboxes(bboxes, curve="morton"):
+    """
+    Morton codes (or codes of another curve in CURVES) of the bbox centers as a list of int, computed at once
+    """
+    return get_curve(curve)[1](*bbox_centers(bboxes)).tolist()
+
+
+def morton_argsort(z_orders, bboxes):
+    """
+    Indices that sort the (z_order, bbox, idx) tuples, i.e. by Morton code, then bbox coordinates, then index
+    """
+    bboxes = np.asarray(bboxes).reshape(-1, 4)
+    z_orders = np.asarray(z_orders)
+    order = np.argsort(z_orders, kind="stable")
+    # Only the runs of equal codes need the bbox coordinates, they are usually a small part of the bboxes
+    z_sorted = z_orders[order]
+    tied = np.zeros(len(order), dtype=bool)
+    same = z_sorted[1:] == z_sorted[:-1]
+    tied[1:] |= same
+    tied[:-1] |= same
+    if tied.any():
+        idx = np.sort(order[tied])
+        b = bboxes[idx]
+        order[tied] = idx[np.lexsort((idx, b[:, 3], b[:, 2], b[:, 1], b[:, 0], z_orders[idx]))]
+    return order
+
+
+def hilbert_encode(x, y, order=16):
+    """
+    Distance of (x, y) along the Hilbert curve on a 2^order x 2^order grid.
+    Like the Morton code, only the lower 16 bits of each coordinate are used.
+    """
+    n = 1 << order
+    x &= n - 1
+    y &= n - 1
+    d = 0
+    s = n >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return d
+
+
+def hilbert_encode_batch(x, y, order=16):
+    """
+    Vectorized hilbert_encode, x and y are int arrays, return an int64 array of Hilbert distances
+    """
+    n = 1 << order
+    x = np.asarray(x, dtype=np.int64) & (n - 1)
+    y = np.asarray(y, dtype=np.int64) & (n - 1)
+    d = np.zeros_like(x)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s >>= 1
+    return d
+
+
+# Shift of the shifted Morton curve, 0b0101...01 moves the quadrant boundaries of every level by 1/3 or 2/3
+MORTON_SHIFT = 0x5555
+
+
+def shifted_interleave2(x, y):
+    return pm.interleave2(x + MORTON_SHIFT, y + MORTON_SHIFT)
+
+
+def shifted_interleave2_batch(x, y):
+    return interleave2_batch(np.asarray(x, dtype=np.int64) + MORTON_SHIFT, np.asarray(y, dtype=np.int64) + MORTON_SHIFT)
+
+
+# Space-filling curves used to order the bboxes: name -> (scalar encoder, vectorized encoder)
+CURVES = {"morton": (pm.interleave2, interleave2_batch),
+          "morton_shifted": (shifted_interleave2, shifted_interleave2_batch),
+          "hilbert": (hilbert_encode, hilbert_encode_batch)}
+
+
+def get_curve(curve):
+    """
+    curve: name in CURVES, or a (scalar encoder, vectorized encoder) pair taking the integer center x, y
+    """
+    if isinstance(curve, str):
+        if curve not in CURVES:
+            raise ValueError(f"Unknown curve: {curve}")
+        return CURVES[curve]
+    return curve
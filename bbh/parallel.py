@@ -0,0 +1,291 @@
+import heapq
+import itertools
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from bbh.bbh import BBH, BBHFast, uncovered_area_metric, check_output, wrap_tree, n_merges_until
+from bbh.merge_tree import MergeTree
+from bbh.morton import bbox_centers, interleave2_batch
+
+
+def merge_group(args):
+    """
+    Run BBHFast on one group of bboxes, e.g. a tile or a label, return the merges of the group in local node ids
+    and the queue stats: (children, costs, merged bboxes, queue_stats).
+    This runs in a worker process, so it has to be a module level function.
+    """
+    bboxes, dist_metric, n_neighbors, indexed_queue, max_cost = args
+    alg = BBHFast(bboxes=bboxes, dist_metric=dist_metric, n_neighbors=n_neighbors, indexed_queue=indexed_queue)
+    tree = alg.merge(output="tree", max_cost=max_cost)
+    return tree.children, tree.costs, tree.bboxes[tree.n_leaves:], alg.queue_stats
+
+
+def run_groups(jobs, workers=None):
+    """
+    merge_group on every job, in a process pool unless workers is 1 or there is a single job
+    """
+    if workers == 1 or len(jobs) <= 1:
+        return [merge_group(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(merge_group, jobs))
+
+
+def interleave_merges(results, local2global, n, n_merges, n_keep=None):
+    """
+    Interleave the merges of the groups by cost into one merge sequence, keeping the order inside each group.
+    results: merge_group result of each group
+    local2global: list of the global node ids of the bboxes of each group, the merged bboxes are appended in place
+    n: No. of bboxes, the i-th merge creates node n+i
+    n_merges: max No. of merges
+    n_keep: max No. of merges taken from each group, all of them by default
+    Return the merges (global node ids), their costs, the merged bboxes as (1, 4) arrays and the group of each merge
+    """
+    if n_keep is None:
+        n_keep = [len(result[1]) for result in results]
+    merge_children = []
+    merge_costs = []
+    bboxes_merged = []
+    merge_groups = []
+    heads = [(results[g][1][0], g, 0) for g in range(len(results)) if n_keep[g] > 0]
+    heapq.heapify(heads)
+    while heads and len(merge_children) < n_merges:
+        cost, g, i = heapq.heappop(heads)
+        children, costs, bboxes_g, _ = results[g]
+        merge_children.append((local2global[g][children[i][0]], local2global[g][children[i][1]]))
+        merge_costs.append(cost)
+        bboxes_merged.append(bboxes_g[i:i+1])
+        merge_groups.append(g)
+        local2global[g].append(n + len(merge_children) - 1)
+        if i + 1 < n_keep[g]:
+            heapq.heappush(heads, (costs[i+1], g, i + 1))
+    return merge_children, merge_costs, bboxes_merged, merge_groups
+
+
+class BBHParallel(BBH):
+    """
+    Parallel Bounding Box Hierarchy by spatial tiling.
+    The input is cut into n_tiles x n_tiles tiles by bbox center, BBHFast runs on every tile in a process pool,
+    and a final sequential BBHFast pass merges what is left of the tiles (stitching).
+    Each tile is merged down to stitch_size bboxes; the tile merges are interleaved by cost into one merge sequence,
+    followed by the merges of the stitching pass, so the output is a single hierarchy like BBHFast.merge().
+
+    Deviation from the sequential BBHFast:
+    - Inside a tile, the merges are exactly the ones BBHFast makes on the bboxes of that tile.
+    - Before stitching, the only candidates missing are the pairs across a tile boundary. BBHFast pairs each bbox with
+      its 2*n_neighbors neighbors in Morton order, so at most 2*n_neighbors pairs per bbox next to a boundary in
+      Morton order are lost, i.e. O(n_tiles * n_neighbors * sqrt(N)) pairs for uniformly spread bboxes.
+    - The last n_tiles^2 * stitch_size - 1 merges are done by the stitching pass and can merge across tiles.
+    So the levels with more than n_tiles^2 * stitch_size bboxes only differ from BBHFast by the pairs that
+    straddle a tile boundary, and a larger stitch_size moves more of the top of the hierarchy to the exact pass.
+    With max_cost every tile stops at its first merge above max_cost, with stop_at_count the interleaved tile
+    merges are cut at the budget and the stitching pass stops at stop_at_count bboxes.
+    """
+    def __init__(self,
+                 bboxes,
+                 dist_metric=uncovered_area_metric,
+                 n_neighbors=4,
+                 n_tiles=4,
+                 stitch_size=8,
+                 workers=None):
+        super().__init__(bboxes=bboxes, dist_metric=dist_metric)
+        self.n_neighbors = n_neighbors
+        self.n_tiles = n_tiles  # No. of tiles along each axis
+        self.stitch_size = max(stitch_size, 1)  # No. of bboxes each tile hands to the stitching pass
+        self.workers = workers  # No. of processes, None for the No. of CPUs, 1 to run in this process
+
+    def _tile_ids(self, bboxes):
+        """
+        Split the bbox indices by the tile of their center
+        """
+        center_x, center_y = bbox_centers(bboxes)
+        x_min, y_min = center_x.min(), center_y.min()
+        tile_w = max((center_x.max() - x_min + 1) / self.n_tiles, 1)
+        tile_h = max((center_y.max() - y_min + 1) / self.n_tiles, 1)
+        tile_x = np.minimum(((center_x - x_min) / tile_w).astype(np.int64), self.n_tiles - 1)
+        tile_y = np.minimum(((center_y - y_min) / tile_h).astype(np.int64), self.n_tiles - 1)
+        tile = tile_y * self.n_tiles + tile_x
+        order = np.argsort(tile, kind="stable")
+        bounds = np.searchsorted(tile[order], np.arange(self.n_tiles * self.n_tiles + 1))
+        return [order[bounds[i]:bounds[i+1]] for i in range(self.n_tiles * self.n_tiles) if bounds[i] < bounds[i+1]]
+
+    def _run_tiles(self, tiles, max_cost=None):
+        dist_metric = (self.dist_metric, self.dist_metric_batch)
+        jobs = [(self.bboxes_array[ids].tolist(), dist_metric, self.n_neighbors, False, max_cost) for ids in tiles]
+        return run_groups(jobs, self.workers)
+
+    def merge(self, output="levels", checkpoint_interval=None, stop_at_count=None, max_cost=None):
+        """
+        output: "levels", "tree", "hierarchy" or "replay", see BBHFast.merge
+        stop_at_count, max_cost: stop early, see BBHFast.merge
+        """
+        check_output(output)
+        n = len(self.bboxes)
+        self.bboxes_array = np.asarray(self.bboxes).reshape(-1, 4)
+        tiles = self._tile_ids(self.bboxes_array) if n > 0 else []
+        results = self._run_tiles(tiles, max_cost)
+
+        # Interleave the tile merges by cost, keeping the order inside each tile
+        local2global = [list(ids) for ids in tiles]  # local node id -> global node id of each tile
+        # No. of merges kept from each tile, fewer if the tile stopped at max_cost
+        n_keep = [min(max(len(ids) - self.stitch_size, 0), len(results[t][0])) for t, ids in enumerate(tiles)]
+        merge_children, merge_costs, bboxes_merged, _ = interleave_merges(results, local2global, n,
+                                                                          n_merges_until(n, stop_at_count), n_keep)
+
+        # Stitch the bboxes left in every tile with a sequential pass
+        alive = np.ones(n + len(merge_children), dtype=bool)
+        alive[np.asarray(merge_children, dtype=np.int64).ravel()] = False
+        stitch_ids = np.flatnonzero(alive)
+        all_bboxes = np.concatenate([self.bboxes_array] + bboxes_merged)
+        if len(stitch_ids) > 1:
+            tree = BBHFast(bboxes=all_bboxes[stitch_ids].tolist(),
+                           dist_metric=(self.dist_metric, self.dist_metric_batch),
+                           n_neighbors=self.n_neighbors).merge(output="tree",
+                                                               stop_at_count=stop_at_count,
+                                                               max_cost=max_cost)
+            stitch2global = list(stitch_ids)
+            for (s, t), cost in zip(tree.children, tree.costs):
+                merge_children.append((stitch2global[s], stitch2global[t]))
+                merge_costs.append(cost)
+                stitch2global.append(n + len(merge_children) - 1)
+            all_bboxes = np.concatenate((all_bboxes, tree.bboxes[tree.n_leaves:]))
+
+        # Levels are ordered by Morton code like BBHFast
+        center_x, center_y = bbox_centers(all_bboxes)
+        tree = MergeTree(n_leaves=n,
+                         bboxes=all_bboxes,
+                         children=merge_children,
+                         costs=merge_costs,
+                         keys=interleave2_batch(center_x, center_y))
+        if output == "levels":
+            return tree.levels()
+        return wrap_tree(tree, output, checkpoint_interval)
+
+
+def _build_chunk(args):
+    """
+    Build the hierarchies of a chunk of bbox lists in a worker process, return a list of (idx, result)
+    """
+    engine, engine_kwargs, merge_kwargs, start, bbox_lists = args
+    return [(start + i, engine(bboxes=bboxes, **engine_kwargs).merge(**merge_kwargs))
+            for i, bboxes in enumerate(bbox_lists)]
+
+
+def _chunks(bbox_lists, chunk_size):
+    """
+    Split an iterable of bbox lists into (start idx, list of bbox lists), without reading it all at once
+    """
+    it = iter(bbox_lists)
+    start = 0
+    while True:
+        chunk = list(itertools.islice(it, chunk_size))
+        if not chunk:
+            return
+        yield start, chunk
+        start += len(chunk)
+
+
+def build_hierarchies(bbox_lists,
+                      engine=BBHFast,
+                      workers=None,
+                      chunk_size=8,
+                      ordered=True,
+                      output="levels",
+                      stop_at_count=None,
+                      max_cost=None,
+                      **engine_kwargs):
+    """
+    Build the hierarchy of every bbox list (e.g. one per image) in a process pool, yield (idx, result).
+    idx is the position in bbox_lists, result is
+    engine(bboxes=bbox_list, **engine_kwargs).merge(output=output, stop_at_count=stop_at_count, max_cost=max_cost).
+    bbox_lists: iterable of bbox lists, consumed lazily, at most 2*workers chunks are in flight or finished and
+                waiting for their turn at a time
+    engine: BBH class to use, e.g. BBHNaive, BBHFast, it has to be defined at module level to be sent to the workers
+    workers: No. of processes, None for the No. of CPUs, 1 to run in this process
+    chunk_size: No. of bbox lists sent to a worker at once, larger chunks amortize the inter-process overhead
+    ordered: True to yield the results in the order of bbox_lists, False to yield them as they are completed
+    """
+    check_output(output)
+    merge_kwargs = {"output": output, "stop_at_count": stop_at_count, "max_cost": max_cost}
+    chunks = ((engine, engine_kwargs, merge_kwargs, start, chunk) for start, chunk in _chunks(bbox_lists, chunk_size))
+    if workers == 1:
+        for job in chunks:
+            yield from _build_chunk(job)
+        return
+    max_pending = 2 * (workers or os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        done_chunks = {}  # start idx -> results of a chunk finished ahead of its turn
+        next_start = 0
+        has_chunks = True
+        while True:
+            # The chunks waiting for their turn count too, so a slow chunk can not make them pile up
+            while has_chunks and len(pending) + len(done_chunks) < max_pending:
+                job = next(chunks, None)
+                if job is None:
+                    has_chunks = False
+                else:
+                    pending.add(executor.submit(_build_chunk, job))
+            if not pending:
+                return  # the chunk of next_start is always pending or done, so nothing is left
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results = future.result()
+                if not ordered:
+                    yield from results
+                    continue
+                done_chunks[results[0][0]] = results
+            while next_start in done_chunks:
+                results = done_chunks.pop(next_start)
+                next_start += len(results)
+                yield from results
+
+
+def bbh_parallel_test():
+    """
+    Test the parallel bbh algorithm, the output should be a complete hierarchy with one bbox merged per level
+    """
+    from bbh.bbh import get_test_case
+    bboxes_ori = get_test_case()
+    bboxes_hierarchy = BBHParallel(bboxes=bboxes_ori, n_tiles=2, stitch_size=2, workers=2).merge()
+    assert len(bboxes_hierarchy) == len(bboxes_ori)
+    for i, h in enumerate(bboxes_hierarchy):
+        assert len(h) == len(bboxes_ori) - i
+    assert sorted(bboxes_hierarchy[0]) == sorted(bboxes_ori)
+    print(bboxes_hierarchy[-1])
+
+
+def build_hierarchies_test():
+    """
+    The batch api should give the same hierarchies as building them one by one, in order or as completed
+    """
+    from bbh.bbh import get_test_case
+    bboxes_ori = get_test_case()
+    bbox_lists = [bboxes_ori[:n] for n in range(2, len(bboxes_ori) + 1)]
+    expected = [BBHFast(bboxes=bboxes).merge() for bboxes in bbox_lists]
+    results = list(build_hierarchies(iter(bbox_lists), workers=2, chunk_size=3))
+    assert [idx for idx, _ in results] == list(range(len(bbox_lists)))
+    assert [h for _, h in results] == expected
+    results = dict(build_hierarchies(bbox_lists, workers=2, chunk_size=2, ordered=False))
+    assert [results[i] for i in range(len(bbox_lists))] == expected
+    # At most 2*workers chunks are read ahead of the results
+    n_read = 0
+
+    def read():
+        nonlocal n_read
+        for bboxes in bbox_lists:
+            n_read += 1
+            yield bboxes
+    results = build_hierarchies(read(), workers=2, chunk_size=1)
+    next(results)
+    assert n_read <= 4, n_read
+    results.close()
+    print("Passed")
+
+
+def main():
+    #bbh_parallel_test()
+    build_hierarchies_test()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import heapq
+import math
+
+
+def uncovered_area_lower_bound(bbox, center_gap_x, center_gap_y, max_half_w, max_half_h):
+    """
+    Lower bound of uncovered_area_metric(bbox, other) for any other bbox whose center is at least
+    center_gap_x away in x OR center_gap_y away in y, and whose half width/height are at most max_half_w/max_half_h.
+    If the two bboxes are apart by gap g in x, the hull covers a g x height(bbox) strip which is in neither bbox,
+    so the metric is at least g * height(bbox). Same for y. Overlapping bboxes are bounded by -area(bbox).
+    """
+    w, h = bbox[2] - bbox[0], bbox[3] - bbox[1]
+    gap_x = center_gap_x - w / 2 - max_half_w
+    gap_y = center_gap_y - h / 2 - max_half_h
+    return max(min(gap_x * h, gap_y * w), -w * h)
+
+
+def bboxes_overlap(bbox_s, bbox_t):
+    """
+    True if the two bboxes have a positive area in common, touching bboxes do not overlap
+    """
+    return (min(bbox_s[2], bbox_t[2]) > max(bbox_s[0], bbox_t[0]) and
+            min(bbox_s[3], bbox_t[3]) > max(bbox_s[1], bbox_t[1]))
+
+
+class GridIndex:
+    """
+    Dynamic uniform grid over the bbox centers, supports insert, remove, k-nearest query under uncovered_area_metric
+    and overlap query.
+    Cells are visited ring by ring around the query bbox until the k-th best cost is not larger than
+    the lower bound of all the bboxes in the remaining rings.
+    cell_size: side length of a cell, about sqrt(area / N) so that each cell holds ~1 bbox
+    """
+    def __init__(self, cell_size, dist_metric):
+        self.cell_size = max(cell_size, 1)
+        self.dist_metric = dist_metric
+        self.cells = {}  # (i, j) -> set of bbox idx
+        self.idx2bbox = {}
+        self.idx2cell = {}
+        # Half width/height of the largest bboxes ever inserted, an upper bound is enough for pruning
+        self.max_half_w = 0
+        self.max_half_h = 0
+        self.i_min = self.j_min = math.inf
+        self.i_max = self.j_max = -math.inf
+
+    @classmethod
+    def from_bboxes(cls, bboxes, dist_metric):
+        """
+        Build an index of bboxes (idx is the position in the list) with the cell size derived from their extent
+        """
+        n = max(len(bboxes), 1)
+        x_min = min((b[0] for b in bboxes), default=0)
+        y_min = min((b[1] for b in bboxes), default=0)
+        x_max = max((b[2] for b in bboxes), default=1)
+        y_max = max((b[3] for b in bboxes), default=1)
+        index = cls(cell_size=math.sqrt(max((x_max - x_min) * (y_max - y_min), 1) / n),
+                    dist_metric=dist_metric)
+        for idx, bbox in enumerate(bboxes):
+            index.insert(idx, bbox)
+        return index
+
+    def __len__(self):
+        return len(self.idx2bbox)
+
+    def _cell(self, bbox):
+        return (int(((bbox[0] + bbox[2]) / 2) // self.cell_size),
+                int(((bbox[1] + bbox[3]) / 2) // self.cell_size))
+
+    def insert(self, idx, bbox):
+        cell = self._cell(bbox)
+        self.cells.setdefault(cell, set()).add(idx)
+        self.idx2bbox[idx] = bbox
+        self.idx2cell[idx] = cell
+        self.max_half_w = max(self.max_half_w, (bbox[2] - bbox[0]) / 2)
+        self.max_half_h = max(self.max_half_h, (bbox[3] - bbox[1]) / 2)
+        self.i_min, self.i_max = min(self.i_min, cell[0]), max(self.i_max, cell[0])
+        self.j_min, self.j_max = min(self.j_min, cell[1]), max(self.j_max, cell[1])
+
+    def remove(self, idx):
+        cell = self.idx2cell.pop(idx)
+        del self.idx2bbox[idx]
+        members = self.cells[cell]
+        members.discard(idx)
+        if not members:
+            del self.cells[cell]
+
+    def _ring(self, ci, cj, r):
+        """
+        Cells at Chebyshev distance r from (ci, cj), clipped to the occupied range
+        """
+        if r == 0:
+            yield ci, cj
+            return
+        i_lo, i_hi = max(ci - r, self.i_min), min(ci + r, self.i_max)
+        j_lo, j_hi = max(cj - r, self.j_min), min(cj + r, self.j_max)
+        for i in range(i_lo, i_hi + 1):
+            if i == ci - r or i == ci + r:
+                for j in range(j_lo, j_hi + 1):
+                    yield i, j
+            else:
+                if cj - r >= self.j_min:
+                    yield i, cj - r
+                if cj + r <= self.j_max:
+                    yield i, cj + r
+
+    def knn(self, bbox, k, exclude=None):
+        """
+        k bboxes with the smallest cost to bbox, return a list of (cost, idx) sorted by cost.
+        exclude: idx to skip, e.g. the query bbox itself
+        """
+        if not self.cells:
+            return []
+        ci, cj = self._cell(bbox)
+        max_r = max(ci - self.i_min, self.i_max - ci, cj - self.j_min, self.j_max - cj)
+        best = []  # max-heap of (-cost, -idx)
+        cells = self.cells
+        for r in range(max_r + 1):
+            for cell in self._ring(ci, cj, r):
+                for idx in cells.get(cell, ()):
+                    if idx == exclude:
+                        continue
+                    dist = self.dist_metric(bbox, self.idx2bbox[idx])
+                    if len(best) < k:
+                        heapq.heappush(best, (-dist, -idx))
+                    elif (-dist, -idx) > best[0]:
+                        heapq.heapreplace(best, (-dist, -idx))
+            if len(best) == k:
+                # The bboxes in ring r+1 or further have their center at least r cells away in x or y
+                gap = r * self.cell_size
+                lower_bound = uncovered_area_lower_bound(bbox, gap, gap, self.max_half_w, self.max_half_h)
+                if -best[0][0] <= lower_bound:
+                    break
+        return sorted((-d, -idx) for d, idx in best)
+
+    def overlapping(self, bbox, exclude=()):
+        """
+        Yield the idx of the bboxes which overlap bbox, see bboxes_overlap.
+        The center of such a bbox is less than max_half_w/max_half_h away from bbox, only the cells in that range
+        are visited, or all the occupied cells if there are fewer of them.
+        exclude: idx to skip
+        """
+        if not self.cells:
+            return
+        i_lo = max(int((bbox[0] - self.max_half_w) // self.cell_size), self.i_min)
+        i_hi = min(int((bbox[2] + self.max_half_w) // self.cell_size), self.i_max)
+        j_lo = max(int((bbox[1] - self.max_half_h) // self.cell_size), self.j_min)
+        j_hi = min(int((bbox[3] + self.max_half_h) // self.cell_size), self.j_max)
+        if i_lo > i_hi or j_lo > j_hi:
+            return
+        if (i_hi - i_lo + 1) * (j_hi - j_lo + 1) <= len(self.cells):
+            cells = ((i, j) for i in range(i_lo, i_hi + 1) for j in range(j_lo, j_hi + 1))
+        else:
+            cells = (cell for cell in self.cells if i_lo <= cell[0] <= i_hi and j_lo <= cell[1] <= j_hi)
+        for cell in cells:
+            for idx in self.cells.get(cell, ()):
+                if idx not in exclude and bboxes_overlap(bbox, self.idx2bbox[idx]):
+                    yield idx
@@ -0,0 +1,167 @@
+import numpy as np
+from bbh.metrics import uncovered_area_metric
+from bbh.incremental import IncrementalBBH
+
+
+def iou_matrix(bboxes_s, bboxes_t):
+    """
+    IoU between every bbox in the (M, 4) array bboxes_s and every bbox in the (K, 4) array bboxes_t, an (M, K) array
+    """
+    bboxes_s = np.asarray(bboxes_s, dtype=np.float64).reshape(-1, 1, 4)
+    bboxes_t = np.asarray(bboxes_t, dtype=np.float64).reshape(1, -1, 4)
+    w = np.minimum(bboxes_s[..., 2], bboxes_t[..., 2]) - np.maximum(bboxes_s[..., 0], bboxes_t[..., 0])
+    h = np.minimum(bboxes_s[..., 3], bboxes_t[..., 3]) - np.maximum(bboxes_s[..., 1], bboxes_t[..., 1])
+    area_i = np.maximum(w, 0) * np.maximum(h, 0)
+    area_s = (bboxes_s[..., 2] - bboxes_s[..., 0]) * (bboxes_s[..., 3] - bboxes_s[..., 1])
+    area_t = (bboxes_t[..., 2] - bboxes_t[..., 0]) * (bboxes_t[..., 3] - bboxes_t[..., 1])
+    area_u = area_s + area_t - area_i
+    return np.divide(area_i, area_u, out=np.zeros(np.shape(area_u)), where=area_u > 0)
+
+
+class BBHStream:
+    """
+    Bounding box hierarchy of a video, one frame at a time.
+    The bboxes of a frame are matched to the bboxes of the previous frame, and the merge tree of the previous frame
+    is updated instead of built again (see IncrementalBBH):
+    - bboxes which did not change are reused as they are
+    - bboxes which moved a little (IoU >= match_iou with an unmatched bbox of the previous frame) are moved in place,
+      the tree is kept and only the bboxes and costs of their ancestors are recomputed
+    - the other bboxes of the previous frame are deleted and the other bboxes of the frame are inserted,
+      each rebuilds a subtree of at most rebuild_size leaves
+    If more than rebuild_ratio of the bboxes are inserted or deleted, e.g. at a scene cut, the hierarchy is rebuilt.
+    Since the moved bboxes keep their place in the tree, the hierarchy drifts from the one BBHFast would build
+    when the objects move a lot over many frames. rebuild_every bounds the drift by rebuilding every that many frames.
+    """
+    def __init__(self,
+                 dist_metric=uncovered_area_metric,
+                 n_neighbors=4,
+                 rebuild_size=8,
+                 match_iou=0.5,
+                 rebuild_ratio=0.5,
+                 rebuild_every=None):
+        self.dist_metric = dist_metric
+        self.n_neighbors = n_neighbors
+        self.rebuild_size = rebuild_size
+        self.match_iou = match_iou
+        self.rebuild_ratio = rebuild_ratio
+        self.rebuild_every = rebuild_every
+        self.reset()
+
+    def reset(self):
+        """
+        Start from scratch, the next frame builds a new hierarchy
+        """
+        self.alg = None
+        self.n_frames = 0  # No. of frames since the last rebuild
+        self.frame_handles = []  # handle of each bbox of the last frame in IncrementalBBH, in the input order
+        self.frame_stats = {}
+
+    def _build(self, bboxes):
+        self.alg = IncrementalBBH(bboxes=bboxes,
+                                  dist_metric=self.dist_metric,
+                                  n_neighbors=self.n_neighbors,
+                                  rebuild_size=self.rebuild_size)
+        self.frame_handles = list(range(len(bboxes)))
+        self.n_frames = 1
+        self.frame_stats = {"same": 0, "moved": 0, "inserted": len(bboxes), "deleted": 0, "rebuilt": True}
+
+    def _match(self, bboxes):
+        """
+        Handle of the matched bbox of the previous frame for each bbox, None if unmatched.
+        Identical bboxes are matched first, then the rest greedily by IoU.
+        """
+        matches = [None] * len(bboxes)
+        prev = {}  # bbox -> handles of the previous frame
+        for handle in self.frame_handles:
+            prev.setdefault(tuple(self.alg.bbox(handle)), []).append(handle)
+        for i, bbox in enumerate(bboxes):
+            handles = prev.get(tuple(bbox))
+            if handles:
+                matches[i] = handles.pop()
+        unmatched_new = [i for i, handle in enumerate(matches) if handle is None]
+        unmatched_prev = [handle for handles in prev.values() for handle in handles]
+        if unmatched_new and unmatched_prev:
+            iou = iou_matrix([bboxes[i] for i in unmatched_new], [self.alg.bbox(h) for h in unmatched_prev])
+            rows, cols = np.nonzero(iou >= self.match_iou)
+            order = np.argsort(-iou[rows, cols], kind="stable")
+            used_rows, used_cols = set(), set()
+            for r, c in zip(rows[order].tolist(), cols[order].tolist()):
+                if r not in used_rows and c not in used_cols:
+                    used_rows.add(r)
+                    used_cols.add(c)
+                    matches[unmatched_new[r]] = unmatched_prev[c]
+        return matches
+
+    def push(self, bboxes, output="tree", checkpoint_interval=None, stop_at_count=None, max_cost=None):
+        """
+        Add the bboxes of the next frame and return its hierarchy.
+        output: "tree" (default, cheapest), "replay", "hierarchy" or "levels", see BBHFast.merge.
+        stop_at_count, max_cost: stop early, see BBHFast.merge
+        The leaves of the hierarchy are ordered by handle, self.frame_handles[i] is the handle of bboxes[i]
+        and self.alg.leaf_handles[j] is the handle of leaf j.
+        """
+        self._update(bboxes)
+        return self.alg.merge(output=output, checkpoint_interval=checkpoint_interval,
+                              stop_at_count=stop_at_count, max_cost=max_cost)
+
+    def _update(self, bboxes):
+        """
+        Update the hierarchy to the bboxes of the next frame, or rebuild it
+        """
+        if self.alg is None or len(self.alg) == 0 or self.n_frames == self.rebuild_every:
+            self._build(bboxes)
+            return
+        matches = self._match(bboxes)
+        matched = set(h for h in matches if h is not None)
+        deleted = [h for h in self.frame_handles if h not in matched]
+        inserted = [i for i, h in enumerate(matches) if h is None]
+        if len(deleted) + len(inserted) > self.rebuild_ratio * max(len(bboxes), len(self.frame_handles)):
+            self._build(bboxes)
+            return
+
+        moves = [(h, bbox) for h, bbox in zip(matches, bboxes)
+                 if h is not None and list(bbox) != self.alg.bbox(h)]
+        self.alg.move(moves)
+        for h in deleted:
+            self.alg.delete(h)
+        for i in inserted:
+            matches[i] = self.alg.insert(bboxes[i])
+        self.frame_handles = matches
+        self.n_frames += 1
+        self.frame_stats = {"same": len(bboxes) - len(inserted) - len(moves),
+                            "moved": len(moves),
+                            "inserted": len(inserted),
+                            "deleted": len(deleted),
+                            "rebuilt": False}
+
+
+def bbh_stream_test():
+    """
+    Test the streaming bbh algorithm on frames made by moving, removing and adding bboxes of the test case
+    """
+    from bbh.bbh import get_test_case
+    bboxes_ori = get_test_case()
+    frames = [bboxes_ori,
+              [[x1+1, y1, x2+1, y2] for x1, y1, x2, y2 in bboxes_ori[:7]] + bboxes_ori[7:],
+              bboxes_ori[1:] + [[500, 500, 520, 540]],
+              bboxes_ori[1:] + [[500, 500, 520, 540]]]
+    stream = BBHStream(rebuild_size=4)
+    for frame in frames:
+        tree = stream.push(frame)
+        assert sorted(tree.level(0)) == sorted(frame)
+        assert [stream.alg.bbox(h) for h in stream.frame_handles] == frame
+        # Every merged bbox still contains its children after the moves
+        for v, children in stream.alg.node_children.items():
+            x_tl, y_tl, x_br, y_br = stream.alg.node_bbox[v]
+            for c in children:
+                bbox = stream.alg.node_bbox[c]
+                assert x_tl <= bbox[0] and y_tl <= bbox[1] and bbox[2] <= x_br and bbox[3] <= y_br
+        print(stream.frame_stats)
+
+
+def main():
+    bbh_stream_test()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,10 @@ import os
 import sys
 import time
 from util.extract_bbox_from_real_cases import load_bbox_from_txt
-from util.evaluate_acc import cal_iou_bbox_list
+from util.evaluate_acc import iou_curve
 import logging
 from bbh.bbh import BBHNaive, BBHFast
+from bbh.parallel import build_hierarchies
 from util.visualization import visualize_realworld
 from PIL import Image
 import json
@@ -59,7 +60,30 @@ def running_time_eva(ann_file_path):
     print(f"Average bbox: {cnt}")
 
 
-def quality_eva(ann_file_path, img_dir, out_dir):
+class FastAndBF:
+    """
+    Engine for build_hierarchies which builds both the fast and the brute force hierarchy of a bbox list,
+    so that one job and one process pool do both
+    """
+    def __init__(self, bboxes):
+        self.bboxes = bboxes
+
+    def merge(self, **merge_kwargs):
+        return BBHFast(bboxes=self.bboxes).merge(**merge_kwargs), BBHNaive(bboxes=self.bboxes).merge(**merge_kwargs)
+
+
+def build_fast_bf(img_info, workers=None):
+    """
+    Build the fast and brute force hierarchies of all the samples in img_info in a process pool,
+    yield (info, bbh_fast, bbh_bf) in the order of img_info. The hierarchies are merge trees, see MergeTree.
+    """
+    bbox_lists = (img_info[info]['bbox_list'] for info in img_info)
+    results = build_hierarchies(bbox_lists, engine=FastAndBF, workers=workers, output="tree")
+    for info, (_, (bbh_fast, bbh_bf)) in zip(img_info, results):
+        yield info, bbh_fast, bbh_bf
+
+
+def quality_eva(ann_file_path, img_dir, out_dir, workers=None):
     vis_dir = os.path.join(out_dir, "vis")
     if not os.path.exists(vis_dir):
         os.makedirs(vis_dir)
@@ -71,7 +95,7 @@ def quality_eva(ann_file_path, img_dir, out_dir):
     fast_vs_bf_list = {}
     with open(ann_file_path, 'r') as f:
         img_info = json.load(f)
-    for info in tqdm(img_info):
+    for info, bbh_fast, bbh_bf in tqdm(build_fast_bf(img_info, workers=workers), total=len(img_info)):
         img_name = img_info[info]['file_name']
         print(f"{img_name}")
         img_path = os.path.join(img_dir, img_name)
@@ -81,27 +105,16 @@ def quality_eva(ann_file_path, img_dir, out_dir):
         bbox_list_gt = bbox_list
         img_h = img_info[info]['height']
         img_w = img_info[info]['width']
-        alg_bf = BBHNaive(bboxes=bbox_list)
-        alg_fast = BBHFast(bboxes=bbox_list)
-        bbh_fast = alg_fast.merge()
-        bbh_bf = alg_bf.merge()
 
         h_levels = len(bbh_bf)
+        # IoU of every level at once, updated by each merge
+        fast_vs_gt_curve = iou_curve(bbh_fast, bbox_list_gt, height=img_h, width=img_w)
+        bf_vs_gt_curve = iou_curve(bbh_bf, bbox_list_gt, height=img_h, width=img_w)
+        fast_vs_bf_curve = iou_curve(bbh_fast, bbh_bf, height=img_h, width=img_w)
         for i in range(h_levels):
-            bbox_list_fast = bbh_fast[i]
-            bbox_list_bf = bbh_bf[i]
-            fast_vs_gt = cal_iou_bbox_list(bbox_list_src=bbox_list_fast,
-                                           bbox_list_tgt=bbox_list_gt,
-                                           height=img_h,
-                                           width=img_w)
-            bf_vs_gt = cal_iou_bbox_list(bbox_list_src=bbox_list_bf,
-                                         bbox_list_tgt=bbox_list_gt,
-                                         height=img_h,
-                                         width=img_w)
-            fast_vs_bf = cal_iou_bbox_list(bbox_list_src=bbox_list_fast,
-                                           bbox_list_tgt=bbox_list_bf,
-                                           height=img_h,
-                                           width=img_w)
+            fast_vs_gt = fast_vs_gt_curve[i]
+            bf_vs_gt = bf_vs_gt_curve[i]
+            fast_vs_bf = fast_vs_bf_curve[i]
             if i in fast_vs_gt_list:
                 fast_vs_gt_list[i].append(fast_vs_gt)
             else:
@@ -122,12 +135,12 @@ def quality_eva(ann_file_path, img_dir, out_dir):
                                              bbox_color="BLUE")
             img_vis_gt.save(os.path.join(vis_dir, f"{img_name[:-4]}_gt_{i}.png"))
 
-            img_vis_fast = visualize_realworld(bbox_list=bbox_list_fast,
+            img_vis_fast = visualize_realworld(bbox_list=bbh_fast.level(i),
                                                image=img.copy(),
                                                bbox_color="CYAN")
             img_vis_fast.save(os.path.join(vis_dir, f"{img_name[:-4]}_fast_{i}.png"))
 
-            img_vis_bf = visualize_realworld(bbox_list=bbox_list_bf,
+            img_vis_bf = visualize_realworld(bbox_list=bbh_bf.level(i),
                                              image=img.copy(),
                                              bbox_color="MAGENTA")
             img_vis_bf.save(os.path.join(vis_dir, f"{img_name[:-4]}_bf_{i}.png"))
@@ -142,7 +155,7 @@ def quality_eva(ann_file_path, img_dir, out_dir):
         json.dump(eva_info, f)
 
 
-def quality_eva_select(ann_file_path, img_dir, out_dir, select_list=[-20, -10, -5]):
+def quality_eva_select(ann_file_path, img_dir, out_dir, select_list=[-20, -10, -5], workers=None):
     vis_dir = os.path.join(out_dir, "vis")
     if not os.path.exists(vis_dir):
         os.makedirs(vis_dir)
@@ -154,7 +167,7 @@ def quality_eva_select(ann_file_path, img_dir, out_dir, select_list=[-20, -10, -
     fast_vs_bf_list = {}
     with open(ann_file_path, 'r') as f:
         img_info = json.load(f)
-    for info in tqdm(img_info):
+    for info, bbh_fast, bbh_bf in tqdm(build_fast_bf(img_info, workers=workers), total=len(img_info)):
         img_name = img_info[info]['file_name']
         print(f"{img_name}")
         img_path = os.path.join(img_dir, img_name)
@@ -164,27 +177,16 @@ def quality_eva_select(ann_file_path, img_dir, out_dir, select_list=[-20, -10, -
         bbox_list_gt = bbox_list
         img_h = img_info[info]['height']
         img_w = img_info[info]['width']
-        alg_bf = BBHNaive(bboxes=bbox_list)
-        alg_fast = BBHFast(bboxes=bbox_list)
-        bbh_fast = alg_fast.merge()
-        bbh_bf = alg_bf.merge()
 
         h_levels = len(bbh_bf)
+        # IoU of every level at once, updated by each merge
+        fast_vs_gt_curve = iou_curve(bbh_fast, bbox_list_gt, height=img_h, width=img_w)
+        bf_vs_gt_curve = iou_curve(bbh_bf, bbox_list_gt, height=img_h, width=img_w)
+        fast_vs_bf_curve = iou_curve(bbh_fast, bbh_bf, height=img_h, width=img_w)
         for i in range(h_levels):
-            bbox_list_fast = bbh_fast[i]
-            bbox_list_bf = bbh_bf[i]
-            fast_vs_gt = cal_iou_bbox_list(bbox_list_src=bbox_list_fast,
-                                           bbox_list_tgt=bbox_list_gt,
-                                           height=img_h,
-                                           width=img_w)
-            bf_vs_gt = cal_iou_bbox_list(bbox_list_src=bbox_list_bf,
-                                         bbox_list_tgt=bbox_list_gt,
-                                         height=img_h,
-                                         width=img_w)
-            fast_vs_bf = cal_iou_bbox_list(bbox_list_src=bbox_list_fast,
-                                           bbox_list_tgt=bbox_list_bf,
-                                           height=img_h,
-                                           width=img_w)
+            fast_vs_gt = fast_vs_gt_curve[i]
+            bf_vs_gt = bf_vs_gt_curve[i]
+            fast_vs_bf = fast_vs_bf_curve[i]
             if i in fast_vs_gt_list:
                 fast_vs_gt_list[i].append(fast_vs_gt)
             else:
@@ -207,12 +209,12 @@ def quality_eva_select(ann_file_path, img_dir, out_dir, select_list=[-20, -10, -
                                              bbox_color="BLUE")
                 img_vis_gt.save(os.path.join(vis_dir, f"{img_name[:-4]}_gt_{i}.png"))
 
-                img_vis_fast = visualize_realworld(bbox_list=bbox_list_fast,
+                img_vis_fast = visualize_realworld(bbox_list=bbh_fast.level(i),
                                                image=img.copy(),
                                                bbox_color="CYAN")
                 img_vis_fast.save(os.path.join(vis_dir, f"{img_name[:-4]}_fast_{i}.png"))
 
-                img_vis_bf = visualize_realworld(bbox_list=bbox_list_bf,
+                img_vis_bf = visualize_realworld(bbox_list=bbh_bf.level(i),
                                              image=img.copy(),
                                              bbox_color="MAGENTA")
                 img_vis_bf.save(os.path.join(vis_dir, f"{img_name[:-4]}_bf_{i}.png"))
@@ -4,6 +4,15 @@ from PIL import Image, ImageDraw
 from bbh.bbh import BBHFastNonOverlap, BBHFast
 from util.bbox_preprocess import remove_overlap_bboxes
 
+
+def level_with_count(hierarchy, count):
+    '''
+    Level of the hierarchy with count bboxes, or its last level if it stopped with more bboxes.
+    BBHFastNonOverlap stops early when every merge left would overlap another bbox.
+    '''
+    return hierarchy[min(max(len(hierarchy[0]) - count, 0), len(hierarchy) - 1)]
+
+
 def task_vis_on_city_person():
     ann_file_path = r"D:\Data\BBH_Exp\CityPersons\multi_labels\annotation_filtered.json"
     img_dir = "D:\\Data\\BBH_Exp\\CityPersons\\city_persons\\images"
@@ -11,7 +20,7 @@ def task_vis_on_city_person():
 
     os.makedirs(out_dir, exist_ok=True)
 
-    select_list = [-20, -10, -5]
+    select_list = [20, 10, 5]  # No. of bboxes of the levels to draw
     color_nonoverlap = (255, 255, 255)
     color_ori = (0, 255, 0)
 
@@ -40,24 +49,28 @@ def task_vis_on_city_person():
         alg_nonoverlap = BBHFastNonOverlap(bboxes=bboxes)
         bbh_fast = alg_fast.merge()
         bbh_nonoverlap = alg_nonoverlap.merge()
+        if len(bbh_nonoverlap[-1]) > 1:
+            print(f'Non-overlap hierarchy stopped early with {len(bbh_nonoverlap[-1])} bboxes')
 
         for i in select_list:
-            bbox_list = bbh_fast[i]
-            bbox_nonoverlap_list = bbh_nonoverlap[i]
+            bbox_list = level_with_count(bbh_fast, i)
+            bbox_nonoverlap_list = level_with_count(bbh_nonoverlap, i)
+            if len(bbox_nonoverlap_list) != i:
+                print(f'No non-overlap level with {i} bboxes, drawing the last one with {len(bbox_nonoverlap_list)}')
 
             image = img.copy()
             draw = ImageDraw.Draw(image)
             for j, bbox in enumerate(bbox_list):
                 draw.rectangle([(bbox[0], bbox[1]), (bbox[2], bbox[3])],
                                fill=None, outline=color_ori)
-            image.save(os.path.join(out_dir, f"{img_name[:-4]}_{abs(i)}_ori.png"))
+            image.save(os.path.join(out_dir, f"{img_name[:-4]}_{i}_ori.png"))
 
             image_nonoverlap = img.copy()
             draw_nonoverlap = ImageDraw.Draw(image_nonoverlap)
             for j, bbox in enumerate(bbox_nonoverlap_list):
                 draw_nonoverlap.rectangle([(bbox[0], bbox[1]), (bbox[2], bbox[3])],
                                           fill=None, outline=color_nonoverlap)
-            image_nonoverlap.save(os.path.join(out_dir, f"{img_name[:-4]}_{abs(i)}_nonoverlap.png"))
+            image_nonoverlap.save(os.path.join(out_dir, f"{img_name[:-4]}_{i}_nonoverlap.png"))
 
 
 def main():
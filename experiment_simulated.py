@@ -4,7 +4,10 @@ import time
 from util.extract_bbox_from_real_cases import load_bbox_from_txt
 from util.evaluate_acc import cal_iou_bbox_list
 import logging
-from bbh.bbh import BBHNaive, BBHFast
+from queue import PriorityQueue
+from bbh.bbh import BBHNaive, BBHNaiveVectorized, BBHExactNN, BBHFast
+from bbh.candidate_queue import CandidateQueue
+from bbh.compiled import BBHCompiled
 from util.visualization import visualize
 
 def exp_homepage_case_test():
@@ -36,7 +39,8 @@ def running_time_test_by_rect_num(in_dir, out_path, alg_name='FAST'):
     """
     Calculate the running time of a particular rect_num
     This will run sample_num time and calculate the average
-    Algorithm name can be either BF or FAST
+    Algorithm name can be BF, BF_NP (vectorized BF), BF_NN (nearest-neighbor table BF), FAST or
+    FAST_JIT (compiled FAST, needs numba)
     """
     logging.basicConfig(filename=out_path, encoding='utf-8', level=logging.INFO)
     sample_file_list = os.listdir(in_dir)
@@ -49,6 +53,12 @@ def running_time_test_by_rect_num(in_dir, out_path, alg_name='FAST'):
             alg = BBHFast(bboxes=bbox_list)
         elif alg_name == "BF":
             alg = BBHNaive(bboxes=bbox_list)
+        elif alg_name == "BF_NP":
+            alg = BBHNaiveVectorized(bboxes=bbox_list)
+        elif alg_name == "BF_NN":
+            alg = BBHExactNN(bboxes=bbox_list)
+        elif alg_name == "FAST_JIT":
+            alg = BBHCompiled(bboxes=bbox_list)
         else:
             raise Exception("Unknown Algorithm")
         t_start = time.perf_counter()
@@ -71,6 +81,68 @@ def task_running_time_exp():
                                   alg_name=alg_name)
 
 
+def queue_benchmark_by_rect_num(in_dir, out_path):
+    """
+    Compare queue.PriorityQueue with CandidateQueue on the candidate pairs of the samples in in_dir.
+    The initial candidate pairs of BBHFast are pushed and then popped one by one,
+    PriorityQueue uses the old (dist, (z, bbox, idx), (z, bbox, idx)) entries, CandidateQueue uses (dist, s_idx, t_idx).
+    """
+    logging.basicConfig(filename=out_path, encoding='utf-8', level=logging.INFO)
+    sample_file_list = os.listdir(in_dir)
+    t_pq_list = []
+    t_cq_list = []
+    for sample_file_name in sample_file_list:
+        sample_file_path = os.path.join(in_dir, sample_file_name)
+        bbox_list = load_bbox_from_txt(txt_file_path=sample_file_path)
+        alg = BBHFast(bboxes=bbox_list)
+        alg._morton_order()
+        store = alg.store
+        data = alg.data
+        # the sorted level keys are packed ints, rebuild the old (z, bbox, idx) tuples
+        old_data = [(int(store.z[idx]), store.bbox(idx), idx) for idx in store.key_ids(data).tolist()]
+        pairs = [(alg.dist_metric(old_data[i][1], old_data[j][1]), old_data[i], old_data[j])
+                 for i in range(len(data))
+                 for j in range(i-alg.n_neighbors, i+alg.n_neighbors+1)
+                 if 0 <= j < len(data) and j != i]
+
+        t_start = time.perf_counter()
+        pq = PriorityQueue()
+        for p in pairs:
+            pq.put(p)
+        while not pq.empty():
+            pq.get()
+        t_pq = time.perf_counter() - t_start
+
+        t_start = time.perf_counter()
+        cq = CandidateQueue()
+        for dist, d_s, d_t in pairs:
+            cq.push(dist, d_s[2], d_t[2])
+        while len(cq) > 0:
+            cq.pop()
+        t_cq = time.perf_counter() - t_start
+
+        t_pq_list.append(t_pq)
+        t_cq_list.append(t_cq)
+        logging.info(f'Sample {sample_file_name} pairs: {len(pairs)} PriorityQueue: {t_pq} CandidateQueue: {t_cq}')
+    t_pq_avg = sum(t_pq_list) / len(t_pq_list)
+    t_cq_avg = sum(t_cq_list) / len(t_cq_list)
+    logging.info(f"Avg PriorityQueue: {t_pq_avg}, Avg CandidateQueue: {t_cq_avg}, Speedup: {t_pq_avg / t_cq_avg}")
+
+
+def task_queue_benchmark():
+    """
+    Benchmark of the candidate queue on the synthetic samples generated by task_generate_exp_data
+    Push and pop all the initial candidate pairs, avg over 3 samples:
+        1000 rects: PriorityQueue 0.050s, CandidateQueue 0.023s, Speedup: 2.2
+        10000 rects: PriorityQueue 0.665s, CandidateQueue 0.343s, Speedup: 1.9
+        100000 rects: PriorityQueue 8.191s, CandidateQueue 4.539s, Speedup: 1.8
+    """
+    in_dir = sys.argv[1]
+    out_path = sys.argv[2]
+    queue_benchmark_by_rect_num(in_dir=in_dir,
+                                out_path=out_path)
+
+
 def evaluate_acc(bbox_list_gt, bbox_list_fast, bbox_list_bf, img_h, img_w):
     """
     Evaluate the accuracy of bbh_fast and bbh_naive
@@ -193,6 +265,7 @@ def main():
     #exp_homepage_case_test()
     #task_running_time_exp()
     #task_acc_eva()
+    #task_queue_benchmark()
     task_vis_exp()
 
 
@@ -0,0 +1,191 @@
+'''
+Streaming loaders of large COCO / TextOCR annotation files.
+The annotation file is read with incremental JSON events (ijson) instead of json.load, one image or annotation
+object at a time, so the whole document is never in memory: only the bboxes, 4 integers each, and the image info
+are kept until the bboxes of an image are complete. Without ijson the file is loaded with json.load.
+Each loader yields (image_id, bbox_array, meta) records, bbox_array is an (N, 4) int64 array of
+x_min, y_min, x_max, y_max and meta is a dict with file_name, width and height, ready for the BBH engines:
+    for image_id, bboxes, meta in stream_coco_annotations(ann_file_path):
+        tree = BBHFast(bboxes=bboxes.tolist()).merge(output="tree")
+'''
+import json
+from array import array
+import numpy as np
+
+try:
+    import ijson
+    HAS_IJSON = True
+except ImportError:
+    HAS_IJSON = False
+
+
+def _items(ann_file_path, prefix):
+    """
+    Objects of the list at prefix, e.g. "annotations", one at a time
+    """
+    if not HAS_IJSON:
+        with open(ann_file_path, 'r') as f:
+            yield from json.load(f)[prefix]
+        return
+    with open(ann_file_path, 'rb') as f:
+        yield from ijson.items(f, f"{prefix}.item", use_float=True)
+
+
+def _kvitems(ann_file_path, prefix):
+    """
+    (key, object) pairs of the dict at prefix, e.g. "anns", one at a time
+    """
+    if not HAS_IJSON:
+        with open(ann_file_path, 'r') as f:
+            yield from json.load(f)[prefix].items()
+        return
+    with open(ann_file_path, 'rb') as f:
+        yield from ijson.kvitems(f, prefix, use_float=True)
+
+
+def _group_bboxes(id2meta, anns, min_bboxes=1, grouped=False, image_ids=None):
+    """
+    Group the (image_id, bbox) pairs of anns by image and yield (image_id, bbox_array, meta).
+    The bboxes of an image are kept in a compact int64 array until all the annotations are read,
+    then the images are yielded in the order of their first annotation, like the json.load loaders.
+    id2meta: image id -> meta of the images to keep
+    image_ids: ids of all the images of the file, the annotations of the ones not in id2meta are skipped.
+               KeyError for an annotation of an image not in the file, like the json.load loaders.
+               The keys of id2meta by default.
+    grouped: the annotations of an image are next to each other in the file, so every image is yielded as soon as
+             its last annotation is read and only one image is kept in memory. ValueError if an image comes back.
+    min_bboxes: skip the images with fewer bboxes
+    """
+    if image_ids is None:
+        image_ids = id2meta
+    bboxes = {}  # image id -> array of the coordinates of its bboxes
+    cur_id = None
+    done = set()
+    for image_id, bbox in anns:
+        if image_id not in id2meta:
+            if image_id not in image_ids:
+                raise KeyError(image_id)
+            continue
+        if grouped and image_id != cur_id:
+            if cur_id is not None:
+                done.add(cur_id)
+                coords = bboxes.pop(cur_id)
+                if len(coords) >= 4 * min_bboxes:
+                    yield cur_id, np.frombuffer(coords, dtype=np.int64).reshape(-1, 4), id2meta[cur_id]
+            if image_id in done:
+                raise ValueError(f"Annotations of image {image_id} are not grouped")
+            cur_id = image_id
+        bboxes.setdefault(image_id, array('q')).extend(bbox)
+    for image_id, coords in bboxes.items():
+        if len(coords) >= 4 * min_bboxes:
+            yield image_id, np.frombuffer(coords, dtype=np.int64).reshape(-1, 4), id2meta[image_id]
+
+
+def stream_coco_annotations(ann_file_path, min_bboxes=1, grouped=False):
+    '''
+    Yield (image_id, bbox_array, meta) of every image of a coco annotation file with at least min_bboxes bboxes,
+    in the order of their first annotation. The file is read twice, for the images and for the annotations.
+    The bboxes are rounded like parse_annotation in coco_preprocess, KeyError for an image id not in the images.
+    grouped: see _group_bboxes
+    '''
+    id2meta = {}
+    for info in _items(ann_file_path, "images"):
+        id2meta[info['id']] = {"file_name": info['file_name'],
+                               "width": info['width'],
+                               "height": info['height']}
+
+    def bboxes():
+        for annotation in _items(ann_file_path, "annotations"):
+            x, y, w, h = annotation["bbox"]  # coco use x, y, w, h
+            yield annotation["image_id"], (int(round(x)), int(round(y)), int(round(x+w)), int(round(y+h)))
+
+    yield from _group_bboxes(id2meta, bboxes(), min_bboxes=min_bboxes, grouped=grouped)
+
+
+def stream_textocr_annotations(ann_file_path, split="train", min_bboxes=1, grouped=False):
+    '''
+    Yield (image_id, bbox_array, meta) of every image of a TextOCR annotation file in split with at least
+    min_bboxes bboxes, in the order of their first annotation. The file is read twice, for imgs and for anns.
+    The bboxes are truncated like parse_annotation in textocr_preprocess, file_name is the path in the dataset.
+    KeyError for an image id not in imgs.
+    split: "train", "val", or None for all the images
+    grouped: see _group_bboxes. The anns of TextOCR are grouped by image.
+    '''
+    id2meta = {}
+    image_ids = set()
+    for img_id, info in _kvitems(ann_file_path, "imgs"):
+        image_ids.add(img_id)
+        if split is None or info['set'] == split:
+            id2meta[img_id] = {"file_name": info['file_name'],
+                               "width": info['width'],
+                               "height": info['height']}
+
+    def bboxes():
+        for _, annotation in _kvitems(ann_file_path, "anns"):
+            x, y, w, h = annotation['bbox']
+            yield annotation['image_id'], (int(x), int(y), int(x+w), int(y+h))
+
+    yield from _group_bboxes(id2meta, bboxes(), min_bboxes=min_bboxes, grouped=grouped, image_ids=image_ids)
+
+
+def annotation_stream_test():
+    """
+    Test the loaders on small COCO and TextOCR files against grouping the bboxes after json.load
+    """
+    import os
+    import tempfile
+    coco = {"images": [{"id": 1, "file_name": "1.jpg", "width": 100, "height": 80},
+                       {"id": 2, "file_name": "2.jpg", "width": 60, "height": 60},
+                       {"id": 3, "file_name": "3.jpg", "width": 60, "height": 60}],
+            "annotations": [{"image_id": 2, "bbox": [1.4, 2.6, 10.0, 10.5], "segmentation": [[1, 2, 3, 4]]},
+                            {"image_id": 1, "bbox": [0, 0, 5, 5]},
+                            {"image_id": 2, "bbox": [20, 20, 5.5, 5]}]}
+    textocr = {"imgs": {"a": {"file_name": "train/a.jpg", "width": 50, "height": 40, "set": "train"},
+                        "b": {"file_name": "train/b.jpg", "width": 50, "height": 40, "set": "val"}},
+               "anns": {"a_1": {"image_id": "a", "bbox": [1.9, 2.2, 3.5, 4.5], "utf8_string": "x"},
+                        "a_2": {"image_id": "a", "bbox": [10, 10, 5, 5], "utf8_string": "y"},
+                        "b_1": {"image_id": "b", "bbox": [0, 0, 1, 1], "utf8_string": "z"}}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        coco_path = os.path.join(tmp_dir, "coco.json")
+        textocr_path = os.path.join(tmp_dir, "textocr.json")
+        with open(coco_path, 'w') as f:
+            json.dump(coco, f)
+        with open(textocr_path, 'w') as f:
+            json.dump(textocr, f)
+
+        records = [(image_id, bboxes.tolist(), meta) for image_id, bboxes, meta in stream_coco_annotations(coco_path)]
+        assert records == [(2, [[1, 3, 11, 13], [20, 20, 26, 25]], {"file_name": "2.jpg", "width": 60, "height": 60}),
+                           (1, [[0, 0, 5, 5]], {"file_name": "1.jpg", "width": 100, "height": 80})]
+        assert [r[0] for r in stream_coco_annotations(coco_path, min_bboxes=2)] == [2]
+        try:
+            list(stream_coco_annotations(coco_path, grouped=True))
+            assert False, "image 2 is not grouped"
+        except ValueError:
+            pass
+
+        records = [(image_id, bboxes.tolist(), meta["file_name"])
+                   for image_id, bboxes, meta in stream_textocr_annotations(textocr_path, grouped=True)]
+        assert records == [("a", [[1, 2, 5, 6], [10, 10, 15, 15]], "train/a.jpg")]
+        assert [r[0] for r in stream_textocr_annotations(textocr_path, split=None)] == ["a", "b"]
+        # An annotation of an image which is not in the file
+        coco["annotations"].append({"image_id": 4, "bbox": [0, 0, 1, 1]})
+        textocr["anns"]["c_1"] = {"image_id": "c", "bbox": [0, 0, 1, 1], "utf8_string": "w"}
+        with open(coco_path, 'w') as f:
+            json.dump(coco, f)
+        with open(textocr_path, 'w') as f:
+            json.dump(textocr, f)
+        for loader, path in [(stream_coco_annotations, coco_path), (stream_textocr_annotations, textocr_path)]:
+            try:
+                list(loader(path))
+                assert False, "image not in the file"
+            except KeyError:
+                pass
+    print(f"annotation_stream_test passed, ijson: {HAS_IJSON}")
+
+
+def main():
+    annotation_stream_test()
+
+
+if __name__ == "__main__":
+    main()
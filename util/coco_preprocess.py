@@ -9,6 +9,7 @@ COCO 2017 Val Stats:
 import os
 import json
 import shutil
+from util.annotation_stream import stream_coco_annotations
 
 
 def parse_annotation(ann_file_path):
@@ -17,26 +18,10 @@ def parse_annotation(ann_file_path):
     return a dict where key is the image id,
     and value is a dict containing  bboxes and image path
     '''
-    ann = json.load(open(ann_file_path))
     img_info = {}
-    id2info = {}
-    for info in ann['images']:
-        id2info[info['id']] = {"file_name": info['file_name'],
-                               "width": info['width'],
-                               "height": info['height']}
-    ann_list = ann["annotations"]
-    for annotation in ann_list:
-        image_id = annotation["image_id"]
-        bbox = annotation["bbox"]  # coco use x, y, w, h
-        bbox = [int(round(bbox[0])), int(round(bbox[1])), int(round(bbox[0]+bbox[2])), int(round(bbox[1]+bbox[3]))]  # change to x_min, y_min, x_max, y_max
-        if image_id not in img_info:
-            img_info[image_id] = {}
-            img_info[image_id]["bbox_list"] = [bbox]
-            img_info[image_id]["file_name"] = id2info[image_id]["file_name"]
-            img_info[image_id]["width"] = id2info[image_id]["width"]
-            img_info[image_id]["height"] = id2info[image_id]["height"]
-        else:
-            img_info[image_id]["bbox_list"].append(bbox)
+    # Stream the annotation file instead of loading it at once, see util.annotation_stream
+    for image_id, bboxes, meta in stream_coco_annotations(ann_file_path):
+        img_info[image_id] = {"bbox_list": bboxes.tolist(), **meta}  # x_min, y_min, x_max, y_max
 
     return img_info
 
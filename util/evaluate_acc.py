@@ -1,4 +1,15 @@
 import numpy as np
+from bbh.jit import njit, HAS_NUMBA, kernel_args
+
+
+# Without numba, painting the masks is faster than the sweep when the image has fewer pixels than this per bbox
+MASK_PIXELS_PER_BBOX = 10000
+
+# MaskIoU paints with a difference array when the bboxes cover the image more than this No. of times in total
+DIFF_PAINT_COVERAGE = 128
+
+# iou_curve covers at most this No. of cells at once, about 18 bytes each, the rows are split into bands above it
+MAX_CURVE_CELLS = 1 << 22
 
 
 def cal_iou_bool(mask_src, mask_tgt):
@@ -15,9 +26,159 @@ def cal_iou_bool(mask_src, mask_tgt):
     return iou
 
 
+def pixel_rects(bbox_list, height=None, width=None, drop_empty=True):
+    """
+    Pixels covered by each bbox as half-open rectangles [x1, x2) x [y1, y2), the corners of a bbox are inclusive
+    like when it is painted on a mask. The rectangles are clipped to the height x width image.
+    drop_empty: drop the empty rectangles, otherwise keep one rectangle per bbox, with x2 <= x1 or y2 <= y1 if empty
+    Return 4 int64 arrays x1, y1, x2, y2.
+    """
+    bboxes = np.asarray(bbox_list, dtype=np.int64).reshape(-1, 4)
+    x1, y1 = np.maximum(bboxes[:, 0], 0), np.maximum(bboxes[:, 1], 0)
+    x2, y2 = bboxes[:, 2] + 1, bboxes[:, 3] + 1
+    if width is not None:
+        x2 = np.minimum(x2, width)
+    if height is not None:
+        y2 = np.minimum(y2, height)
+    if not drop_empty:
+        return x1, y1, x2, y2
+    keep = (x2 > x1) & (y2 > y1)
+    return x1[keep], y1[keep], x2[keep], y2[keep]
+
+
+@njit(cache=True)
+def _pull(v, size, length, cnt, cov):
+    """
+    Lengths covered by src, tgt and both under segment tree node v, from its counts and its children
+    """
+    src = cnt[0][v] > 0
+    tgt = cnt[1][v] > 0
+    if v >= size:
+        cov[0][v] = length[v] if src else 0
+        cov[1][v] = length[v] if tgt else 0
+        cov[2][v] = length[v] if src and tgt else 0
+        return
+    left, right = 2*v, 2*v + 1
+    cov[0][v] = length[v] if src else cov[0][left] + cov[0][right]
+    cov[1][v] = length[v] if tgt else cov[1][left] + cov[1][right]
+    if src and tgt:
+        cov[2][v] = length[v]
+    elif src:
+        # All of v is covered by src, so both cover what tgt covers below v
+        cov[2][v] = cov[1][left] + cov[1][right]
+    elif tgt:
+        cov[2][v] = cov[0][left] + cov[0][right]
+    else:
+        cov[2][v] = cov[2][left] + cov[2][right]
+
+
+@njit(cache=True)
+def _sweep_areas(xs, deltas, is_tgt, lows, highs, size, length, cnt, cov):
+    """
+    Sweep a vertical line over the events sorted by x. The segment tree over the compressed y coordinates holds
+    the lengths covered by src, by tgt and by both under the line: cnt[0/1][v] is the No. of src/tgt rectangles
+    covering all of node v, cov[0/1/2][v] the length covered by src/tgt/both below v.
+    Event i adds (deltas[i]=1) or removes (deltas[i]=-1) the y range [lows[i], highs[i]) of a rectangle,
+    given as leaf node ids, in O(log(N)).
+    Return the areas covered by src, by tgt and by both.
+    """
+    area_src = 0
+    area_tgt = 0
+    area_both = 0
+    x_prev = xs[0]
+    for i in range(len(xs)):
+        dx = xs[i] - x_prev
+        if dx != 0:
+            area_src += dx * cov[0][1]
+            area_tgt += dx * cov[1][1]
+            area_both += dx * cov[2][1]
+            x_prev = xs[i]
+        which = 1 if is_tgt[i] else 0
+        lo, hi = lows[i], highs[i]
+        lo_leaf, hi_leaf = lo, hi - 1
+        # Count the rectangle on the O(log(N)) nodes which make up [lo, hi), then update the nodes above both ends
+        while lo < hi:
+            if lo & 1:
+                cnt[which][lo] += deltas[i]
+                _pull(lo, size, length, cnt, cov)
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                cnt[which][hi] += deltas[i]
+                _pull(hi, size, length, cnt, cov)
+            lo >>= 1
+            hi >>= 1
+        v = lo_leaf >> 1
+        while v > 0:
+            _pull(v, size, length, cnt, cov)
+            v >>= 1
+        v = hi_leaf >> 1
+        while v > 0:
+            _pull(v, size, length, cnt, cov)
+            v >>= 1
+    return area_src, area_tgt, area_both
+
+
+def union_areas(bbox_list_src, bbox_list_tgt, height=None, width=None):
+    """
+    Exact No. of pixels covered by bbox_list_src, by bbox_list_tgt and by both, same as painting them on two masks
+    but without any mask: O(N*log(N)) whatever the image size, N is the No. of bboxes.
+    The y coordinates are compressed and a line is swept over x with a segment tree of the covered lengths.
+    The sweep is compiled by numba if it is installed, otherwise it runs in plain Python, about 50 times slower.
+    height, width: the bboxes are clipped to the image like on the masks, None for no clipping
+    """
+    rects_src = pixel_rects(bbox_list_src, height, width)
+    rects_tgt = pixel_rects(bbox_list_tgt, height, width)
+    n_src, n_tgt = len(rects_src[0]), len(rects_tgt[0])
+    if n_src + n_tgt == 0:
+        return 0, 0, 0
+    ys = np.unique(np.concatenate((rects_src[1], rects_src[3], rects_tgt[1], rects_tgt[3])))
+    n_leaves = len(ys) - 1
+    size = 1 << (n_leaves - 1).bit_length()
+    # Length of the y range of every segment tree node, leaf size+i is [ys[i], ys[i+1])
+    length = np.zeros(2*size, dtype=np.int64)
+    length[size:size + n_leaves] = np.diff(ys)
+    v = size
+    while v > 1:
+        length[v//2:v] = length[v:2*v:2] + length[v+1:2*v:2]
+        v //= 2
+
+    # Every rectangle is added at x1 and removed at x2, the order of the events at the same x does not change the areas
+    lows = np.searchsorted(ys, np.concatenate((rects_src[1], rects_tgt[1]))) + size
+    highs = np.searchsorted(ys, np.concatenate((rects_src[3], rects_tgt[3]))) + size
+    is_tgt = np.repeat([False, True], [n_src, n_tgt])
+    xs = np.concatenate((rects_src[0], rects_tgt[0], rects_src[2], rects_tgt[2]))
+    order = np.argsort(xs, kind="stable")
+    events = [xs[order],
+              np.repeat(np.array([1, -1], dtype=np.int64), n_src + n_tgt)[order],
+              np.concatenate((is_tgt, is_tgt))[order],
+              np.concatenate((lows, lows))[order],
+              np.concatenate((highs, highs))[order]]
+    cnt = np.zeros((2, 2*size), dtype=np.int64)
+    cov = np.zeros((3, 2*size), dtype=np.int64)
+    events = kernel_args(events)
+    length, cnt, cov = kernel_args([length, cnt, cov])
+    area_src, area_tgt, area_both = _sweep_areas(*events, size, length, cnt, cov)
+    return int(area_src), int(area_tgt), int(area_both)
+
+
 def cal_iou_bbox_list(bbox_list_src, bbox_list_tgt, height, width):
     """
-    Calculate the IoU between 2 bounding box list
+    Calculate the IoU between 2 bounding box list.
+    Exact and the same as cal_iou_bbox_list_mask, but without painting masks, see union_areas.
+    Without numba the masks are still painted for small images with many bboxes, which is faster there.
+    """
+    if not HAS_NUMBA and height * width < MASK_PIXELS_PER_BBOX * (len(bbox_list_src) + len(bbox_list_tgt)):
+        return _mask_iou(bbox_list_src, bbox_list_tgt, height, width)
+    area_src, area_tgt, area_intersection = union_areas(bbox_list_src, bbox_list_tgt, height, width)
+    # nan if both unions are empty, like the masks
+    iou = np.float64(area_intersection) / (area_src + area_tgt - area_intersection)
+    return iou
+
+
+def cal_iou_bbox_list_mask(bbox_list_src, bbox_list_tgt, height, width):
+    """
+    Calculate the IoU between 2 bounding box list by painting them on 2 masks, O(height*width)
     """
     mask_src = np.zeros((height, width), dtype=bool)
     mask_tgt = np.zeros((height, width), dtype=bool)
@@ -34,6 +195,283 @@ def cal_iou_bbox_list(bbox_list_src, bbox_list_tgt, height, width):
     return iou
 
 
+class MaskIoU:
+    """
+    IoU between 2 bounding box lists by painting them on masks, for pixel-exact comparisons with masks,
+    same as cal_iou_bbox_list_mask without allocating anything per call.
+    The masks of a resolution are allocated once and reused by the next calls, the buffers of the max_buffers
+    resolutions used last are kept.
+    The bboxes are painted one slice at a time. When they overlap so much that they cover the image more than
+    DIFF_PAINT_COVERAGE times, e.g. the top levels of a hierarchy, they are painted with a 2-D difference array and
+    two cumulative sums instead, O(height*width) whatever the bboxes.
+    The intersection is counted in place in the src mask, after its area is counted.
+    """
+    def __init__(self, max_buffers=4):
+        self.max_buffers = max_buffers
+        self.buffers = {}  # (height, width) -> [mask_src, mask_tgt, diff], least recently used first
+
+    def _get_buffers(self, height, width):
+        key = (height, width)
+        buffers = self.buffers.pop(key, None)
+        if buffers is None:
+            buffers = [np.empty((height, width), dtype=bool), np.empty((height, width), dtype=bool), None]
+            while len(self.buffers) >= self.max_buffers:
+                del self.buffers[next(iter(self.buffers))]
+        self.buffers[key] = buffers
+        return buffers
+
+    def paint(self, bbox_list, mask, buffers):
+        """
+        Paint the bboxes on mask, it is cleared first
+        """
+        height, width = mask.shape
+        x1, y1, x2, y2 = pixel_rects(bbox_list, height, width)
+        if np.sum((x2 - x1) * (y2 - y1)) <= DIFF_PAINT_COVERAGE * height * width:
+            mask.fill(False)
+            for x_tl, y_tl, x_br, y_br in zip(x1.tolist(), y1.tolist(), x2.tolist(), y2.tolist()):
+                mask[y_tl:y_br, x_tl:x_br] = True
+            return
+        if buffers[2] is None:
+            buffers[2] = np.empty((height + 1, width + 1), dtype=np.int32)
+        diff = buffers[2]
+        diff.fill(0)
+        # +1 at the top left and bottom right corners, -1 at the other two, the cumulative sums give the coverage
+        idx = np.concatenate((y1*(width + 1) + x1, y2*(width + 1) + x2, y1*(width + 1) + x2, y2*(width + 1) + x1))
+        values = np.repeat(np.array([1, -1], dtype=np.int32), 2*len(x1))
+        np.add.at(diff.reshape(-1), idx, values)
+        np.cumsum(diff, axis=0, out=diff)
+        np.cumsum(diff, axis=1, out=diff)
+        np.greater(diff[:height, :width], 0, out=mask)
+
+    def __call__(self, bbox_list_src, bbox_list_tgt, height, width):
+        buffers = self._get_buffers(height, width)
+        mask_src, mask_tgt = buffers[0], buffers[1]
+        self.paint(bbox_list_src, mask_src, buffers)
+        self.paint(bbox_list_tgt, mask_tgt, buffers)
+        area_src = np.count_nonzero(mask_src)
+        area_tgt = np.count_nonzero(mask_tgt)
+        area_intersection = np.count_nonzero(np.logical_and(mask_src, mask_tgt, out=mask_src))
+        iou = area_intersection / (area_src + area_tgt - area_intersection)
+        return iou
+
+
+_mask_iou = MaskIoU()  # Used by cal_iou_bbox_list without numba
+
+
+@njit(cache=True)
+def _find_uncovered(nxt, r, c):
+    """
+    First uncovered cell at or after column c in row r, with path compression
+    """
+    root = c
+    while nxt[r][root] != root:
+        root = nxt[r][root]
+    while nxt[r][c] != root:
+        nxt[r][c], c = root, nxt[r][c]
+    return root
+
+
+@njit(cache=True)
+def _cover(nxt, covered, other, col1, row1, col2, row2, cell_w, cell_h):
+    """
+    Cover the cells [col1, col2) x [row1, row2), only the cells not covered yet are visited.
+    Return the area newly covered and the part of it already covered by the other side.
+    """
+    area = 0
+    area_both = 0
+    for r in range(row1, row2):
+        c = _find_uncovered(nxt, r, col1)
+        while c < col2:
+            covered[r][c] = True
+            nxt[r][c] = c + 1
+            area += cell_w[c] * cell_h[r]
+            if other[r][c]:
+                area_both += cell_w[c] * cell_h[r]
+            c = _find_uncovered(nxt, r, c + 1)
+    return area, area_both
+
+
+@njit(cache=True)
+def _iou_curve_areas(rects_a, ends_a, rects_b, ends_b, nxt_a, nxt_b, covered_a, covered_b, cell_w, cell_h, areas):
+    """
+    Cover the rectangles of side a and b in order, areas[k] is the area covered by a, by b and by both once
+    the first ends_a[k] rectangles of a and ends_b[k] of b are covered.
+    rects_a, rects_b: (col1, row1, col2, row2) of every rectangle in cell indices
+    """
+    area_a = 0
+    area_b = 0
+    area_both = 0
+    i_a = 0
+    i_b = 0
+    for k in range(len(ends_a)):
+        while i_a < ends_a[k]:
+            area, both = _cover(nxt_a, covered_a, covered_b, rects_a[i_a][0], rects_a[i_a][1],
+                                rects_a[i_a][2], rects_a[i_a][3], cell_w, cell_h)
+            area_a += area
+            area_both += both
+            i_a += 1
+        while i_b < ends_b[k]:
+            area, both = _cover(nxt_b, covered_b, covered_a, rects_b[i_b][0], rects_b[i_b][1],
+                                rects_b[i_b][2], rects_b[i_b][3], cell_w, cell_h)
+            area_b += area
+            area_both += both
+            i_b += 1
+        areas[k][0] = area_a
+        areas[k][1] = area_b
+        areas[k][2] = area_both
+
+
+def _curve_side(tree_or_bboxes):
+    """
+    Bboxes of every node of a merge tree in the order they appear, and the No. of them in level 0.
+    A bbox list is a hierarchy with a single level.
+    """
+    if hasattr(tree_or_bboxes, "n_leaves"):
+        return np.asarray(tree_or_bboxes.bboxes).reshape(-1, 4), tree_or_bboxes.n_leaves
+    bboxes = np.asarray(tree_or_bboxes).reshape(-1, 4)
+    return bboxes, len(bboxes)
+
+
+def iou_curve(tree, reference, height=None, width=None):
+    """
+    IoU between every level of a merge tree and a reference, the same as cal_iou_bbox_list on every level,
+    for about the cost of one.
+    Every merged bbox contains its two children, so the union of the bboxes of level k+1 is the union of level k plus
+    the merged bbox: the union only grows and each merge only adds the area of the merged bbox not covered yet.
+    The coordinates of all the nodes are compressed into cells, each cell is covered once and a union-find per row
+    of cells skips the covered ones, so the whole curve takes O(No. of cells + sum of the rows of the merged bboxes).
+    The areas of disjoint bands of rows add up, so when there are more than MAX_CURVE_CELLS cells the rows are
+    covered band by band and the memory stays O(MAX_CURVE_CELLS + No. of bboxes) whatever the No. of cells.
+    tree: MergeTree, level k is tree.level(k)
+    reference: list of bboxes, e.g. the input bboxes, or another MergeTree to compare level by level.
+               A hierarchy with fewer levels than the other stays at its last level.
+    height, width: the bboxes are clipped to the image like on the masks, None for no clipping
+    Return an array of the IoU of each level
+    """
+    bboxes_a, n0_a = _curve_side(tree)
+    bboxes_b, n0_b = _curve_side(reference)
+    n_levels = max(len(bboxes_a) - n0_a, len(bboxes_b) - n0_b) + 1
+    rects_a = np.stack(pixel_rects(bboxes_a, height, width, drop_empty=False), axis=1)
+    rects_b = np.stack(pixel_rects(bboxes_b, height, width, drop_empty=False), axis=1)
+    # Cell boundaries, the empty rectangles are kept to keep the node order but cover no cell
+    rects = np.concatenate((rects_a, rects_b))
+    rects = rects[(rects[:, 2] > rects[:, 0]) & (rects[:, 3] > rects[:, 1])]
+    xs = np.unique(rects[:, [0, 2]])
+    ys = np.unique(rects[:, [1, 3]])
+    n_cols, n_rows = max(len(xs) - 1, 0), max(len(ys) - 1, 0)
+    for rects_side in (rects_a, rects_b):
+        rects_side[:, [0, 2]] = np.searchsorted(xs, rects_side[:, [0, 2]])
+        rects_side[:, [1, 3]] = np.searchsorted(ys, rects_side[:, [1, 3]])
+        # An empty rectangle out of all the cells would map past the last cell, collapse it to cover nothing
+        empty = (rects_side[:, 2] <= rects_side[:, 0]) | (rects_side[:, 3] <= rects_side[:, 1])
+        rects_side[empty] = 0
+    levels = np.arange(n_levels)
+    ends_a = np.minimum(n0_a + levels, len(bboxes_a))
+    ends_b = np.minimum(n0_b + levels, len(bboxes_b))
+    cell_w = np.diff(xs)
+    cell_h = np.diff(ys)
+    areas = np.zeros((n_levels, 3), dtype=np.int64)
+    band_rows = max(MAX_CURVE_CELLS // max(n_cols, 1), 1)
+    for row0 in range(0, max(n_rows, 1), band_rows):
+        row1 = min(row0 + band_rows, n_rows)
+        # Rows of the rectangles in the band, the ones out of it cover no row
+        bands = []
+        for rects_side in (rects_a, rects_b):
+            band = rects_side.copy()
+            band[:, [1, 3]] = np.clip(band[:, [1, 3]], row0, row1) - row0
+            bands.append(band)
+        # nxt[r][c] points to the next cell which may be uncovered in row r, column n_cols is the end of the row
+        nxt_a = np.tile(np.arange(n_cols + 1, dtype=np.int64), (row1 - row0, 1))
+        nxt_b = nxt_a.copy()
+        covered_a = np.zeros((row1 - row0, n_cols), dtype=bool)
+        covered_b = np.zeros((row1 - row0, n_cols), dtype=bool)
+        areas_band = np.zeros((n_levels, 3), dtype=np.int64)
+        args = [bands[0], ends_a, bands[1], ends_b, nxt_a, nxt_b, covered_a, covered_b,
+                cell_w, cell_h[row0:row1], areas_band]
+        args = kernel_args(args)
+        _iou_curve_areas(*args)
+        areas += np.asarray(args[-1], dtype=np.int64)
+    areas = areas.astype(np.float64)
+    return areas[:, 2] / (areas[:, 0] + areas[:, 1] - areas[:, 2])
+
+
+def cal_iou_bbox_list_test():
+    """
+    Test the exact IoU against painting the masks on random bboxes, some of them out of the image
+    """
+    rng = np.random.default_rng(0)
+    height, width = 120, 160
+    for n_src, n_tgt in [(1, 1), (0, 3), (5, 5), (40, 20), (200, 200)]:
+        bboxes = []
+        for n in (n_src, n_tgt):
+            x1, y1 = rng.integers(0, width + 10, n), rng.integers(0, height + 10, n)
+            w, h = rng.integers(0, 40, n), rng.integers(0, 40, n)
+            bboxes.append(np.stack((x1, y1, x1 + w, y1 + h), axis=1).tolist())
+        area_src, area_tgt, area_intersection = union_areas(bboxes[0], bboxes[1], height, width)
+        iou = area_intersection / (area_src + area_tgt - area_intersection)
+        iou_mask = cal_iou_bbox_list_mask(bboxes[0], bboxes[1], height, width)
+        assert iou == iou_mask, (iou, iou_mask)
+        print(f"{n_src} vs {n_tgt} bboxes, IoU: {iou}")
+    # Both unions empty, nan like the masks
+    with np.errstate(invalid="ignore"):
+        for bbox_list_src, bbox_list_tgt in [([], []), ([[width + 5, 0, width + 9, 9]], [[0, height, 9, height + 9]])]:
+            assert np.isnan(cal_iou_bbox_list(bbox_list_src, bbox_list_tgt, height, width))
+            assert np.isnan(cal_iou_bbox_list_mask(bbox_list_src, bbox_list_tgt, height, width))
+
+
+def mask_iou_test():
+    """
+    Test MaskIoU against cal_iou_bbox_list_mask, with both ways of painting and buffers of 2 resolutions
+    """
+    rng = np.random.default_rng(0)
+    mask_iou = MaskIoU(max_buffers=1)
+    for height, width, max_size in [(120, 160, 40), (120, 160, 200), (90, 70, 40), (120, 160, 40)]:
+        bboxes = []
+        for n in (100, 80):
+            x1, y1 = rng.integers(0, width + 10, n), rng.integers(0, height + 10, n)
+            w, h = rng.integers(0, max_size, n), rng.integers(0, max_size, n)
+            bboxes.append(np.stack((x1, y1, x1 + w, y1 + h), axis=1).tolist())
+        iou = mask_iou(bboxes[0], bboxes[1], height, width)
+        iou_mask = cal_iou_bbox_list_mask(bboxes[0], bboxes[1], height, width)
+        assert iou == iou_mask, (iou, iou_mask)
+        print(f"{height}x{width}, bboxes up to {max_size}, IoU: {iou}")
+    assert list(mask_iou.buffers) == [(120, 160)]
+
+
+def iou_curve_test():
+    """
+    Test the incremental IoU curve against cal_iou_bbox_list on every level of a hierarchy, some bboxes out of the image
+    """
+    from bbh.bbh import BBHFast, BBHNaive
+    # A bbox entirely out of the image covers no cell
+    curve = iou_curve([[0, 0, 9, 30], [60, 5, 70, 20]], [[0, 0, 9, 9]], 50, 50)
+    assert curve[0] == cal_iou_bbox_list_mask([[0, 0, 9, 30], [60, 5, 70, 20]], [[0, 0, 9, 9]], 50, 50)
+    rng = np.random.default_rng(0)
+    height, width = 300, 400
+    x1, y1 = rng.integers(0, width + 60, 60), rng.integers(0, height + 60, 60)
+    w, h = rng.integers(0, 50, 60), rng.integers(0, 50, 60)
+    bboxes = np.stack((x1, y1, x1 + w, y1 + h), axis=1).tolist()
+    tree_fast = BBHFast(bboxes=bboxes).merge(output="tree")
+    tree_bf = BBHNaive(bboxes=bboxes).merge(output="tree", stop_at_count=10)
+    curve = iou_curve(tree_fast, bboxes, height, width)
+    assert len(curve) == len(tree_fast)
+    for k, iou in enumerate(curve):
+        assert iou == cal_iou_bbox_list_mask(tree_fast.level(k), bboxes, height, width)
+    # The brute force hierarchy stopped early, it stays at its last level
+    curve = iou_curve(tree_fast, tree_bf, height, width)
+    for k, iou in enumerate(curve):
+        level_bf = tree_bf.level(min(k, len(tree_bf) - 1))
+        assert iou == cal_iou_bbox_list_mask(tree_fast.level(k), level_bf, height, width)
+    # Same curve when the rows are covered band by band
+    global MAX_CURVE_CELLS
+    max_curve_cells, MAX_CURVE_CELLS = MAX_CURVE_CELLS, 500
+    try:
+        assert np.array_equal(iou_curve(tree_fast, tree_bf, height, width), curve)
+    finally:
+        MAX_CURVE_CELLS = max_curve_cells
+    print(f"IoU curve of {len(curve)} levels: {curve[0]} ... {curve[-1]}")
+
+
 def main():
     bbox_list_src = [[10, 10, 19, 19]]
     bbox_list_tgt = [[15, 10, 24, 19],
@@ -47,6 +485,9 @@ def main():
                             width=width)
     print(f"Ground truth IoU: {iou_gt}")
     print(f"Calculated IoU: {iou}")
+    cal_iou_bbox_list_test()
+    mask_iou_test()
+    iou_curve_test()
 
 
 if __name__ == "__main__":
@@ -1,25 +1,14 @@
 import os
 import json
 import shutil
+from util.annotation_stream import stream_textocr_annotations
 
 
 def parse_annotation(ann_file_path, img_dir, out_dir, threshold=50):
     img_info = {}
-    with open(ann_file_path, 'r') as f:
-        data = json.load(f)
-    for ann_id in data['anns']:
-        img_id = data['anns'][ann_id]['image_id']
-        if data['imgs'][img_id]['set'] != "train":
-            continue
-        bbox = data['anns'][ann_id]['bbox']
-        bbox = [int(bbox[0]), int(bbox[1]), int(bbox[0]+bbox[2]), int(bbox[1]+bbox[3])]
-        if img_id not in img_info:
-            img_info[img_id] = {'bbox_list': [bbox],
-                                'file_name': data["imgs"][img_id]['file_name'],
-                                'width': data["imgs"][img_id]['width'],
-                                'height': data["imgs"][img_id]['height']}
-        else:
-            img_info[img_id]['bbox_list'].append(bbox)
+    # Stream the annotation file instead of loading it at once, see util.annotation_stream
+    for img_id, bboxes, meta in stream_textocr_annotations(ann_file_path, split="train"):
+        img_info[img_id] = {'bbox_list': bboxes.tolist(), **meta}
     img_info_select = {}
     # Select the subset that contains >= threshold bboxes
     for img_id in img_info: